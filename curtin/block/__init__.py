@@ -1,23 +1,54 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 import re
 from contextlib import contextmanager
+import binascii
+import ctypes
 import errno
+import fcntl
 import itertools
+import mmap
 import os
+import random
 import stat
+import struct
 import sys
 import tempfile
+import threading
+import time
 
 from curtin import util
 from curtin.block import lvm
 from curtin.block import multipath
+from curtin.block import partition_table
+from curtin.block import signatures
+from curtin.block import sysfs
 from curtin.log import LOG
-from curtin.udev import udevadm_settle, udevadm_info
+from curtin.udev import settle_generation, udevadm_settle, udevadm_info
 from curtin import storage_config
 
 
 SECTOR_SIZE_BYTES = 512
 
+# linux/fs.h: _IO(0x12, 119) and _IO(0x12, 127), take a u64 [start, length]
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+# issue discard/zeroout ioctls this many bytes at a time
+WIPE_IOCTL_RANGE_BYTES = 1024 ** 3
+# number of O_DIRECT writes direct_wipe_file keeps in flight
+WIPE_QUEUE_DEPTH = 4
+
+# linux/fs.h: _IO(0x12, 105), takes a struct blkpg_ioctl_arg
+BLKPG = 0x1269
+BLKPG_ADD_PARTITION = 1
+BLKPG_DEL_PARTITION = 2
+BLKPG_RESIZE_PARTITION = 3
+# linux/blkpg.h: struct blkpg_ioctl_arg {int op; int flags; int datalen;
+# void *data;} and struct blkpg_partition {long long start, length;
+# int pno; char devname[64], volname[64];}
+BLKPG_IOCTL_ARG = struct.Struct('iiiP')
+# (padded to the alignment of long long, as the kernel copies sizeof)
+BLKPG_PARTITION = struct.Struct('qqi64s64s0q')
+
 
 def get_dev_name_entry(devname):
     """
@@ -89,7 +120,7 @@ def path_to_kname(path):
     # only do this if given a path though, if kname is already specified then
     # this would cause a failure where the function should still be able to run
     if os.path.sep in path:
-        path = os.path.realpath(path)
+        path = sysfs.realpath(path)
     # using basename here ensures that the function will work given a path in
     # /dev, a kname, or a path in /sys/block as an arg
     dev_kname = os.path.basename(path)
@@ -290,6 +321,9 @@ def sfdisk_info(devpath):
     }
     '''
     (parent, partnum) = get_blockdev_for_partition(devpath)
+    table = read_partition_table(parent)
+    if table is not None:
+        return table
     try:
         (out, _err) = util.subp(['sfdisk', '--json', parent], capture=True)
     except util.ProcessExecutionError as e:
@@ -301,6 +335,24 @@ def sfdisk_info(devpath):
     return {}
 
 
+def read_partition_table(disk):
+    """ Read the gpt or dos partition table of disk without running sfdisk.
+
+    Returns the table in the format of sfdisk_info, or None if disk has no
+    partition table that can be read here, including device mapper disks
+    whose partitions sfdisk names after the mapper name.
+    """
+    if path_to_kname(disk).startswith('dm-'):
+        return None
+    try:
+        sector_size = int(util.load_file(
+            sys_block_path(disk, 'queue/logical_block_size')))
+        return partition_table.read_partition_table(disk, sector_size)
+    except (IOError, OSError, ValueError) as e:
+        LOG.debug('Unable to read partition table of %s: %s', disk, e)
+    return None
+
+
 def get_partition_sfdisk_info(devpath, sfdisk_info=None):
     if not sfdisk_info:
         sfdisk_info = sfdisk_info(devpath)
@@ -344,19 +396,77 @@ def get_unused_blockdev_info():
     These are devices that do not have anything mounted on them.
     """
 
-    # get a list of top level block devices, then iterate over it to get
-    # devices dependent on those.  If the lsblk call for that specific
-    # call has nothing 'MOUNTED", then this is an unused block device
+    from curtin.block.topology import BlockTopology
+
+    # get a list of top level block devices, then check whether any of
+    # them, their partitions or the devices holding them is mounted or in
+    # use as swap, using one snapshot of the block topology rather than an
+    # lsblk call for each device.
     bdinfo = _lsblock(['--nodeps'])
+    topology = BlockTopology()
+    in_use = get_mounted_majmin()
     unused = {}
     for devname, data in bdinfo.items():
-        cur = _lsblock([data['device_path']])
-        mountpoints = [x for x in cur if cur[x].get('MOUNTPOINT')]
-        if len(mountpoints) == 0:
+        if devname in topology:
+            tree = [devname] + topology.descendants(devname)
+            used = any(topology.get(kname)['majmin'] in in_use
+                       for kname in tree)
+        else:
+            cur = _lsblock([data['device_path']])
+            used = any(cur[x].get('MOUNTPOINT') for x in cur)
+        if not used:
             unused[devname] = data
     return unused
 
 
+def _blockdev_majmin(path):
+    """
+    return the major:minor of the block device at path, or None if path is
+    not a block device.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISBLK(st.st_mode):
+        return None
+    return '%s:%s' % (os.major(st.st_rdev), os.minor(st.st_rdev))
+
+
+def get_mounted_majmin(mountinfo="/proc/self/mountinfo", swaps="/proc/swaps"):
+    """
+    return a set of the major:minor numbers of block devices which are
+    mounted (per mountinfo) or are active swap devices (per swaps).
+
+    The major:minor field of mountinfo is the st_dev of the filesystem,
+    which for btrfs, zfs and other filesystems on anonymous devices is not
+    that of any block device, so the mount source is resolved as well.
+    """
+    majmins = set()
+    with open(mountinfo, "r") as fp:
+        for line in fp:
+            toks = line.split()
+            if len(toks) > 2 and not toks[2].startswith('0:'):
+                majmins.add(toks[2])
+            # optional fields end with '-', then fstype and mount source
+            if '-' not in toks[6:]:
+                continue
+            source = toks[toks.index('-', 6) + 2:][:1]
+            if source and source[0].startswith('/dev/'):
+                majmin = _blockdev_majmin(source[0])
+                if majmin:
+                    majmins.add(majmin)
+    with open(swaps, "r") as fp:
+        for line in fp.readlines()[1:]:
+            toks = line.split()
+            if not toks or not toks[0].startswith('/dev/'):
+                continue
+            majmin = _blockdev_majmin(toks[0])
+            if majmin:
+                majmins.add(majmin)
+    return majmins
+
+
 def get_devices_for_mp(mountpoint):
     """
     return a list of devices (full paths) used by the provided mountpoint
@@ -404,7 +514,7 @@ def get_blockdev_for_partition(devpath, strict=True):
     if device is not a partition, None will be returned for partition number
     """
     # normalize path
-    rpath = os.path.realpath(devpath)
+    rpath = sysfs.realpath(devpath)
 
     # convert an entry in /dev/ to parent disk and partition number
     # if devpath is a block device and not a partition, return (devpath, None)
@@ -429,15 +539,15 @@ def get_blockdev_for_partition(devpath, strict=True):
     if not os.path.exists(ptpath):
         return (rpath, None)
 
-    ptnum = util.load_file(ptpath).rstrip()
+    ptnum = sysfs.load_file(ptpath).rstrip()
 
     # for a partition, real syspath is something like:
     # /sys/devices/pci0000:00/0000:00:04.0/virtio1/block/vda/vda1
-    rsyspath = os.path.realpath(syspath)
+    rsyspath = sysfs.realpath(syspath)
     disksyspath = os.path.dirname(rsyspath)
 
-    diskmajmin = util.load_file(os.path.join(disksyspath, "dev")).rstrip()
-    diskdevpath = os.path.realpath("/dev/block/%s" % diskmajmin)
+    diskmajmin = sysfs.load_file(os.path.join(disksyspath, "dev")).rstrip()
+    diskdevpath = sysfs.realpath("/dev/block/%s" % diskmajmin)
 
     # diskdevpath has something like 253:0
     # and udev has put links in /dev/block/253:0 to the device name in /dev/
@@ -532,6 +642,111 @@ def rescan_block_devices(devices=None, warn_on_fail=True):
     return
 
 
+def blkpg_partition(disk, op, number, start_bytes, length_bytes):
+    """
+    add (BLKPG_ADD_PARTITION), resize (BLKPG_RESIZE_PARTITION) or delete
+    (BLKPG_DEL_PARTITION) partition number of disk in the kernel, without
+    re-reading the partition table.
+    raises OSError/IOError with the errno of the ioctl on failure.
+    """
+    part = ctypes.create_string_buffer(BLKPG_PARTITION.pack(
+        start_bytes, length_bytes, number, b'', b''))
+    arg = BLKPG_IOCTL_ARG.pack(op, 0, BLKPG_PARTITION.size,
+                               ctypes.addressof(part))
+    fd = os.open(disk, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, BLKPG, arg)
+    finally:
+        os.close(fd)
+
+
+def _register_partition(disk, number, start_bytes, length_bytes):
+    try:
+        blkpg_partition(disk, BLKPG_ADD_PARTITION, number, start_bytes,
+                        length_bytes)
+    except (IOError, OSError) as e:
+        if e.errno != errno.EBUSY:
+            raise
+        # the kernel already has a partition with this number, which can
+        # only be resized in place; if it starts elsewhere this fails too
+        blkpg_partition(disk, BLKPG_RESIZE_PARTITION, number, start_bytes,
+                        length_bytes)
+
+
+def _kernel_partitions(disk):
+    """
+    return {number: (start, size)} of the partitions of disk the kernel
+    knows about, per sysfs, in 512 byte sectors.
+    """
+    partitions = {}
+    for path in get_sysfs_partitions(disk):
+        attrs = sysfs.read_attrs(path, ('partition', 'start', 'size'))
+        try:
+            partitions[int(attrs['partition'])] = (int(attrs['start']),
+                                                   int(attrs['size']))
+        except (TypeError, ValueError):
+            continue
+    return partitions
+
+
+def register_partitions(disk, numbers):
+    """
+    tell the kernel about partitions numbers of disk as they are in its
+    partition table, one BLKPG ioctl each, so that unlike a full re-read
+    of the table the other partitions of disk are left alone and may be in
+    use.  partitions the kernel still has which are no longer in the table
+    are deleted.  falls back to rescan_block_devices if the table cannot
+    be read here, a partition is a dos extended partition, another
+    partition differs from the table or the kernel refuses.
+    """
+    # the partition table of disk has just been changed
+    sysfs.invalidate()
+    table = read_partition_table(disk)
+    if not table:
+        LOG.debug('Cannot read partition table of %s, rescanning', disk)
+        return rescan_block_devices([disk])
+    sector_size = table['sectorsize']
+    nodes = dict((part['node'], part) for part in table['partitions'])
+    for number, (start, size) in sorted(_kernel_partitions(disk).items()):
+        if number in numbers:
+            continue
+        part = nodes.get(partition_table.partition_node(table['device'],
+                                                        number))
+        if part is None:
+            LOG.debug('Deleting partition %s of %s, which is no longer in '
+                      'its partition table', number, disk)
+            try:
+                blkpg_partition(disk, BLKPG_DEL_PARTITION, number, 0, 0)
+            except (IOError, OSError) as e:
+                LOG.debug('Deleting partition %s of %s failed: %s, '
+                          'rescanning', number, disk, e)
+                return rescan_block_devices([disk])
+        elif (table['label'] != 'dos' or int(part['type'], 16) not in
+                partition_table.MBR_EXTENDED_TYPES) and (
+                (start, size) != (part['start'] * sector_size // 512,
+                                  part['size'] * sector_size // 512)):
+            LOG.debug('Partition %s of %s differs from its partition table, '
+                      'rescanning', number, disk)
+            return rescan_block_devices([disk])
+    for number in numbers:
+        part = nodes.get(partition_table.partition_node(table['device'],
+                                                        number))
+        if not part or (table['label'] == 'dos' and int(
+                part['type'], 16) in partition_table.MBR_EXTENDED_TYPES):
+            LOG.debug('Cannot register partition %s of %s, rescanning',
+                      number, disk)
+            return rescan_block_devices([disk])
+        try:
+            _register_partition(disk, number, part['start'] * sector_size,
+                                part['size'] * sector_size)
+        except (IOError, OSError) as e:
+            LOG.debug('Registering partition %s of %s failed: %s, '
+                      'rescanning', number, disk, e)
+            return rescan_block_devices([disk])
+    sysfs.invalidate()
+    LOG.debug('Registered partitions %s of %s', numbers, disk)
+
+
 def blkid(devs=None, cache=True):
     """
     get data about block devices from blkid and convert to dict
@@ -785,11 +1000,11 @@ def get_blockdev_sector_size(devpath):
         logical = info[parent]['LOG-SEC']
         physical = info[parent]['PHY-SEC']
     else:
-        sys_path = sys_block_path(devpath)
-        logical = util.load_file(
-            os.path.join(sys_path, 'queue/logical_block_size'))
-        physical = util.load_file(
-            os.path.join(sys_path, 'queue/hw_sector_size'))
+        attrs = sysfs.read_attrs(
+            sys_block_path(devpath),
+            ('queue/logical_block_size', 'queue/hw_sector_size'))
+        logical = attrs['queue/logical_block_size']
+        physical = attrs['queue/hw_sector_size']
 
     LOG.debug('get_blockdev_sector_size: (log=%s, phys=%s)', logical, physical)
     return (int(logical), int(physical))
@@ -799,8 +1014,7 @@ def read_sys_block_size_bytes(device):
     """ /sys/class/block/<device>/size and return integer value in bytes"""
     device_dir = os.path.join('/sys/class/block', os.path.basename(device))
     blockdev_size = os.path.join(device_dir, 'size')
-    with open(blockdev_size) as d:
-        size = int(d.read().strip()) * SECTOR_SIZE_BYTES
+    size = int(sysfs.load_file(blockdev_size).strip()) * SECTOR_SIZE_BYTES
     return size
 
 
@@ -880,22 +1094,105 @@ def get_dev_disk_byid():
     return _get_dev_disk_by_prefix('/dev/disk/by-id')
 
 
+class DiskLinkIndex(object):
+    """
+    Index of the /dev/disk/by-id, by-path and by-uuid symlinks, mapping each
+    link to its device and each device to its links, scanned once and
+    shared by lookups until udev settles or the index is invalidated.
+
+    Lookups check the links they return still point where the index says
+    and rescan the links once on a miss or a stale entry, so devices added
+    or changed since the scan are found.
+    """
+    PREFIXES = ('by-id', 'by-path', 'by-uuid')
+
+    def __init__(self, root='/dev/disk'):
+        self.root = root
+        self._lock = threading.Lock()
+        self._links = None
+        self._devices = None
+        self._generation = None
+
+    def invalidate(self):
+        """ Rescan the links on the next lookup. """
+        self._links = None
+
+    def refresh(self):
+        """ Scan the links now. """
+        self._generation = settle_generation()
+        links = {}
+        devices = {}
+        for prefix in self.PREFIXES:
+            mapping = {}
+            prefix_dir = os.path.join(self.root, prefix)
+            if os.path.exists(prefix_dir):
+                for name in os.listdir(prefix_dir):
+                    link = os.path.join(prefix_dir, name)
+                    mapping[link] = os.path.realpath(link)
+            links[prefix] = mapping
+            devices[prefix] = {}
+            for link, devpath in mapping.items():
+                devices[prefix].setdefault(devpath, []).append(link)
+        self._links = links
+        self._devices = devices
+
+    def _lookup(self, func):
+        """ Return func() on the index, rescanning once if it returns None.
+        """
+        with self._lock:
+            fresh = (self._links is None or
+                     self._generation != settle_generation())
+            if fresh:
+                self.refresh()
+            result = func()
+            if result is None and not fresh:
+                self.refresh()
+                result = func()
+        return result
+
+    def _valid(self, prefix, link):
+        return os.path.realpath(link) == self._links[prefix].get(link)
+
+    def device_link(self, prefix, devpath):
+        """ Return a link in prefix (e.g. 'by-id') to devpath, or None. """
+        def find():
+            for link in sorted(self._devices[prefix].get(devpath, [])):
+                if self._valid(prefix, link):
+                    return link
+        return self._lookup(find)
+
+    def find_links(self, prefix, substring):
+        """ Return the links in prefix with names containing substring,
+            shortest first, or None if there are none. """
+        def find():
+            links = sorted((link for link in self._links[prefix]
+                            if substring in os.path.basename(link)),
+                           key=lambda link: (len(link), link))
+            if links and all(self._valid(prefix, link) for link in links):
+                return links
+        return self._lookup(find)
+
+
+_DISK_LINKS = DiskLinkIndex()
+
+
+def invalidate_disk_links():
+    """ Rescan /dev/disk links on the next disk lookup. """
+    _DISK_LINKS.invalidate()
+
+
 def disk_to_byid_path(kname):
     """"
     Return a /dev/disk/by-id path to kname if present.
     """
-
-    mapping = get_dev_disk_byid()
-    return mapping.get(dev_path(kname))
+    return _DISK_LINKS.device_link('by-id', dev_path(kname))
 
 
 def disk_to_bypath_path(kname):
     """"
     Return a /dev/disk/by-path path to kname if present.
     """
-
-    mapping = _get_dev_disk_by_prefix('/dev/disk/by-path')
-    return mapping.get(dev_path(kname))
+    return _DISK_LINKS.device_link('by-path', dev_path(kname))
 
 
 def get_device_mapper_links(devpath, first=False):
@@ -923,17 +1220,15 @@ def lookup_disk(serial):
     serial_udev = serial.replace(' ', '_')
     LOG.info('Processing serial %s via udev to %s', serial, serial_udev)
 
-    disks = list(filter(lambda x: serial_udev in x,
-                        os.listdir("/dev/disk/by-id/")))
-    if not disks or len(disks) < 1:
+    disks = _DISK_LINKS.find_links('by-id', serial_udev)
+    if not disks:
         raise ValueError("no disk with serial '%s' found" % serial_udev)
 
-    # Sort by length and take the shortest path name, as the longer path names
-    # will be the partitions on the disk. Then use os.path.realpath to
-    # determine the path to the block device in /dev/
-    disks.sort(key=lambda x: len(x))
+    # The links are sorted by length, take the shortest path name, as the
+    # longer path names will be the partitions on the disk. Then use
+    # os.path.realpath to determine the path to the block device in /dev/
     LOG.debug('lookup_disks found: %s', disks)
-    path = os.path.realpath("/dev/disk/by-id/%s" % disks[0])
+    path = os.path.realpath(disks[0])
     # /dev/dm-X
     if multipath.is_mpath_device(path):
         info = udevadm_info(path)
@@ -996,18 +1291,15 @@ def sysfs_partition_data(blockdev=None, sysfs_path=None):
         sysfs_prefix = sys_block_path(parent)
         partnum = int(partnum)
 
-    block_size = int(util.load_file(os.path.join(
+    block_size = int(sysfs.load_file(os.path.join(
         sysfs_prefix, 'queue/logical_block_size')))
     unit = block_size
 
     ptdata = []
     for part_sysfs in get_sysfs_partitions(sysfs_prefix):
-        data = {}
-        for sfile in ('partition', 'start', 'size'):
-            dfile = os.path.join(part_sysfs, sfile)
-            if not os.path.isfile(dfile):
-                continue
-            data[sfile] = int(util.load_file(dfile))
+        data = dict((sfile, int(value)) for sfile, value in sysfs.read_attrs(
+            part_sysfs, ('partition', 'start', 'size')).items()
+            if value is not None)
         if partnum is None or data['partition'] == partnum:
             ptdata.append((path_to_kname(part_sysfs), data['partition'],
                            data['start'] * unit, data['size'] * unit,))
@@ -1086,16 +1378,26 @@ def is_extended_partition(device):
             check_dos_signature(device))
 
 
+def get_signatures(device):
+    """
+    read the partition table, raid, lvm, luks, bcache, zfs and filesystem
+    signatures on the specified device, see signatures.scan_signatures.
+    returns None if the device could not be read
+    """
+    devname = dev_path(path_to_kname(device))
+    try:
+        return signatures.scan_signatures(devname)
+    except (IOError, OSError) as e:
+        LOG.debug('Failed to read signatures on %s: %s', devname, e)
+        return None
+
+
 def is_zfs_member(device):
     """
     check if the specified device path is a zfs member
     """
-    info = _lsblock()
-    kname = path_to_kname(device)
-    if kname in info and info[kname].get('FSTYPE') == 'zfs_member':
-        return True
-
-    return False
+    scan = get_signatures(device)
+    return bool(scan and signatures.find_signature(scan, 'zfs_member'))
 
 
 def is_online(device):
@@ -1130,10 +1432,11 @@ def zkey_supported(strict=True):
 
 
 @contextmanager
-def exclusive_open(path, exclusive=True):
+def exclusive_open(path, exclusive=True, direct=False):
     """
     Obtain an exclusive file-handle to the file/device specified unless
-    caller specifics exclusive=False.
+    caller specifics exclusive=False.  With direct=True the file is opened
+    with O_DIRECT; callers must then write aligned buffers to its fileno().
     """
     mode = 'rb+'
     fd = None
@@ -1143,6 +1446,8 @@ def exclusive_open(path, exclusive=True):
     flags = os.O_RDWR
     if exclusive:
         flags += os.O_EXCL
+    if direct:
+        flags += os.O_DIRECT
     try:
         fd = os.open(path, flags)
         try:
@@ -1168,13 +1473,145 @@ def exclusive_open(path, exclusive=True):
         raise
 
 
-def wipe_file(path, reader=None, buflen=4 * 1024 * 1024, exclusive=True):
+class BandwidthLimiter(object):
+    """
+    Limit the combined rate of writes reported with consume() from any
+    number of threads to bytes_per_second.
+    """
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = float(bytes_per_second)
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def consume(self, nbytes):
+        with self._lock:
+            now = time.time()
+            start = max(self._next, now)
+            self._next = start + nbytes / self.bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+
+class RandomKeystream(object):
+    """
+    Fast pseudo-random data for wiping.  Reads generate fresh data with a
+    pseudo-random generator which is reseeded from /dev/urandom every
+    'reseed' reads, so no data repeats.  This is not suitable where
+    cryptographic randomness is required.
+    """
+    def __init__(self, reseed=64):
+        self.reseed = reseed
+        self._reads = 0
+        self._random = random.Random(os.urandom(32))
+
+    def read(self, size):
+        if self._reads >= self.reseed:
+            self._random.seed(os.urandom(32))
+            self._reads = 0
+        self._reads += 1
+        if size <= 0:
+            return b''
+        bits = self._random.getrandbits(8 * size)
+        if hasattr(bits, 'to_bytes'):
+            return bits.to_bytes(size, 'little')
+        # python2
+        return binascii.unhexlify('%0*x' % (2 * size, bits))
+
+
+def can_direct_wipe(path):
+    """
+    return True if direct_wipe_file can be used for path: a block device on
+    a python providing os.pwrite.
+    """
+    return hasattr(os, 'pwrite') and is_block_device(path)
+
+
+def direct_wipe_file(path, keystream=False, buflen=4 * 1024 * 1024,
+                     queue_depth=WIPE_QUEUE_DEPTH, exclusive=True,
+                     limiter=None):
+    """
+    wipe the block device at path with O_DIRECT writes of page-aligned
+    mmap buffers, keeping queue_depth writes of buflen bytes in flight.
+    zeros are written unless keystream is True, in which case the data
+    comes from a RandomKeystream per writer.  writes are throttled by the
+    BandwidthLimiter limiter if provided.
+    """
+    buflen = max(buflen // mmap.PAGESIZE, 1) * mmap.PAGESIZE
+    size = util.file_size(path)
+    LOG.debug("%s is %s bytes. wiping with O_DIRECT buflen=%s "
+              "queue_depth=%s keystream=%s", path, size, buflen,
+              queue_depth, keystream)
+
+    state = {'offset': 0, 'error': None}
+    lock = threading.Lock()
+
+    def next_offset():
+        with lock:
+            offset = state['offset']
+            if state['error'] or offset >= size:
+                return None
+            state['offset'] = offset + buflen
+            return offset
+
+    def writer(fd):
+        buf = mmap.mmap(-1, buflen)
+        view = memoryview(buf)
+        source = RandomKeystream() if keystream else None
+        try:
+            while True:
+                offset = next_offset()
+                if offset is None:
+                    return
+                length = min(buflen, size - offset)
+                if source:
+                    buf[0:length] = source.read(length)
+                if limiter:
+                    limiter.consume(length)
+                done = 0
+                while done < length:
+                    done += os.pwrite(fd, view[done:length], offset + done)
+        except Exception as e:
+            with lock:
+                state['error'] = state['error'] or e
+
+    start = time.time()
+    with exclusive_open(path, exclusive=exclusive, direct=True) as fp:
+        fd = fp.fileno()
+        threads = [threading.Thread(target=writer, args=(fd,))
+                   for _ in range(max(queue_depth, 1))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if state['error']:
+            raise state['error']
+        os.fsync(fd)
+
+    elapsed = max(time.time() - start, 0.001)
+    LOG.info("wiped %s (%s bytes) in %.1f seconds: %.1f MB/s", path, size,
+             elapsed, size / elapsed / 1024 ** 2)
+
+
+def wipe_file(path, reader=None, buflen=4 * 1024 * 1024, exclusive=True,
+              limiter=None):
     """
     wipe the existing file at path.
     if reader is provided, it will be called as a 'reader(buflen)'
     to provide data for each write.  Otherwise, zeros are used.
-    writes will be done in size of buflen.
+    writes will be done in size of buflen, throttled by the
+    BandwidthLimiter limiter if provided.
+    zeros are written with direct_wipe_file when path is a block device.
     """
+    if not reader and can_direct_wipe(path):
+        try:
+            return direct_wipe_file(path, buflen=buflen, exclusive=exclusive,
+                                    limiter=limiter)
+        except (IOError, OSError) as e:
+            if e.errno != errno.EINVAL:
+                raise
+            LOG.debug("O_DIRECT wipe of %s failed, using buffered writes: %s",
+                      path, e)
+
     if reader:
         readfunc = reader
     else:
@@ -1196,6 +1633,8 @@ def wipe_file(path, reader=None, buflen=4 * 1024 * 1024, exclusive=True):
                     "short read on reader got %d expected %d after %d" %
                     (len(pbuf), buflen, pos))
 
+            if limiter:
+                limiter.consume(min(buflen, size - pos))
             if pos + buflen >= size:
                 fp.write(pbuf[0:size-pos])
                 break
@@ -1286,21 +1725,107 @@ def zero_file_at_offsets(path, offsets, buflen=1024, count=1024, strict=False,
                     fp.write(buf)
 
 
-def wipe_volume(path, mode="superblock", exclusive=True, strict=False):
+def get_blockdev_queue_limit(path, limit):
+    """
+    return the integer value of queue/<limit> in sysfs for the block device
+    at path (read from the parent disk for partitions), or 0 if unavailable.
+    """
+    try:
+        (parent, _partnum) = get_blockdev_for_partition(path)
+        return int(util.load_file(
+            sys_block_path(parent, add=os.path.join('queue', limit))).strip())
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def ioctl_wipe_file(path, request, exclusive=True,
+                    range_bytes=WIPE_IOCTL_RANGE_BYTES, limiter=None):
+    """
+    discard (BLKDISCARD) or zero (BLKZEROOUT) the whole block device at path
+    with the kernel ioctl, range_bytes at a time, throttled by the
+    BandwidthLimiter limiter if provided.
+    """
+    name = {BLKDISCARD: 'BLKDISCARD', BLKZEROOUT: 'BLKZEROOUT'}[request]
+    size = util.file_size(path)
+    LOG.debug("%s is %s bytes. wiping with %s in ranges of %s bytes",
+              path, size, name, range_bytes)
+    with exclusive_open(path, exclusive=exclusive) as fp:
+        offset = 0
+        while offset < size:
+            length = min(range_bytes, size - offset)
+            if limiter:
+                limiter.consume(length)
+            fcntl.ioctl(fp.fileno(), request,
+                        struct.pack('QQ', offset, length))
+            offset += length
+
+
+def _ioctl_wipe_volume(path, mode, exclusive=True, limiter=None):
+    """
+    wipe path for the zeroout, discard and fast-zero modes of wipe_volume,
+    falling back to writing zeros if the device does not support the
+    ioctl.
+    """
+    request = BLKZEROOUT
+    if not is_block_device(path):
+        supported = False
+    elif mode == "discard":
+        request = BLKDISCARD
+        supported = get_blockdev_queue_limit(path, 'discard_max_bytes') > 0
+    elif mode == "fast-zero":
+        supported = (
+            get_blockdev_queue_limit(path, 'write_zeroes_max_bytes') > 0)
+    else:
+        # the kernel zeroes the range itself if the device lacks offload
+        supported = True
+
+    if supported:
+        # discards do not write data, only throttle zeroing
+        try:
+            return ioctl_wipe_file(
+                path, request, exclusive=exclusive,
+                limiter=limiter if request == BLKZEROOUT else None)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+                raise
+            LOG.warning("wipe mode %s failed on %s: %s", mode, path, e)
+
+    LOG.debug("wipe mode %s not supported on %s, writing zeros", mode, path)
+    wipe_file(path, exclusive=exclusive, limiter=limiter)
+
+
+def wipe_volume(path, mode="superblock", exclusive=True, strict=False,
+                limiter=None):
     """wipe a volume/block device
 
     :param path: a path to a block device
     :param mode: how to wipe it.
        pvremove: wipe a lvm physical volume
        zero: write zeros to the entire volume
-       random: write random data (/dev/urandom) to the entire volume
+       zeroout: have the kernel zero the entire volume (BLKZEROOUT)
+       discard: discard the entire volume (BLKDISCARD) if the device
+                supports it, otherwise write zeros to it
+       fast-zero: use BLKZEROOUT if the device can zero without writing
+                  data (write_zeroes_max_bytes), otherwise write zeros
+       random: write random data (/dev/urandom, or a RandomKeystream seeded
+               from it for block devices) to the entire volume
        superblock: zero the beginning and the end of the volume
        superblock-recursive: zero the beginning of the volume, the end of the
                     volume and beginning and end of any partitions that are
                     known to be on this device.
     :param exclusive: boolean to control how path is opened
     :param strict: boolean to control when to raise errors on write failures
+    :param limiter: BandwidthLimiter throttling the zero, zeroout, fast-zero
+                    and random modes
     """
+    try:
+        return _wipe_volume(path, mode, exclusive, strict, limiter)
+    finally:
+        # what sysfs reports of path, its partitions and holders may change
+        sysfs.invalidate()
+
+
+def _wipe_volume(path, mode, exclusive, strict, limiter):
     if mode == "pvremove":
         # We need to use --force --force in case it's already in a volgroup and
         # pvremove doesn't want to remove it
@@ -1312,10 +1837,23 @@ def wipe_volume(path, mode="superblock", exclusive=True, strict=False):
                   rcs=[0, 5], capture=True)
         lvm.lvm_scan()
     elif mode == "zero":
-        wipe_file(path, exclusive=exclusive)
+        wipe_file(path, exclusive=exclusive, limiter=limiter)
+    elif mode in ("zeroout", "discard", "fast-zero"):
+        _ioctl_wipe_volume(path, mode, exclusive=exclusive, limiter=limiter)
     elif mode == "random":
+        if can_direct_wipe(path):
+            try:
+                return direct_wipe_file(path, keystream=True,
+                                        exclusive=exclusive,
+                                        limiter=limiter)
+            except (IOError, OSError) as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                LOG.debug("O_DIRECT wipe of %s failed, using buffered "
+                          "writes: %s", path, e)
         with open("/dev/urandom", "rb") as reader:
-            wipe_file(path, reader=reader.read, exclusive=exclusive)
+            wipe_file(path, reader=reader.read, exclusive=exclusive,
+                      limiter=limiter)
     elif mode == "superblock":
         quick_zero(path, partitions=False, exclusive=exclusive, strict=strict)
     elif mode == "superblock-recursive":
@@ -1324,6 +1862,66 @@ def wipe_volume(path, mode="superblock", exclusive=True, strict=False):
         raise ValueError("wipe mode %s not supported" % mode)
 
 
+def get_wipe_spindles(path):
+    """
+    return the set of knames of the whole disks underneath the device at
+    path, following slaves (for raid, lvm, crypt, ...) and partitions.
+    """
+    spindles = set()
+    for kname in get_device_slave_knames(path):
+        try:
+            (parent, _partnum) = get_blockdev_for_partition(kname)
+            spindles.add(path_to_kname(parent))
+        except OSError:
+            spindles.add(kname)
+    return spindles
+
+
+def wipe_volumes(jobs, max_workers=1, bandwidth=None, exclusive=True,
+                 strict=False):
+    """
+    wipe several volumes, running jobs on physically distinct disks at the
+    same time.
+
+    :param jobs: list of (path, mode) tuples, see wipe_volume for modes.
+                 jobs whose devices share an underlying disk run one after
+                 the other, in list order.
+    :param max_workers: maximum number of jobs running at the same time.
+    :param bandwidth: optional limit in bytes per second on the combined
+                      write rate of all jobs.
+    """
+    jobs = list(jobs)
+    limiter = BandwidthLimiter(bandwidth) if bandwidth else None
+
+    # jobs sharing a disk, directly or through another job, form a group
+    # of (spindles, job indices) which is wiped one job at a time
+    groups = []
+    for index, (path, _mode) in enumerate(jobs):
+        spindles = get_wipe_spindles(path)
+        indices = [index]
+        for group in [g for g in groups if g[0] & spindles]:
+            groups.remove(group)
+            spindles |= group[0]
+            indices.extend(group[1])
+        groups.append((spindles, sorted(indices)))
+
+    depends = {}
+    for _spindles, indices in groups:
+        for previous, index in zip(indices, indices[1:]):
+            depends[index] = [previous]
+    LOG.info('wiping %s volumes on %s independent disk groups with %s '
+             'workers', len(jobs), len(groups), max_workers)
+
+    def wipe_job(index):
+        (path, mode) = jobs[index]
+        with util.LogTimer(LOG.info, 'wiping %s with mode %s' % (path, mode)):
+            wipe_volume(path, mode=mode, exclusive=exclusive, strict=strict,
+                        limiter=limiter)
+
+    util.run_in_dependency_order(range(len(jobs)), wipe_job, depends=depends,
+                                 max_workers=max_workers)
+
+
 def get_supported_filesystems():
     """ Return a list of filesystems that the kernel currently supports
         as read from /proc/filesystems.
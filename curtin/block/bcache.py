@@ -7,7 +7,7 @@ import time
 from curtin import util
 from curtin.log import LOG
 from curtin.udev import udevadm_settle
-from . import dev_path, sys_block_path
+from . import dev_path, get_signatures, signatures, sys_block_path
 
 # Wait up to 20 minutes (150 + 300 + 750 = 1200 seconds)
 BCACHE_RETRIES = [sleep for nap in [1, 2, 5] for sleep in [nap] * 150]
@@ -37,6 +37,33 @@ def superblock_asdict(device=None, data=None):
     return bcache_super
 
 
+def read_superblock(device):
+    """ Read the bcache superblock of device without bcache-super-show.
+
+    Returns a dictionary with the keys of superblock_asdict which describe
+    the superblock (sb.version, dev.label, dev.uuid, cset.uuid and for
+    backing devices dev.data.cache_mode), or None if device has no bcache
+    superblock."""
+    scan = get_signatures(device)
+    sig = signatures.find_signature(scan, 'bcache') if scan else None
+    if not sig:
+        LOG.debug('No bcache superblock found on %s', device)
+        return None
+    role = 'backing' if sig['role'] == 'backing' else 'caching'
+    sbdict = {
+        'sb.magic': 'ok',
+        'sb.version': '%s [%s device]' % (sig['version'], role),
+        'dev.label': sig.get('label', '(empty)'),
+        'dev.uuid': sig.get('uuid'),
+        'cset.uuid': sig.get('set_uuid'),
+    }
+    if 'cache_mode' in sig:
+        sbdict['dev.data.cache_mode'] = '%s [%s]' % (
+            signatures.BCACHE_CACHE_MODES.index(sig['cache_mode']),
+            sig['cache_mode'])
+    return sbdict
+
+
 def parse_sb_version(device=None, sbdict=None):
     """ Parse bcache 'sb_version' field to integer if possible.
 
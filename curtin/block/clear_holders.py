@@ -6,10 +6,13 @@ top of a block device, making it possible to reuse the block device without
 having to reboot the system
 """
 
+import errno
 import glob
 import os
 import time
 
+from collections import deque, OrderedDict
+
 from curtin import (block, udev, util)
 from curtin.swap import is_swap_device
 from curtin.block import bcache
@@ -17,6 +20,7 @@ from curtin.block import lvm
 from curtin.block import mdadm
 from curtin.block import multipath
 from curtin.block import zfs
+from curtin.block.topology import BlockTopology, SYS_CLASS_BLOCK
 from curtin.log import LOG
 
 # poll frequenty, but wait up to 60 seconds total
@@ -432,35 +436,142 @@ def get_holders(device):
     return holders
 
 
+class HoldersScan(object):
+    """
+    The holders of every block device, read in a single walk of sysfs
+    (holders/, slaves/ and partitions of /sys/class/block/*) and shared by
+    all of the holders trees generated from it.
+
+    The device type of each device is identified once per scan.  After
+    changing the storage stack, call refresh() to walk sysfs again; device
+    types are kept for devices with the same major:minor and slaves.
+    """
+    def __init__(self, sysfs_dir=SYS_CLASS_BLOCK):
+        self.sysfs_dir = sysfs_dir
+        self.topology = BlockTopology(sysfs_dir=sysfs_dir)
+        self._dev_types = {}
+        self._trees = {}
+
+    def refresh(self):
+        """ Walk sysfs again, dropping the holders trees built so far. """
+        self.topology.refresh()
+        self._trees = {}
+        return self
+
+    def _entry(self, kname):
+        try:
+            return self.topology.get(kname)
+        except KeyError:
+            # device may have appeared since the walk, read just its entry
+            self.topology.invalidate(kname)
+        try:
+            return self.topology.get(kname)
+        except KeyError:
+            return None
+
+    def dev_type(self, device):
+        """
+        return the dev_type of the device with sysfs path 'device'
+        """
+        entry = self._entry(os.path.basename(device))
+        key = (device,)
+        if entry:
+            key = (device, entry['majmin'], tuple(entry['slaves']))
+        if key not in self._dev_types:
+            # the DEV_TYPE registry contains a function under the key 'ident'
+            # for each device type entry that returns true if the device
+            # passed to it is of the correct type. in the event that no
+            # identify functions return true, the device will be treated as
+            # a disk (DEFAULT_DEV_TYPE).
+            self._dev_types[key] = next(
+                (k for k, v in DEV_TYPES.items() if v['ident'](device)),
+                DEFAULT_DEV_TYPE)
+        return self._dev_types[key]
+
+    def holders_tree(self, device):
+        """
+        return the holders tree above 'device', in the format of
+        gen_holders_tree
+        """
+        kname = block.path_to_kname(device)
+        if self._entry(kname) is None:
+            err = OSError("devname '%s' did not have existing syspath '%s'" %
+                          (device, os.path.join(self.sysfs_dir, kname)))
+            err.errno = errno.ENOENT
+            raise err
+        return self._tree(kname)
+
+    def slaves(self, device):
+        """
+        return the sysfs paths of the devices which 'device' is built on
+        """
+        entry = self._entry(block.path_to_kname(device))
+        if entry is None:
+            return []
+        return [os.path.join(self.sysfs_dir, kname)
+                for kname in entry['slaves']]
+
+    def holders_trees(self, base_paths):
+        """
+        return a list of the holders trees above each of base_paths, with
+        devices holding more than one of them shared between the trees
+        """
+        return [self.holders_tree(path) for path in base_paths]
+
+    def _tree(self, kname):
+        if kname in self._trees:
+            return self._trees[kname]
+        entry = self._entry(kname)
+        device = os.path.join(self.sysfs_dir, kname)
+        tree = {'device': device, 'dev_type': self.dev_type(device),
+                'name': kname, 'holders': []}
+        self._trees[kname] = tree
+        # the holders for a device should consist of the devices in the
+        # holders/ dir in sysfs and any partitions on the device. this
+        # ensures that a storage tree starting from a disk will include all
+        # devices holding the disk's partitions
+        for holder in entry['holders'] + entry['partitions']:
+            if self._entry(holder) is None:
+                LOG.debug("holder '%s' of '%s' is gone, skipping", holder,
+                          kname)
+                continue
+            tree['holders'].append(self._tree(holder))
+        return tree
+
+
 def gen_holders_tree(device):
     """
     generate a tree representing the current storage hirearchy above 'device'
     """
-    device = block.sys_block_path(device)
-    dev_name = block.path_to_kname(device)
-    # the holders for a device should consist of the devices in the holders/
-    # dir in sysfs and any partitions on the device. this ensures that a
-    # storage tree starting from a disk will include all devices holding the
-    # disk's partitions
-    holders = get_holders(device)
-    holder_paths = ([block.sys_block_path(h) for h in holders] +
-                    block.get_sysfs_partitions(device))
-    # the DEV_TYPE registry contains a function under the key 'ident' for each
-    # device type entry that returns true if the device passed to it is of the
-    # correct type. there should never be a situation in which multiple
-    # identify functions return true. therefore, it will always work to take
-    # the device type with the first identify function that returns true as the
-    # device type for the current device. in the event that no identify
-    # functions return true, the device will be treated as a disk
-    # (DEFAULT_DEV_TYPE). the identify function for disk never returns true.
-    # the next() builtin in python will not raise a StopIteration exception if
-    # there is a default value defined
-    dev_type = next((k for k, v in DEV_TYPES.items() if v['ident'](device)),
-                    DEFAULT_DEV_TYPE)
-    return {
-        'device': device, 'dev_type': dev_type, 'name': dev_name,
-        'holders': [gen_holders_tree(h) for h in holder_paths],
-    }
+    return HoldersScan().holders_tree(device)
+
+
+def build_holders_graph(holders_trees):
+    """
+    merge holders trees into a graph with a single node for each device
+
+    returns an OrderedDict keyed by device sysfs path, in the order devices
+    are first found walking the trees, with values of
+    {'dev_type': dev_type, 'holders': [holder sysfs paths]}
+    """
+    graph = OrderedDict()
+
+    def add_tree(tree):
+        device = tree['device']
+        if device in graph:
+            # the subtree of a device is the same wherever it appears
+            return
+        holders = []
+        for holder in tree['holders']:
+            if holder['device'] not in holders:
+                holders.append(holder['device'])
+        graph[device] = {'dev_type': tree['dev_type'], 'holders': holders}
+        for holder in tree['holders']:
+            add_tree(holder)
+
+    for holders_tree in holders_trees:
+        add_tree(holders_tree)
+    return graph
 
 
 def plan_shutdown_holder_trees(holders_trees):
@@ -475,10 +586,6 @@ def plan_shutdown_holder_trees(holders_trees):
     to start at an equal place in storage hirearchy (i.e. a list of trees
     starting from disk)
     """
-    # holds a temporary registry of holders to allow cross references
-    # key = device sysfs path, value = {} of priority level, shutdown function
-    reg = {}
-
     # normalize to list of trees
     if not isinstance(holders_trees, (list, tuple)):
         holders_trees = [holders_trees]
@@ -486,47 +593,55 @@ def plan_shutdown_holder_trees(holders_trees):
     # sort the trees to ensure we generate a consistent plan
     holders_trees = sorted(holders_trees, key=lambda x: x['device'])
 
-    def htree_level(tree):
-        if len(tree['holders']) == 0:
-            return 0
-        return 1 + sum(htree_level(holder) for holder in tree['holders'])
-
-    def flatten_holders_tree(tree, level=0):
-        """
-        add entries from holders tree to registry with level key corresponding
-        to how many layers from raw disks the current device is at
-        """
-        device = tree['device']
-        device_level = htree_level(tree)
-
-        # always go with highest level if current device has been
-        # encountered already. since the device and everything above it is
-        # re-added to the registry it ensures that any increase of level
-        # required here will propagate down the tree
-        # this handles a scenario like mdadm + bcache, where the backing
-        # device for bcache is a 3rd level item like mdadm, but the cache
-        # device is 1st level (disk) or second level (partition), ensuring
-        # that the bcache item is always considered higher level than
-        # anything else regardless of whether it was added to the tree via
-        # the cache device or backing device first
-        if device in reg:
-            level = max(reg[device]['level'], level) + 1
-
-        else:
-            # first time device to registry, assume the larger value of the
-            # current level or the length of its dependencies.
-            level = max(device_level, level)
-
+    # devices shared by several trees (a volume group on many partitions,
+    # a bcache device with its cache and backing devices on different disks)
+    # appear once in the graph, so each device is only visited once below
+    graph = build_holders_graph(holders_trees)
+
+    # order devices so that every device comes after all of the devices it
+    # holds
+    pending = dict((device, 0) for device in graph)
+    for node in graph.values():
+        for holder in node['holders']:
+            pending[holder] += 1
+    ready = deque(device for device in graph if pending[device] == 0)
+    order = []
+    while ready:
+        device = ready.popleft()
+        order.append(device)
+        for holder in graph[device]['holders']:
+            pending[holder] -= 1
+            if pending[holder] == 0:
+                ready.append(holder)
+
+    if len(order) != len(graph):
+        raise ValueError('Holders trees contain a cycle through: %s' %
+                         sorted(set(graph) - set(order)))
+
+    # the htree level of a device is the size of the holders tree above it,
+    # computed once per device from the levels of its holders
+    htree_levels = {}
+    for device in reversed(order):
+        holders = graph[device]['holders']
+        htree_levels[device] = (
+            1 + sum(htree_levels[h] for h in holders) if holders else 0)
+
+    # a device starts at the larger value of its htree level and one more
+    # than the highest level of the devices below it.
+    # this handles a scenario like mdadm + bcache, where the backing
+    # device for bcache is a 3rd level item like mdadm, but the cache
+    # device is 1st level (disk) or second level (partition), ensuring
+    # that the bcache item is always considered higher level than
+    # anything else regardless of whether it was found via the cache
+    # device or backing device first
+    levels = dict((device, 0) for device in graph)
+    reg = {}
+    for device in order:
+        level = max(htree_levels[device], levels[device])
         reg[device] = {'level': level, 'device': device,
-                       'dev_type': tree['dev_type']}
-
-        # handle holders above this level
-        for holder in tree['holders']:
-            flatten_holders_tree(holder, level=level + 1)
-
-    # flatten the holders tree into the registry
-    for holders_tree in holders_trees:
-        flatten_holders_tree(holders_tree)
+                       'dev_type': graph[device]['dev_type']}
+        for holder in graph[device]['holders']:
+            levels[holder] = max(levels[holder], level + 1)
 
     def devtype_order(dtype):
         """Return the order in which we want to clear device types, higher
@@ -545,11 +660,52 @@ def plan_shutdown_holder_trees(holders_trees):
     # Devices must be cleared in descending 'level' value.  For devices which
     # have the same 'level' value, we sort within the 'level' by devtype order.
     return [reg[k]
-            for k in sorted(reg, reverse=True,
+            for k in sorted(graph, reverse=True,
                             key=lambda x: (reg[x]['level'],
                                            devtype_order(reg[x]['dev_type'])))]
 
 
+def group_shutdown_plan(ordered_devs, holders_trees, holders_scan=None):
+    """
+    split a shutdown plan into groups of devices which can be shut down
+    independently of each other
+
+    devices are in the same group if one holds the other, directly or through
+    other devices in the holders trees.  with holders_scan, devices built on
+    the same device (as listed in sysfs slaves/) are also grouped together,
+    for example bcache devices sharing a cache device which is not itself in
+    the holders trees.
+
+    returns a list of groups, each a list of entries in ordered_devs order
+    """
+    if not isinstance(holders_trees, (list, tuple)):
+        holders_trees = [holders_trees]
+    parents = {}
+
+    def find(device):
+        parents.setdefault(device, device)
+        while parents[device] != device:
+            parents[device] = parents[parents[device]]
+            device = parents[device]
+        return device
+
+    def union(device, other):
+        parents[find(other)] = find(device)
+
+    for device, node in build_holders_graph(holders_trees).items():
+        find(device)
+        for holder in node['holders']:
+            union(device, holder)
+        if holders_scan is not None:
+            for slave in holders_scan.slaves(device):
+                union(device, slave)
+
+    groups = OrderedDict()
+    for dev_info in ordered_devs:
+        groups.setdefault(find(dev_info['device']), []).append(dev_info)
+    return list(groups.values())
+
+
 def format_holders_tree(holders_tree):
     """
     draw a nice dirgram of the holders tree
@@ -584,28 +740,39 @@ def get_holder_types(tree):
     return types
 
 
-def assert_clear(base_paths):
+def assert_clear(base_paths, holders_scan=None):
     """
     Check if all paths in base_paths are clear to use
+
+    A HoldersScan used by clear_holders may be passed in as holders_scan, it
+    is refreshed and its device type identification reused.
     """
     valid = ('disk', 'partition')
     if not isinstance(base_paths, (list, tuple)):
         base_paths = [base_paths]
+    if holders_scan is None:
+        holders_scan = HoldersScan()
+    else:
+        holders_scan.refresh()
     base_paths = [block.sys_block_path(path, strict=False)
                   for path in base_paths]
-    for holders_tree in [gen_holders_tree(p)
-                         for p in base_paths if os.path.exists(p)]:
+    for holders_tree in holders_scan.holders_trees(
+            [p for p in base_paths if os.path.exists(p)]):
         if any(holder_type not in valid and path not in base_paths
                for (holder_type, path) in get_holder_types(holders_tree)):
             raise OSError('Storage not clear, remaining:\n{}'
                           .format(format_holders_tree(holders_tree)))
 
 
-def clear_holders(base_paths, try_preserve=False):
+def clear_holders(base_paths, try_preserve=False, holders_scan=None,
+                  max_workers=1):
     """
     Clear all storage layers depending on the devices specified in 'base_paths'
     A single device or list of devices can be specified.
     Device paths can be specified either as paths in /dev or /sys/block
+    Holders are read with holders_scan, a new HoldersScan if not specified.
+    Up to max_workers independent groups of devices are shut down at the same
+    time, the devices of each group in plan order.
     Will throw OSError if any holders could not be shut down
     """
     # handle single path
@@ -614,47 +781,55 @@ def clear_holders(base_paths, try_preserve=False):
     LOG.info('Generating device storage trees for path(s): %s', base_paths)
 
     # get current holders and plan how to shut them down
-    holder_trees = [gen_holders_tree(path) for path in base_paths]
+    if holders_scan is None:
+        holders_scan = HoldersScan()
+    holder_trees = holders_scan.holders_trees(base_paths)
     LOG.info('Current device storage tree:\n%s',
              '\n'.join(format_holders_tree(tree) for tree in holder_trees))
     ordered_devs = plan_shutdown_holder_trees(holder_trees)
     LOG.info('Shutdown Plan:\n%s', "\n".join(map(str, ordered_devs)))
 
-    # run shutdown functions
-    for dev_info in ordered_devs:
+    # each device waits for the device before it in its group, devices in
+    # different groups do not wait for each other
+    depends = {}
+    groups = group_shutdown_plan(ordered_devs, holder_trees, holders_scan)
+    for group in groups:
+        for previous, dev_info in zip(group, group[1:]):
+            depends[dev_info['device']] = [previous['device']]
+    if max_workers > 1 and len(groups) > 1:
+        LOG.info('Shutting down %s independent groups of holders with %s '
+                 'workers', len(groups), max_workers)
+
+    devices = dict((dev_info['device'], dev_info) for dev_info in ordered_devs)
+
+    def shutdown(device):
+        dev_info = devices[device]
         dev_type = DEV_TYPES.get(dev_info['dev_type'])
         shutdown_function = dev_type.get('shutdown')
         if not shutdown_function:
-            continue
+            return
 
         if try_preserve and shutdown_function in DATA_DESTROYING_HANDLERS:
             LOG.info('shutdown function for holder type: %s is destructive. '
                      'attempting to preserve data, so skipping' %
                      dev_info['dev_type'])
-            continue
+            return
 
         if os.path.exists(dev_info['device']):
             LOG.info("shutdown running on holder type: '%s' syspath: '%s'",
                      dev_info['dev_type'], dev_info['device'])
             shutdown_function(dev_info['device'])
 
+    # run shutdown functions
+    util.run_in_dependency_order(
+        [dev_info['device'] for dev_info in ordered_devs], shutdown,
+        depends=depends, max_workers=max_workers)
+
 
-def start_clear_holders_deps():
+def _start_mdadm_arrays():
     """
-    prepare system for clear holders to be able to scan old devices
+    give any assembling mdadm arrays a second poke and log their details
     """
-    # a mdadm scan has to be started in case there is a md device that needs to
-    # be detected. if the scan fails, it is either because there are no mdadm
-    # devices on the system, or because there is a mdadm device in a damaged
-    # state that could not be started. due to the nature of mdadm tools, it is
-    # difficult to know which is the case. if any errors did occur, then ignore
-    # them, since no action needs to be taken if there were no mdadm devices on
-    # the system, and in the case where there is some mdadm metadata on a disk,
-    # but there was not enough to start the array, the call to wipe_volume on
-    # all disks and partitions should be sufficient to remove the mdadm
-    # metadata
-    mdadm.mdadm_assemble(scan=True, ignore_errors=True)
-    # collect detail on any assembling arrays
     for md in [md for md in glob.glob('/dev/md*')
                if not os.path.isdir(md) and not identify_partition(md)]:
         mdstat = None
@@ -686,32 +861,111 @@ def start_clear_holders_deps():
         except util.ProcessExecutionError:
             LOG.debug('Non-fatal error when querying mdadm detail on %s', md)
 
+
+def _start_multipath():
+    """
+    reload multipath maps if multipath is supported, returns True if it is
+    """
     mp_support = multipath.multipath_supported()
     if mp_support:
         LOG.debug('Detected multipath support, reload maps')
         multipath.reload()
         multipath.force_devmapper_symlinks()
+    return mp_support
 
-    # scan and activate for logical volumes
+
+def _start_lvm(mp_support):
+    """
+    scan and activate for logical volumes
+    """
     lvm.lvm_scan(multipath=mp_support)
     try:
         lvm.activate_volgroups(multipath=mp_support)
     except util.ProcessExecutionError:
         # partial vg may not come up due to missing members, that's OK
         pass
-    udev.udevadm_settle()
 
-    # the bcache module needs to be present to properly detect bcache devs
-    # on some systems (precise without hwe kernel) it may not be possible to
-    # lad the bcache module bcause it is not present in the kernel. if this
-    # happens then there is no need to halt installation, as the bcache devices
-    # will never appear and will never prevent the disk from being reformatted
-    util.load_kernel_module('bcache')
 
+def _check_zfs():
     if not zfs.zfs_supported():
         LOG.warning('zfs filesystem is not supported in this environment')
 
 
+def start_clear_holders_deps():
+    """
+    prepare system for clear holders to be able to scan old devices
+
+    steps which do not depend on each other run at the same time, followed by
+    a single udev settle.  returns a dictionary of the seconds each step took.
+    """
+    state = {'mp_support': False}
+
+    def assemble_mdadm():
+        # a mdadm scan has to be started in case there is a md device that
+        # needs to be detected. if the scan fails, it is either because there
+        # are no mdadm devices on the system, or because there is a mdadm
+        # device in a damaged state that could not be started. due to the
+        # nature of mdadm tools, it is difficult to know which is the case. if
+        # any errors did occur, then ignore them, since no action needs to be
+        # taken if there were no mdadm devices on the system, and in the case
+        # where there is some mdadm metadata on a disk, but there was not
+        # enough to start the array, the call to wipe_volume on all disks and
+        # partitions should be sufficient to remove the mdadm metadata
+        mdadm.mdadm_assemble(scan=True, ignore_errors=True)
+
+    def load_bcache():
+        # the bcache module needs to be present to properly detect bcache
+        # devs on some systems (precise without hwe kernel) it may not be
+        # possible to lad the bcache module bcause it is not present in the
+        # kernel. if this happens then there is no need to halt installation,
+        # as the bcache devices will never appear and will never prevent the
+        # disk from being reformatted
+        util.load_kernel_module('bcache')
+
+    def start_multipath():
+        state['mp_support'] = _start_multipath()
+
+    steps = {
+        'mdadm-assemble': assemble_mdadm,
+        # collect detail on any assembling arrays
+        'mdadm-run': _start_mdadm_arrays,
+        'multipath': start_multipath,
+        'lvm': lambda: _start_lvm(state['mp_support']),
+        'bcache': load_bcache,
+        'zfs': _check_zfs,
+    }
+    # arrays are assembled before anything else looks at their members,
+    # volume groups are activated once the arrays and multipath devices they
+    # may be on are present, and bcache, which registers the devices it finds
+    # when loaded, comes after both
+    depends = {
+        'mdadm-run': ['mdadm-assemble'],
+        'multipath': ['mdadm-assemble'],
+        'lvm': ['mdadm-run', 'multipath'],
+        'bcache': ['mdadm-run', 'lvm'],
+    }
+    order = ['mdadm-assemble', 'zfs', 'mdadm-run', 'multipath', 'lvm',
+             'bcache']
+    timings = {}
+
+    def run_step(name):
+        start = time.time()
+        try:
+            steps[name]()
+        finally:
+            timings[name] = time.time() - start
+
+    util.run_in_dependency_order(order, run_step, depends=depends,
+                                 max_workers=len(order))
+    start = time.time()
+    udev.udevadm_settle()
+    timings['settle'] = time.time() - start
+    LOG.debug('clear-holders dependencies started: %s',
+              ', '.join('%s %.3fs' % (name, timings[name])
+                        for name in order + ['settle'] if name in timings))
+    return timings
+
+
 # anything that is not identified can assumed to be a 'disk' or similar
 DEFAULT_DEV_TYPE = 'disk'
 # handlers that should not be run if an attempt is being made to preserve data
@@ -0,0 +1,1072 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+""" Write dd- disk images to block devices without a shell pipeline: the
+    image is fetched in one thread, unpacked in another and written in
+    aligned blocks by the caller, with bounded queues in between. """
+
+import bz2
+import errno
+import fcntl
+import hashlib
+import os
+import struct
+import tarfile
+import threading
+import time
+import zlib
+from xml.etree import ElementTree
+
+try:
+    import queue
+except ImportError:
+    # python2
+    import Queue as queue  # pylint: disable=import-error
+
+try:
+    import lzma
+except ImportError:
+    # python2
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from curtin import block
+from curtin import url_helper
+from curtin.log import LOG
+from curtin.reporter import events
+
+# images are written in blocks of this size, at offsets aligned to it
+IMAGE_BLOCK_SIZE = 4 * 1024 * 1024
+# size of the chunks passed between the threads
+IMAGE_CHUNK_SIZE = 1024 * 1024
+# chunks queued between two threads before the producer waits
+IMAGE_QUEUE_DEPTH = 16
+# attempts to resume an interrupted http(s) download
+IMAGE_FETCH_RETRIES = 3
+IMAGE_FETCH_RETRY_DELAY = 3
+# android sparse image format, from libsparse sparse_format.h
+SPARSE_MAGIC = 0xed26ff3a
+SPARSE_HEADER = struct.Struct('<IHHHHIIII')
+SPARSE_CHUNK = struct.Struct('<HHII')
+SPARSE_CHUNK_RAW = 0xcac1
+SPARSE_CHUNK_FILL = 0xcac2
+SPARSE_CHUNK_DONT_CARE = 0xcac3
+SPARSE_CHUNK_CRC32 = 0xcac4
+
+# qcow2 format, from qemu docs/interop/qcow2.txt
+QCOW2_MAGIC = b'QFI\xfb'
+QCOW2_HEADER = struct.Struct('>4sIQIIQIIQQIIQ')
+# version 3: incompatible, compatible and autoclear features,
+# refcount_order and header_length
+QCOW2_V3_HEADER = struct.Struct('>QQQII')
+QCOW2_HEADER_READ_BYTES = 4096
+QCOW2_INCOMPAT_DIRTY = 1
+QCOW2_OFFSET_MASK = 0x00fffffffffffe00
+QCOW2_COMPRESSED = 1 << 62
+QCOW2_ZERO = 1
+# compressed clusters this close to each other are read at once, up to
+# this many bytes
+QCOW2_READ_GAP = 64 * 1024
+QCOW2_COMPRESSED_READ_BYTES = 4 * 1024 * 1024
+
+# all-zero pieces of the image of this size are not written, if possible
+IMAGE_ZERO_SIZE = 64 * 1024
+ZERO_BLOCKS_MODES = ('punch', 'zero-device', 'write')
+# seconds between progress messages
+PROGRESS_INTERVAL = 10
+
+# compression of each dd- source type and the container of the image, if
+# it is not a plain disk image: the first file of a tar archive, an android
+# sparse image or a qcow2 image.  'auto' lets tarfile recognise the
+# compression, as smtar does.
+IMAGE_FORMATS = {
+    'dd-raw': (None, None),
+    'dd-gz': ('gz', None),
+    'dd-bz2': ('bz2', None),
+    'dd-xz': ('xz', None),
+    'dd-zst': ('zst', None),
+    'dd-tar': ('auto', 'tar'),
+    'dd-tgz': ('gz', 'tar'),
+    'dd-tbz': ('bz2', 'tar'),
+    'dd-txz': ('xz', 'tar'),
+    'dd-sparse': (None, 'android-sparse'),
+    'dd-qcow2': (None, 'qcow2'),
+}
+
+
+def supported(source_type):
+    """ Return True if images of source_type can be written natively by
+        this python, which may lack the lzma or zstandard modules. """
+    if source_type not in IMAGE_FORMATS:
+        return False
+    compression, _container = IMAGE_FORMATS[source_type]
+    if compression == 'xz':
+        return lzma is not None
+    if compression == 'zst':
+        return zstandard is not None
+    return True
+
+
+class _Decompressor(object):
+    """ One compressed stream, decompressed into pieces of a bounded size
+        where the decompression module allows it. """
+
+    def __init__(self, compression):
+        self.compression = compression
+        if compression == 'gz':
+            # a gzip header and trailer, not a raw zlib stream
+            self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif compression == 'bz2':
+            self._obj = bz2.BZ2Decompressor()
+        elif compression == 'xz':
+            self._obj = lzma.LZMADecompressor()
+        elif compression == 'zst':
+            self._obj = zstandard.ZstdDecompressor().decompressobj()
+        else:
+            raise ValueError('unknown compression: %s' % compression)
+
+    @property
+    def eof(self):
+        if hasattr(self._obj, 'eof'):
+            return self._obj.eof
+        # python2 zlib only tells that the stream ended by leaving the
+        # input which follows it unused
+        return bool(self._obj.unused_data)
+
+    @property
+    def truncated(self):
+        """ True if the stream is known to have ended before its end. """
+        return hasattr(self._obj, 'eof') and not self._obj.eof
+
+    @property
+    def unused_data(self):
+        return self._obj.unused_data
+
+    def decompress(self, data, size=IMAGE_CHUNK_SIZE):
+        """ Generate the output of decompressing data. """
+        if self.compression == 'gz':
+            while True:
+                out = self._obj.decompress(data, size)
+                if out:
+                    yield out
+                data = self._obj.unconsumed_tail
+                if not data and len(out) < size:
+                    return
+        elif hasattr(self._obj, 'needs_input'):
+            out = self._obj.decompress(data, size)
+            while True:
+                if out:
+                    yield out
+                if self._obj.eof or self._obj.needs_input:
+                    return
+                out = self._obj.decompress(b'', size)
+        else:
+            yield self._obj.decompress(data)
+
+
+def _decompress(chunks, compression):
+    """ Generate the decompressed content of chunks, which may hold several
+        compressed streams one after another, as zcat and xzcat allow.
+
+    :raises: ValueError if the last stream is incomplete.
+    """
+    decompressor = None
+    for data in chunks:
+        while data:
+            if decompressor is None or decompressor.eof:
+                decompressor = _Decompressor(compression)
+            for out in decompressor.decompress(data):
+                yield out
+            data = decompressor.unused_data
+    if decompressor is None:
+        raise ValueError('image is empty')
+    if decompressor.truncated:
+        raise ValueError('compressed image is truncated')
+
+
+class _ChunkReader(object):
+    """ File-like reads over an iterable of chunks, for tarfile. """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self._offset = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._offset >= len(self._buffer):
+                self._buffer = next(self._chunks, b'')
+                self._offset = 0
+                if not self._buffer:
+                    break
+            end = (len(self._buffer) if size < 0 else
+                   min(len(self._buffer), self._offset + size))
+            parts.append(self._buffer[self._offset:end])
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+        return b''.join(parts)
+
+
+def _untar(chunks, compression):
+    """ Generate the content of the first regular file of the tar archive
+        in chunks, as 'tar -xO' writes an archive of a single image.
+
+    :param compression: 'auto' if tarfile should decompress the archive.
+    """
+    mode = 'r|*' if compression == 'auto' else 'r|'
+    with tarfile.open(fileobj=_ChunkReader(chunks), mode=mode) as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            fp = tar.extractfile(member)
+            while True:
+                data = fp.read(IMAGE_CHUNK_SIZE)
+                if not data:
+                    return
+                yield data
+    raise ValueError('tar archive has no image file')
+
+
+class _Hole(object):
+    """ length bytes of an image which read as zeroes if zero is True, or
+        whose content does not matter otherwise.  Passed to the writer in
+        place of the data, by formats which know where their data is. """
+
+    def __init__(self, length, zero=True):
+        self.length = length
+        self.zero = zero
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        return (isinstance(other, _Hole) and
+                (self.length, self.zero) == (other.length, other.zero))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '_Hole(%s, zero=%s)' % (self.length, self.zero)
+
+
+def _read_exact(reader, length):
+    data = reader.read(length)
+    if len(data) != length:
+        raise ValueError('image is truncated')
+    return data
+
+
+def _android_sparse(chunks):
+    """ Generate the content of the android sparse image in chunks, as data
+        and holes. """
+    reader = _ChunkReader(chunks)
+    (magic, major, _minor, file_hdr_sz, chunk_hdr_sz, blk_sz, _total_blks,
+     total_chunks, _checksum) = SPARSE_HEADER.unpack(
+        _read_exact(reader, SPARSE_HEADER.size))
+    if magic != SPARSE_MAGIC or major != 1:
+        raise ValueError('not an android sparse image')
+    if file_hdr_sz < SPARSE_HEADER.size or chunk_hdr_sz < SPARSE_CHUNK.size:
+        raise ValueError('invalid android sparse image header')
+    _read_exact(reader, file_hdr_sz - SPARSE_HEADER.size)
+    for _ in range(total_chunks):
+        header = _read_exact(reader, chunk_hdr_sz)
+        chunk_type, _reserved, chunk_sz, total_sz = SPARSE_CHUNK.unpack_from(
+            header)
+        length = chunk_sz * blk_sz
+        payload = total_sz - chunk_hdr_sz
+        if chunk_type == SPARSE_CHUNK_RAW:
+            if payload != length:
+                raise ValueError('invalid android sparse raw chunk')
+            while length:
+                data = _read_exact(reader, min(IMAGE_CHUNK_SIZE, length))
+                length -= len(data)
+                yield data
+        elif chunk_type == SPARSE_CHUNK_FILL:
+            fill = _read_exact(reader, payload)[:4]
+            if fill == b'\0\0\0\0':
+                yield _Hole(length)
+                continue
+            pattern = fill * (IMAGE_CHUNK_SIZE // 4)
+            while length:
+                data = pattern[:min(len(pattern), length)]
+                length -= len(data)
+                yield data
+        elif chunk_type == SPARSE_CHUNK_DONT_CARE:
+            yield _Hole(length, zero=False)
+        elif chunk_type == SPARSE_CHUNK_CRC32:
+            _read_exact(reader, payload)
+        else:
+            raise ValueError('unknown android sparse chunk type 0x%x' %
+                             chunk_type)
+
+
+def _read_bmap(uri):
+    """ Read the bmaptool block map at uri.
+
+    :returns: (image size, list of mapped (start, end, checksum) byte
+              ranges, hashlib algorithm of the checksums or None)
+    """
+    root = ElementTree.fromstring(b''.join(_fetch(uri)))
+    if root.tag != 'bmap':
+        raise ValueError('%s is not a block map' % uri)
+    image_size = int(root.findtext('ImageSize'))
+    block_size = int(root.findtext('BlockSize'))
+    algorithm = (root.findtext('ChecksumType') or '').strip() or None
+    ranges = []
+    for elem in root.find('BlockMap').findall('Range'):
+        first, _, last = elem.text.strip().partition('-')
+        checksum = elem.get('chksum')
+        if checksum is None and elem.get('sha1'):
+            # block maps before version 1.4 only had sha1 checksums
+            checksum, algorithm = elem.get('sha1'), 'sha1'
+        ranges.append((int(first) * block_size,
+                       min((int(last or first) + 1) * block_size,
+                           image_size),
+                       checksum))
+    return (image_size, sorted(ranges), algorithm)
+
+
+def _bmap_filter(chunks, bmap):
+    """ Generate the content of the raw image in chunks, with the parts not
+        mapped by bmap (as from _read_bmap) as holes whose content does not
+        matter, as bmaptool copies images.
+
+    :raises: ValueError if a mapped range does not match its checksum.
+    """
+    image_size, ranges, algorithm = bmap
+    offset = 0
+    index = 0
+    hasher = None
+    for data in chunks:
+        pos = 0
+        while pos < len(data):
+            if index < len(ranges) and offset >= ranges[index][0]:
+                start, end, checksum = ranges[index]
+                if hasher is None and algorithm and checksum:
+                    hasher = hashlib.new(algorithm)
+                piece = data[pos:pos + end - offset]
+                if hasher:
+                    hasher.update(piece)
+                yield piece
+                if offset + len(piece) == end:
+                    if hasher and hasher.hexdigest() != checksum.lower():
+                        raise ValueError('range %s-%s of image does not match '
+                                         'its block map' % (start, end))
+                    hasher = None
+                    index += 1
+            else:
+                limit = (ranges[index][0] if index < len(ranges) else
+                         max(image_size, offset + len(data)))
+                piece = _Hole(min(len(data) - pos, limit - offset), zero=False)
+                yield piece
+            offset += len(piece)
+            pos += len(piece)
+    if index < len(ranges):
+        raise ValueError('image is shorter than its block map')
+
+
+def _qcow2_header(data):
+    (magic, version, backing_file_offset, _backing_file_size, cluster_bits,
+     size, crypt_method, l1_size, l1_table_offset, _refcount_table_offset,
+     _refcount_table_clusters, _nb_snapshots,
+     _snapshots_offset) = QCOW2_HEADER.unpack_from(data)
+    if magic != QCOW2_MAGIC:
+        raise ValueError('not a qcow2 image')
+    if version not in (2, 3):
+        raise ValueError('unsupported qcow2 version %s' % version)
+    if backing_file_offset:
+        raise ValueError('qcow2 images with a backing file are not supported')
+    if crypt_method:
+        raise ValueError('encrypted qcow2 images are not supported')
+    if version == 3:
+        incompatible = QCOW2_V3_HEADER.unpack_from(data, QCOW2_HEADER.size)[0]
+        if incompatible & ~QCOW2_INCOMPAT_DIRTY:
+            raise ValueError('qcow2 image has unsupported incompatible '
+                             'features 0x%x' % incompatible)
+    return {'cluster_bits': cluster_bits, 'size': size, 'l1_size': l1_size,
+            'l1_table_offset': l1_table_offset}
+
+
+def _qcow2_clusters(uri, header):
+    """ Generate (kind, host offset, host length) for each guest cluster of
+        the qcow2 image, kind being 'data', 'compressed' or 'zero'. """
+    cluster_bits = header['cluster_bits']
+    cluster_size = 1 << cluster_bits
+    l2_size = cluster_size // 8
+    clusters = (header['size'] + cluster_size - 1) // cluster_size
+    # the host offset of a compressed cluster is followed by the number of
+    # 512 byte sectors it spans, less one
+    compressed_bits = 62 - (cluster_bits - 8)
+    sectors_mask = (1 << (cluster_bits - 8)) - 1
+    l1 = struct.unpack('>%dQ' % header['l1_size'], _read_range(
+        uri, header['l1_table_offset'], header['l1_size'] * 8))
+    for l1_entry in l1:
+        count = min(l2_size, clusters)
+        clusters -= count
+        l2_offset = l1_entry & QCOW2_OFFSET_MASK
+        if not l2_offset:
+            for _ in range(count):
+                yield ('zero', None, 0)
+        else:
+            l2 = struct.unpack('>%dQ' % l2_size,
+                               _read_range(uri, l2_offset, cluster_size))
+            for entry in l2[:count]:
+                if entry & QCOW2_COMPRESSED:
+                    host = entry & ((1 << compressed_bits) - 1)
+                    sectors = ((entry >> compressed_bits) & sectors_mask) + 1
+                    yield ('compressed', host, sectors * 512 - (host & 511))
+                elif entry & QCOW2_ZERO or not entry & QCOW2_OFFSET_MASK:
+                    yield ('zero', None, 0)
+                else:
+                    yield ('data', entry & QCOW2_OFFSET_MASK, cluster_size)
+        if not clusters:
+            return
+
+
+def _qcow2_runs(clusters):
+    """ Merge the clusters of _qcow2_clusters into runs of one kind, [kind,
+        guest clusters, host start, host end, [(host, length)]], read at
+        once: data clusters which follow each other on the host and
+        compressed clusters close to each other. """
+    run = None
+    for kind, host, length in clusters:
+        if run and run[0] == kind and (
+                kind == 'zero' or
+                (kind == 'data' and host == run[3]) or
+                (kind == 'compressed' and
+                 run[2] <= host <= run[3] + QCOW2_READ_GAP and
+                 run[3] - run[2] < QCOW2_COMPRESSED_READ_BYTES)):
+            run[1] += 1
+            if host is not None:
+                run[3] = max(run[3], host + length)
+                run[4].append((host, length))
+            continue
+        if run:
+            yield run
+        run = [kind, 1, host, None if host is None else host + length,
+               [(host, length)]]
+    if run:
+        yield run
+
+
+def _qcow2(uri):
+    """ Generate the content of the qcow2 image at uri as data and holes,
+        reading only its tables and allocated clusters. """
+    header = _qcow2_header(_read_range(uri, 0, QCOW2_HEADER_READ_BYTES,
+                                       exact=False))
+    cluster_size = 1 << header['cluster_bits']
+    remaining = header['size']
+    for kind, count, start, end, clusters in _qcow2_runs(
+            _qcow2_clusters(uri, header)):
+        length = min(count * cluster_size, remaining)
+        remaining -= length
+        if kind == 'zero':
+            yield _Hole(length)
+        elif kind == 'data':
+            read = 0
+            for data in _fetch(uri, start, length):
+                read += len(data)
+                yield data
+            if read != length:
+                raise ValueError('qcow2 image is truncated')
+        else:
+            data = _read_range(uri, start, end - start, exact=False)
+            for host, host_length in clusters:
+                out = zlib.decompressobj(-12).decompress(
+                    data[host - start:host - start + host_length],
+                    cluster_size)
+                if len(out) != cluster_size:
+                    raise ValueError('invalid compressed cluster at %s of '
+                                     'qcow2 image' % host)
+                yield out[:length]
+                length -= len(out[:length])
+
+
+def _fetch(uri, offset=0, length=None, retries=IMAGE_FETCH_RETRIES,
+           retry_delay=IMAGE_FETCH_RETRY_DELAY):
+    """ Generate the content of uri, a local path or url, from offset and
+        up to length bytes, or to the end if length is None.  http(s) urls
+        are read from offset and resumed after an interruption with range
+        requests.
+
+    :raises: ValueError if the server does not support range requests
+             where they are needed.
+    """
+    end = None if length is None else offset + length
+
+    def next_size():
+        if end is None:
+            return IMAGE_CHUNK_SIZE
+        return min(IMAGE_CHUNK_SIZE, end - offset)
+
+    parsed = url_helper.urlparse(uri)
+    if parsed.scheme in ('', 'file'):
+        with open(parsed.path, 'rb') as fp:
+            fp.seek(offset)
+            while next_size() > 0:
+                data = fp.read(next_size())
+                if not data:
+                    return
+                offset += len(data)
+                yield data
+        return
+
+    attempts = 0
+    while next_size() > 0:
+        headers = None
+        if offset or end is not None:
+            headers = {'Range': 'bytes=%d-%s' % (
+                offset, '' if end is None else end - 1)}
+        try:
+            with url_helper.UrlReader(uri, headers=headers) as reader:
+                if headers and reader.fp.getcode() != 206:
+                    raise ValueError('%s does not support range requests, '
+                                     'cannot read from byte %s' %
+                                     (uri, offset))
+                while next_size() > 0:
+                    data = reader.read(next_size())
+                    if not data:
+                        return
+                    offset += len(data)
+                    yield data
+        except url_helper.UrlError as e:
+            # retry on internal server errors and dropped connections
+            if (e.code is not None and e.code < 500) or attempts >= retries:
+                raise
+            attempts += 1
+            LOG.warning('Reading %s failed at byte %s: %s. Retrying in %s '
+                        'seconds.', uri, offset, e, retry_delay)
+            time.sleep(retry_delay)
+
+
+def _read_range(uri, offset, length, exact=True):
+    """ Return length bytes of uri at offset, fewer only at its end if not
+        exact. """
+    data = b''.join(_fetch(uri, offset, length))
+    if exact and len(data) != length:
+        raise ValueError('short read of %s bytes at %s of %s' %
+                         (length, offset, uri))
+    return data
+
+
+def _hashed(chunks, hasher):
+    for data in chunks:
+        hasher.update(data)
+        yield data
+
+
+def _checksum(source):
+    """ Return (hasher, expected hex digest) for the optional checksum of a
+        source, given as '<algorithm>:<hex digest>', or (None, None). """
+    checksum = source.get('checksum')
+    if not checksum:
+        return (None, None)
+    if ':' not in checksum:
+        raise ValueError("checksum '%s' is not of the form "
+                         "'<algorithm>:<hex digest>'" % checksum)
+    algorithm, digest = checksum.split(':', 1)
+    return (hashlib.new(algorithm), digest.lower())
+
+
+class _Stage(object):
+    """ Run a generator in its own thread, passing what it yields through a
+        bounded queue to whatever iterates over the stage.  An exception in
+        the generator is raised to the consumer. """
+
+    _END = object()
+
+    def __init__(self, name, generator, depth=IMAGE_QUEUE_DEPTH):
+        self.name = name
+        self._generator = generator
+        self._queue = queue.Queue(maxsize=depth)
+        self._stopped = threading.Event()
+        self._exhausted = False
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            for data in self._generator:
+                if not self._put((data, None)):
+                    return
+            self._put((self._END, None))
+        except Exception as e:
+            self._put((None, e))
+
+    def __iter__(self):
+        while not self._stopped.is_set():
+            try:
+                data, error = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if error is not None:
+                raise error
+            if data is self._END:
+                self._exhausted = True
+                return
+            yield data
+
+    def drain(self):
+        """ Read whatever the consumer of the stage left of it. """
+        if not self._exhausted:
+            for _data in self:
+                pass
+
+    def stop(self):
+        """ Stop the stage if still running. """
+        self._stopped.set()
+
+    def join(self):
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+def _zero_request(devnode, zero_blocks):
+    """ Return the ioctl which makes a range of the block device devnode read
+        as zeroes without writing them, or None if it has none. """
+    if zero_blocks == 'write':
+        return None
+    if block.get_blockdev_queue_limit(devnode, 'write_zeroes_max_bytes') > 0:
+        return block.BLKZEROOUT
+    # discard only zeroes on devices which say so
+    if (block.get_blockdev_queue_limit(devnode, 'discard_zeroes_data') == 1 and
+            block.get_blockdev_queue_limit(devnode, 'discard_max_bytes') > 0):
+        return block.BLKDISCARD
+    return None
+
+
+class _BlockWriter(object):
+    """ Write a stream to a device in blocks of block_size at offsets
+        aligned to block_size, the last block possibly shorter.
+
+    Runs of all-zero pieces of zero_size are handled as zero_blocks says:
+       write: write them like any other data.
+       punch: zero them with BLKZEROOUT, or BLKDISCARD if the device reads
+              discarded blocks as zeroes, writing them if it can do neither.
+              Zeroes past the end of a regular file are not written.
+       zero-device: zero the whole device once with BLKZEROOUT (or empty a
+                    regular file) before writing, then skip them.  Devices
+                    which cannot zero without writing are handled as punch.
+
+    Holes in sparse images are handled likewise if they read as zeroes, and
+    skipped if their content does not matter.
+    """
+
+    def __init__(self, devnode, block_size=IMAGE_BLOCK_SIZE,
+                 zero_blocks='write', zero_size=IMAGE_ZERO_SIZE):
+        if zero_blocks not in ZERO_BLOCKS_MODES:
+            raise ValueError("unknown zero_blocks mode '%s', expected one of "
+                             "%s" % (zero_blocks, ZERO_BLOCKS_MODES))
+        self.devnode = devnode
+        self.block_size = block_size
+        self.zero_blocks = zero_blocks
+        self.zero_size = zero_size
+        self.offset = 0
+        # bytes of zeroes which were not written
+        self.zeroed = 0
+        # bytes of holes in the image whose content does not matter
+        self.skipped = 0
+        self._buffer = bytearray()
+        self._zeroes = bytes(bytearray(max(block_size, zero_size)))
+        # pending run of zeroes, [_zero_start, offset)
+        self._zero_start = None
+        # zeroes at or after this offset are skipped
+        self._skip_from = float('inf')
+        self._request = None
+        self._is_file = not block.is_block_device(devnode)
+        self._fd = os.open(devnode, os.O_WRONLY)
+        try:
+            self._prepare()
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def _prepare(self):
+        if self.zero_blocks == 'write':
+            return
+        if self._is_file:
+            size = os.fstat(self._fd).st_size
+            if self.zero_blocks == 'zero-device':
+                # truncating drops the content, keep the size
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                size = 0
+            self._skip_from = size
+        elif (self.zero_blocks == 'zero-device' and
+                block.get_blockdev_queue_limit(
+                    self.devnode, 'write_zeroes_max_bytes') <= 0):
+            # the kernel would write every zero of the device itself
+            LOG.info('%s cannot zero without writing, zeroing ranges of '
+                     'zeroes of the image instead', self.devnode)
+            self._request = _zero_request(self.devnode, 'punch')
+        elif self.zero_blocks == 'zero-device':
+            LOG.info('Zeroing %s before writing the image', self.devnode)
+            try:
+                block.ioctl_wipe_file(self.devnode, block.BLKZEROOUT,
+                                      exclusive=False)
+                self._skip_from = 0
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY,
+                                   errno.EINVAL):
+                    raise
+                LOG.warning('Zeroing %s failed, zeroing ranges of zeroes '
+                            'instead: %s', self.devnode, e)
+                self._request = _zero_request(self.devnode, 'punch')
+        else:
+            self._request = _zero_request(self.devnode, self.zero_blocks)
+        LOG.debug('Zero blocks of image for %s: mode %s, request %s, '
+                  'skipped from %s', self.devnode, self.zero_blocks,
+                  self._request, self._skip_from)
+
+    def write(self, data):
+        """ Write bytes of the image, or a _Hole. """
+        if isinstance(data, _Hole):
+            if self._buffer:
+                self._write_block(bytes(self._buffer))
+                self._buffer = bytearray()
+            self.skip(data.length, zero=data.zero)
+            return
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block_data = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._write_block(block_data)
+
+    def _write_block(self, data):
+        if self.zero_blocks == 'write':
+            self._write_data(data)
+            return
+        # split the block into runs of data and of zeroes
+        run_start = 0
+        for pos in range(0, len(data), self.zero_size):
+            piece = data[pos:pos + self.zero_size]
+            if (len(piece) == self.zero_size and
+                    piece == self._zeroes[:self.zero_size]):
+                if pos > run_start:
+                    self._write_data(data[run_start:pos])
+                if self._zero_start is None:
+                    self._zero_start = self.offset
+                self.offset += len(piece)
+                run_start = pos + len(piece)
+        if run_start < len(data):
+            self._write_data(data[run_start:])
+
+    def skip(self, length, zero=True):
+        """ Move past length bytes of the image which read as zeroes if
+            zero, handled as zero_blocks says, or else are not written. """
+        if zero:
+            if self._zero_start is None:
+                self._zero_start = self.offset
+        else:
+            self._flush_zeroes()
+            self.skipped += length
+        self.offset += length
+
+    def _write_data(self, data):
+        self._flush_zeroes()
+        os.lseek(self._fd, self.offset, os.SEEK_SET)
+        while data:
+            written = os.write(self._fd, data)
+            self.offset += written
+            data = data[written:]
+
+    def _flush_zeroes(self):
+        """ Zero, or skip, the pending run of zeroes. """
+        if self._zero_start is None:
+            return
+        start, end = self._zero_start, self.offset
+        self._zero_start = None
+        skip_from = max(start, min(end, self._skip_from))
+        self.zeroed += end - skip_from
+        if skip_from > start:
+            self._zero_range(start, skip_from)
+
+    def _zero_range(self, start, end):
+        if self._request is not None and not (start | end) % 512:
+            try:
+                offset = start
+                while offset < end:
+                    length = min(block.WIPE_IOCTL_RANGE_BYTES, end - offset)
+                    fcntl.ioctl(self._fd, self._request,
+                                struct.pack('QQ', offset, length))
+                    offset += length
+                self.zeroed += end - start
+                return
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY,
+                                   errno.EINVAL):
+                    raise
+                LOG.warning('Zeroing ranges of %s failed, writing zeroes '
+                            'instead: %s', self.devnode, e)
+                self._request = None
+        os.lseek(self._fd, start, os.SEEK_SET)
+        offset = start
+        while offset < end:
+            length = min(self.block_size, end - offset)
+            offset += os.write(self._fd, self._zeroes[:length])
+
+    def close(self):
+        """ Write what is buffered and flush it to the device. """
+        if self._fd is None:
+            return
+        try:
+            if self._buffer:
+                self._write_block(bytes(self._buffer))
+                self._buffer = bytearray()
+            self._flush_zeroes()
+            if self._is_file and os.fstat(self._fd).st_size < self.offset:
+                # zeroes skipped at the end still belong to the image
+                os.ftruncate(self._fd, self.offset)
+            os.fsync(self._fd)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        if etype is None:
+            self.close()
+        elif self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class _Progress(object):
+    """ Log the amount written and the write rate every interval seconds. """
+
+    def __init__(self, devnode, interval=PROGRESS_INTERVAL):
+        self.devnode = devnode
+        self.interval = interval
+        self.start = self._last = time.time()
+        self.written = 0
+
+    def update(self, count):
+        self.written += count
+        now = time.time()
+        if now - self._last >= self.interval:
+            self._last = now
+            LOG.info('Wrote %s MiB of image to %s (%.1f MB/s)',
+                     self.written // 2 ** 20, self.devnode, self.rate(now))
+
+    def rate(self, now=None):
+        elapsed = (now or time.time()) - self.start
+        return self.written / 1e6 / elapsed if elapsed > 0 else 0.0
+
+
+class _Target(object):
+    """ Write what is put to one device with a _BlockWriter in its own
+        thread, through a bounded queue.  A slow device only holds back the
+        others once its queue is full, and a device which fails stops taking
+        data without stopping the others. """
+
+    _END = object()
+
+    def __init__(self, devnode, block_size, zero_blocks,
+                 depth=IMAGE_QUEUE_DEPTH):
+        self.devnode = devnode
+        self.error = None
+        self.stats = None
+        self._block_size = block_size
+        self._zero_blocks = zero_blocks
+        self._queue = queue.Queue(maxsize=depth)
+        self._thread = threading.Thread(
+            target=self._run,
+            name='write-image-%s' % os.path.basename(devnode))
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def put(self, data):
+        """ Queue data to be written, returning False if the target failed.
+        """
+        while self.error is None:
+            try:
+                self._queue.put(data, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def finish(self, error=None):
+        """ Write and flush what was put, or give up on the image if error
+            is given, and wait for the writer thread. """
+        self.put(self._END if error is None else error)
+        self._thread.join()
+
+    def _run(self):
+        progress = _Progress(self.devnode)
+        try:
+            with _BlockWriter(self.devnode, self._block_size,
+                              zero_blocks=self._zero_blocks) as writer:
+                while True:
+                    data = self._queue.get()
+                    if data is self._END:
+                        break
+                    if isinstance(data, Exception):
+                        raise data
+                    writer.write(data)
+                    progress.update(len(data))
+            self.stats = {'bytes': progress.written,
+                          'zeroed': writer.zeroed,
+                          'skipped': writer.skipped,
+                          'seconds': time.time() - progress.start,
+                          'rate': progress.rate()}
+        except Exception as e:
+            self.error = e
+
+
+def write_image(source, devnode, block_size=IMAGE_BLOCK_SIZE,
+                stack_prefix='', mirrors=None):
+    """ Write the image of a dd- source to devnode.
+
+    The image is fetched, decompressed and written in their own threads.  If
+    source has a 'checksum' ('<algorithm>:<hex digest>') it is computed
+    over all of the fetched data, as published checksums are, even if the
+    image ends before it.  Its 'zero_blocks'
+    chooses how zeroes in the image are written, see _BlockWriter, and
+    defaults to 'punch'.  A raw image may have a bmaptool block map at the
+    url 'bmap', in which case only the blocks it maps are written.
+
+    qcow2 images are read out of order, with range requests for urls, so
+    that only their allocated clusters are read; they cannot have a
+    checksum.
+
+    The same image is written to each device in mirrors at the same time,
+    fetching and decompressing it once.  Each device is written in its own
+    thread.  A mirror which fails is reported and dropped while the others
+    are written; only a failure of devnode fails the write.
+
+    :param source: sanitized source dictionary with type and uri.
+    :param mirrors: list of further devices to write the image to.
+    :returns: dictionary with bytes of image written, of those the bytes of
+              zeroes which were not physically written and the bytes of
+              holes which were skipped, seconds taken and rate in MB/s.
+              With mirrors it has a 'mirrors' dictionary of such stats for
+              each mirror, or of {'error': message} for those which failed.
+    :raises: ValueError if the image is damaged or its checksum mismatches,
+             UrlError or IOError/OSError if it cannot be read or written.
+    """
+    compression, container = IMAGE_FORMATS[source['type']]
+    zero_blocks = source.get('zero_blocks', 'punch')
+    hasher, digest = _checksum(source)
+    mirrors = list(mirrors or [])
+    if devnode in mirrors:
+        raise ValueError('%s cannot be a mirror of itself' % devnode)
+    if source.get('bmap') and container:
+        raise ValueError('a bmap is only supported for raw images, not %s' %
+                         source['type'])
+    if container == 'qcow2':
+        if hasher:
+            raise ValueError('a checksum is not supported for dd-qcow2 '
+                             'images, which are not read in order')
+        stages = [_Stage('unpack-image', _qcow2(source['uri']))]
+    else:
+        fetched = _fetch(source['uri'])
+        if hasher:
+            fetched = _hashed(fetched, hasher)
+        stages = [_Stage('fetch-image', fetched)]
+        unpacked = stages[0]
+        if compression not in (None, 'auto'):
+            unpacked = _decompress(unpacked, compression)
+        if container == 'tar':
+            unpacked = _untar(unpacked, compression)
+        elif container == 'android-sparse':
+            unpacked = _android_sparse(unpacked)
+        if source.get('bmap'):
+            unpacked = _bmap_filter(unpacked, _read_bmap(source['bmap']))
+        if unpacked is not stages[0]:
+            stages.append(_Stage('unpack-image', unpacked))
+
+    description = "writing image %s to %s" % (
+        source['uri'], ', '.join([devnode] + mirrors))
+    with events.ReportEventStack(
+            name=stack_prefix, reporting_enabled=True, level="INFO",
+            description=description) as stack:
+        targets = [_Target(dev, block_size, zero_blocks)
+                   for dev in [devnode] + mirrors]
+        primary = targets[0]
+        error = None
+        try:
+            for target in targets:
+                target.start()
+            for stage in stages:
+                stage.start()
+            for data in stages[-1]:
+                for target in targets:
+                    target.put(data)
+                if primary.error is not None:
+                    break
+            if hasher and primary.error is None:
+                # the image can end before the fetched data does, as the
+                # first file of a tar archive does; the checksum is of all
+                # of it
+                stages[0].drain()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            for stage in stages:
+                stage.stop()
+            for target in targets:
+                target.finish(error or primary.error)
+            for stage in stages:
+                stage.join()
+        if primary.error is not None:
+            raise primary.error
+        if hasher and hasher.hexdigest() != digest:
+            raise ValueError('%s checksum of %s is %s, expected %s' %
+                             (hasher.name, source['uri'], hasher.hexdigest(),
+                              digest))
+        stats = primary.stats
+        messages = [_stats_message(devnode, stats)]
+        if mirrors:
+            stats['mirrors'] = {}
+            for target in targets[1:]:
+                if target.error is not None:
+                    LOG.error('Writing image %s to mirror %s failed: %s',
+                              source['uri'], target.devnode, target.error)
+                    stats['mirrors'][target.devnode] = {
+                        'error': str(target.error)}
+                    messages.append('writing %s failed: %s' %
+                                    (target.devnode, target.error))
+                    stack.result = events.status.WARN
+                else:
+                    stats['mirrors'][target.devnode] = target.stats
+                    messages.append(_stats_message(target.devnode,
+                                                   target.stats))
+        stack.message = '; '.join(messages)
+    LOG.info('Wrote image %s to %s: %s', source['uri'], devnode, stats)
+    return stats
+
+
+def _stats_message(devnode, stats):
+    return ('wrote %s bytes to %s in %.1fs (%.1f MB/s), %s bytes of zeroes '
+            'and %s bytes of holes without writing them' %
+            (stats['bytes'], devnode, stats['seconds'], stats['rate'],
+             stats['zeroed'], stats['skipped']))
+
+
+# vi: ts=4 expandtab syntax=python
@@ -81,7 +81,7 @@ def is_mpath_partition(devpath, info=None):
     if devpath.startswith('/dev/dm-'):
         if not info:
             info = udev.udevadm_info(devpath)
-        if 'DM_PART' in udev.udevadm_info(devpath):
+        if 'DM_PART' in info:
             result = True
 
     LOG.debug("%s is multipath device partition? %s", devpath, result)
@@ -189,8 +189,9 @@ def find_mpath_partitions(mpath_id):
 
 def get_mpath_id_from_device(device):
     # /dev/dm-X
-    if is_mpath_device(device) or is_mpath_partition(device):
-        info = udev.udevadm_info(device)
+    info = udev.udevadm_info(device)
+    if (is_mpath_device(device, info=info) or
+            is_mpath_partition(device, info=info)):
         return info.get('DM_NAME')
     # /dev/sdX
     if is_mpath_member(device):
@@ -0,0 +1,226 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+""" Read GPT and MBR partition tables in the format of 'sfdisk --json'. """
+
+import os
+import struct
+import uuid
+import zlib
+
+GPT_SIGNATURE = b'EFI PART'
+GPT_HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')
+GPT_ENTRY = struct.Struct('<16s16sQQQ72s')
+# names sfdisk gives to the gpt partition attribute bits
+GPT_ATTRIBUTES = {0: 'RequiredPartition', 1: 'NoBlockIOProtocol',
+                  2: 'LegacyBIOSBootable'}
+MBR_EXTENDED_TYPES = (0x05, 0x0f, 0x85)
+MBR_GPT_PROTECTIVE_TYPE = 0xee
+MBR_ENTRY = struct.Struct('<B3sB3sII')
+# logical partitions beyond this many are considered a loop in the chain
+MBR_MAX_LOGICAL = 256
+
+
+def _crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def _read(fp, offset, length):
+    fp.seek(offset)
+    data = fp.read(length)
+    if len(data) != length:
+        raise ValueError('short read of %s bytes at %s' % (length, offset))
+    return data
+
+
+def partition_node(disk, number):
+    """ Return the device node of partition number on disk, named as sfdisk
+        names it. """
+    if disk[-1:].isdigit():
+        return '%sp%s' % (disk, number)
+    return '%s%s' % (disk, number)
+
+
+def _gpt_header(fp, lba, sector_size):
+    data = _read(fp, lba * sector_size, sector_size)
+    fields = GPT_HEADER.unpack_from(data)
+    (signature, _revision, header_size, header_crc, _reserved, my_lba,
+     _alternate_lba, first_lba, last_lba, disk_guid, entries_lba,
+     num_entries, entry_size, entries_crc) = fields
+    if signature != GPT_SIGNATURE:
+        return None
+    if header_size < GPT_HEADER.size or header_size > sector_size:
+        raise ValueError('invalid gpt header size %s at lba %s' %
+                         (header_size, lba))
+    header = bytearray(data[:header_size])
+    header[16:20] = b'\0\0\0\0'
+    if _crc32(bytes(header)) != header_crc:
+        raise ValueError('gpt header checksum mismatch at lba %s' % lba)
+    if my_lba != lba or entry_size < GPT_ENTRY.size:
+        raise ValueError('invalid gpt header at lba %s' % lba)
+    entries = _read(fp, entries_lba * sector_size, num_entries * entry_size)
+    if _crc32(entries) != entries_crc:
+        raise ValueError('gpt partition entries checksum mismatch for '
+                         'header at lba %s' % lba)
+    return {'first_lba': first_lba, 'last_lba': last_lba,
+            'disk_guid': disk_guid, 'entries': entries,
+            'entry_size': entry_size}
+
+
+def _gpt_attrs(attributes):
+    names = [GPT_ATTRIBUTES[bit] for bit in sorted(GPT_ATTRIBUTES)
+             if attributes & (1 << bit)]
+    type_bits = [str(bit) for bit in range(48, 64) if attributes & (1 << bit)]
+    if type_bits:
+        names.append('GUID:' + ','.join(type_bits))
+    return ' '.join(names)
+
+
+def _has_protective_mbr(fp, sector_size):
+    mbr = _read(fp, 0, sector_size)
+    if mbr[0x1fe:0x200] != b'\x55\xaa':
+        return False
+    return any(ptype == MBR_GPT_PROTECTIVE_TYPE
+               for _boot, _chs, ptype, _chs_end, _start, _sectors
+               in _mbr_entries(mbr))
+
+
+def _read_gpt(fp, disk, size, sector_size):
+    """ Return the gpt partition table on fp, None if there is none.
+
+    The gpt headers are only looked at if the mbr is a protective or hybrid
+    one, so that gpt headers left over on a disk since partitioned with a
+    dos table are ignored.  The backup header at the end of the disk is used
+    if the primary header is damaged, as sfdisk does.
+
+    :raises: ValueError if neither header is valid.
+    """
+    if not _has_protective_mbr(fp, sector_size):
+        return None
+    error = None
+    header = None
+    for lba in (1, size // sector_size - 1):
+        try:
+            header = _gpt_header(fp, lba, sector_size)
+        except ValueError as e:
+            error = e
+            continue
+        if header:
+            break
+    if not header:
+        if error:
+            raise error
+        return None
+
+    partitions = []
+    entries = header['entries']
+    for index in range(len(entries) // header['entry_size']):
+        (type_guid, part_guid, first, last, attributes,
+         name) = GPT_ENTRY.unpack_from(entries, index * header['entry_size'])
+        if type_guid == b'\0' * 16:
+            continue
+        part = {
+            'node': partition_node(disk, index + 1),
+            'start': first,
+            'size': last - first + 1,
+            'type': str(uuid.UUID(bytes_le=type_guid)).upper(),
+            'uuid': str(uuid.UUID(bytes_le=part_guid)).upper(),
+        }
+        name = name.decode('utf-16-le', 'replace').split('\0', 1)[0]
+        if name:
+            part['name'] = name
+        attrs = _gpt_attrs(attributes)
+        if attrs:
+            part['attrs'] = attrs
+        partitions.append(part)
+
+    return {
+        'label': 'gpt',
+        'id': str(uuid.UUID(bytes_le=header['disk_guid'])).upper(),
+        'device': disk,
+        'unit': 'sectors',
+        'firstlba': header['first_lba'],
+        'lastlba': header['last_lba'],
+        'sectorsize': sector_size,
+        'partitions': partitions,
+    }
+
+
+def _mbr_entries(sector):
+    for slot in range(4):
+        yield MBR_ENTRY.unpack_from(sector, 0x1be + 16 * slot)
+
+
+def _mbr_partition(disk, number, boot, ptype, start, sectors):
+    part = {'node': partition_node(disk, number), 'start': start,
+            'size': sectors, 'type': '%x' % ptype}
+    if boot == 0x80:
+        part['bootable'] = True
+    return part
+
+
+def _read_mbr(fp, disk, sector_size):
+    """ Return the dos partition table on fp, None if there is none. """
+    mbr = _read(fp, 0, sector_size)
+    if mbr[0x1fe:0x200] != b'\x55\xaa':
+        return None
+    partitions = []
+    extended = None
+    for slot, (boot, _chs, ptype, _chs_end, start,
+               sectors) in enumerate(_mbr_entries(mbr)):
+        if ptype == 0 or sectors == 0:
+            continue
+        partitions.append(
+            _mbr_partition(disk, slot + 1, boot, ptype, start, sectors))
+        if ptype in MBR_EXTENDED_TYPES and extended is None:
+            extended = start
+
+    # logical partitions are in a chain of extended boot records, each
+    # with the logical partition relative to itself and a link to the next
+    # one relative to the start of the extended partition
+    ebr = extended
+    number = 5
+    while ebr is not None and number < 5 + MBR_MAX_LOGICAL:
+        sector = _read(fp, ebr * sector_size, sector_size)
+        if sector[0x1fe:0x200] != b'\x55\xaa':
+            break
+        entries = list(_mbr_entries(sector))
+        boot, _chs, ptype, _chs_end, start, sectors = entries[0]
+        if ptype != 0 and sectors != 0:
+            partitions.append(_mbr_partition(disk, number, boot, ptype,
+                                             ebr + start, sectors))
+            number += 1
+        _boot, _chs, ptype, _chs_end, start, _sectors = entries[1]
+        ebr = extended + start if ptype in MBR_EXTENDED_TYPES else None
+
+    return {
+        'label': 'dos',
+        'id': '0x%08x' % struct.unpack_from('<I', mbr, 0x1b8)[0],
+        'device': disk,
+        'unit': 'sectors',
+        'sectorsize': sector_size,
+        'partitions': partitions,
+    }
+
+
+def read_partition_table(disk, sector_size=512, path=None):
+    """ Read the gpt or dos partition table of disk.
+
+    :param disk: the disk device, used to name partition nodes.
+    :param sector_size: logical sector size of disk.
+    :param path: file to read the table from if not disk itself.
+    :returns: dictionary in the format of the 'partitiontable' member of
+              'sfdisk --json' output, or None if there is no partition table.
+    :raises: ValueError if the partition table is damaged, IOError/OSError
+             if it cannot be read.
+    """
+    with open(path or disk, 'rb') as fp:
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell()
+        # a gpt disk also has a protective mbr, so look for gpt first
+        table = _read_gpt(fp, disk, size, sector_size)
+        if table is None:
+            table = _read_mbr(fp, disk, sector_size)
+    return table
+
+
+# vi: ts=4 expandtab syntax=python
@@ -23,7 +23,8 @@ definitions = {
              'pattern': r'^([1-9]\d*(.\d+)?|\d+.\d+)(K|M|G|T)?B?'},
     'wipe': {
         'type': 'string',
-        'enum': ['random', 'superblock', 'superblock-recursive', 'zero'],
+        'enum': ['discard', 'fast-zero', 'random', 'superblock',
+                 'superblock-recursive', 'zero', 'zeroout'],
     },
     'uuid': {
         'type': 'string',
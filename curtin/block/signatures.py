@@ -0,0 +1,322 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+""" Recognise partition tables, raid, volume manager, encryption, cache and
+    filesystem metadata on a block device by reading its first and last
+    megabyte, without running blkid, mdadm, bcache-super-show or lsblk. """
+
+import struct
+import uuid
+
+from curtin.log import LOG
+
+# every signature recognised here lies within this many bytes of the start
+# or the end of the device
+HEAD_BYTES = 1024 * 1024
+TAIL_BYTES = 1024 * 1024
+
+MD_MAGIC = 0xa92b4efc
+BCACHE_MAGIC = (b'\xc6\x85\x73\xf6\x4e\x1a\x45\xca'
+                b'\x82\x65\xf5\x7f\x48\xba\x6d\x81')
+BCACHE_SB_OFFSET = 4096
+# bcache superblock versions of backing devices, the others are caches
+BCACHE_BACKING_VERSIONS = (1, 4, 6)
+BCACHE_CACHE_MODES = ['writethrough', 'writeback', 'writearound', 'none']
+ZFS_LABEL_SIZE = 256 * 1024
+ZFS_UBERBLOCK_MAGIC = 0x00bab10c
+SWAP_PAGE_SIZES = (4096, 8192, 16384, 65536)
+
+
+class _DeviceData(object):
+    """ The head and the tail of a device, read once. """
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            fp.seek(0, 2)
+            self.size = fp.tell()
+            fp.seek(0)
+            self.head = fp.read(min(self.size, HEAD_BYTES))
+            self.tail_start = max(len(self.head), self.size - TAIL_BYTES)
+            fp.seek(self.tail_start)
+            self.tail = fp.read(self.size - self.tail_start)
+
+    def at(self, offset, length):
+        """ Return length bytes at offset, or None if outside of what was
+            read. """
+        if offset < 0:
+            return None
+        if offset + length <= len(self.head):
+            return self.head[offset:offset + length]
+        if (offset >= self.tail_start and
+                offset + length <= self.tail_start + len(self.tail)):
+            start = offset - self.tail_start
+            return self.tail[start:start + length]
+        return None
+
+    def unpack(self, fmt, offset):
+        data = self.at(offset, struct.calcsize(fmt))
+        if data is None:
+            return None
+        return struct.unpack(fmt, data)[0]
+
+
+def _label(data):
+    label = data.split(b'\0', 1)[0].rstrip(b' ')
+    return label.decode('utf-8', 'replace')
+
+
+def _uuid(data):
+    if not data or data == b'\0' * len(data):
+        return None
+    return str(uuid.UUID(bytes=bytes(data)))
+
+
+def _signature(sig_type, usage, offset, **info):
+    sig = {'type': sig_type, 'usage': usage, 'offset': offset}
+    sig.update((key, value) for key, value in info.items()
+               if value not in (None, ''))
+    return sig
+
+
+def _find_gpt(dev, sector_sizes):
+    for sector_size in sector_sizes:
+        header = dev.at(sector_size, 92)
+        if header and header[:8] == b'EFI PART':
+            return [_signature(
+                'gpt', 'partition_table', sector_size,
+                uuid=str(uuid.UUID(bytes_le=bytes(header[56:72]))),
+                sector_size=sector_size)]
+    return []
+
+
+def _find_dos(dev):
+    if dev.at(0x1fe, 2) != b'\x55\xaa':
+        return []
+    disk_id = dev.unpack('<I', 0x1b8)
+    return [_signature('dos', 'partition_table', 0x1fe,
+                       uuid='%08x' % disk_id if disk_id else None)]
+
+
+def _md_uuid(data):
+    return ':'.join('%08x' % word for word in struct.unpack('>4I', data))
+
+
+def _find_md(dev):
+    found = []
+    # metadata 0.90 is 64KiB from the end, at a 64KiB boundary, in host
+    # byte order
+    offset = (dev.size & ~0xffff) - 0x10000
+    for order in '<>':
+        if dev.unpack(order + 'I', offset) == MD_MAGIC:
+            if dev.unpack(order + 'I', offset + 4) != 0:
+                continue
+            words = [dev.unpack(order + 'I', offset + word)
+                     for word in (20, 52, 56, 60)]
+            found.append(_signature(
+                'linux_raid_member', 'raid', offset, version='0.90.0',
+                uuid=_md_uuid(struct.pack('>4I', *words))))
+            break
+    # metadata 1.0 is at least 8KiB from the end, 1.1 at the start and 1.2
+    # 4KiB from the start, always little endian
+    for version, offset in (
+            ('1.0', ((dev.size >> 9) - 16 & ~7) << 9),
+            ('1.1', 0), ('1.2', 4096)):
+        if (dev.unpack('<I', offset) == MD_MAGIC and
+                dev.unpack('<I', offset + 4) == 1):
+            found.append(_signature(
+                'linux_raid_member', 'raid', offset, version=version,
+                uuid=_md_uuid(dev.at(offset + 16, 16)),
+                label=_label(dev.at(offset + 32, 32))))
+    return found
+
+
+def _lvm_uuid(data):
+    text = data.decode('ascii', 'replace')
+    parts = []
+    for length in (6, 4, 4, 4, 4, 4, 6):
+        parts.append(text[:length])
+        text = text[length:]
+    return '-'.join(parts)
+
+
+def _find_lvm(dev):
+    # the label may be in any of the first four sectors
+    for offset in range(0, 2048, 512):
+        label = dev.at(offset, 64)
+        if label and label[:8] == b'LABELONE' and label[24:32] == b'LVM2 001':
+            return [_signature('LVM2_member', 'raid', offset,
+                               version='LVM2 001',
+                               uuid=_lvm_uuid(label[32:64]))]
+    return []
+
+
+def _find_luks(dev):
+    if dev.at(0, 6) != b'LUKS\xba\xbe':
+        return []
+    version = dev.unpack('>H', 6)
+    label = _label(dev.at(24, 48)) if version == 2 else None
+    return [_signature('crypto_LUKS', 'crypto', 0, version=str(version),
+                       uuid=_label(dev.at(168, 40)), label=label)]
+
+
+def _find_bcache(dev):
+    offset = BCACHE_SB_OFFSET
+    if dev.at(offset + 24, 16) != BCACHE_MAGIC:
+        return []
+    version = dev.unpack('<Q', offset + 16)
+    backing = version in BCACHE_BACKING_VERSIONS
+    sig = _signature('bcache', 'other', offset, version=version,
+                     role='backing' if backing else 'caching',
+                     uuid=_uuid(dev.at(offset + 40, 16)),
+                     set_uuid=_uuid(dev.at(offset + 56, 16)),
+                     label=_label(dev.at(offset + 72, 32)))
+    if backing:
+        mode = dev.unpack('<Q', offset + 104) & 0xf
+        if mode < len(BCACHE_CACHE_MODES):
+            sig['cache_mode'] = BCACHE_CACHE_MODES[mode]
+    return [sig]
+
+
+def _find_zfs(dev):
+    # four labels, two at the start and two at the end of the device, each
+    # with an array of uberblocks in its second half
+    end = dev.size & ~(ZFS_LABEL_SIZE - 1)
+    for label in (0, ZFS_LABEL_SIZE, end - 2 * ZFS_LABEL_SIZE,
+                  end - ZFS_LABEL_SIZE):
+        for slot in range(label + ZFS_LABEL_SIZE // 2, label + ZFS_LABEL_SIZE,
+                          1024):
+            if ZFS_UBERBLOCK_MAGIC in (dev.unpack('<Q', slot),
+                                       dev.unpack('>Q', slot)):
+                return [_signature('zfs_member', 'filesystem', label)]
+    return []
+
+
+def _find_ext(dev):
+    offset = 1024
+    if dev.at(offset + 56, 2) != b'\x53\xef':
+        return []
+    compat = dev.unpack('<I', offset + 92)
+    incompat = dev.unpack('<I', offset + 96)
+    if incompat & 0x2c0:
+        # extents, 64bit or flex_bg
+        fstype = 'ext4'
+    elif compat & 0x4:
+        # has_journal
+        fstype = 'ext3'
+    else:
+        fstype = 'ext2'
+    return [_signature(fstype, 'filesystem', offset,
+                       uuid=_uuid(dev.at(offset + 104, 16)),
+                       label=_label(dev.at(offset + 120, 16)))]
+
+
+def _find_xfs(dev):
+    if dev.at(0, 4) != b'XFSB':
+        return []
+    return [_signature('xfs', 'filesystem', 0, uuid=_uuid(dev.at(32, 16)),
+                       label=_label(dev.at(108, 12)))]
+
+
+def _find_btrfs(dev):
+    offset = 0x10000
+    if dev.at(offset + 0x40, 8) != b'_BHRfS_M':
+        return []
+    return [_signature('btrfs', 'filesystem', offset,
+                       uuid=_uuid(dev.at(offset + 0x20, 16)),
+                       label=_label(dev.at(offset + 0x12b, 256)))]
+
+
+def _find_vfat(dev):
+    if dev.at(0x1fe, 2) != b'\x55\xaa':
+        return []
+    if dev.at(0x52, 5) == b'FAT32':
+        serial, label = 0x43, 0x47
+    elif dev.at(0x36, 5) in (b'FAT12', b'FAT16'):
+        serial, label = 0x27, 0x2b
+    else:
+        return []
+    volume_id = dev.unpack('<I', serial)
+    label = _label(dev.at(label, 11))
+    return [_signature('vfat', 'filesystem', 0,
+                       uuid='%04X-%04X' % (volume_id >> 16,
+                                           volume_id & 0xffff),
+                       label=label if label != 'NO NAME' else None)]
+
+
+def _find_ntfs(dev):
+    if dev.at(3, 8) != b'NTFS    ':
+        return []
+    return [_signature('ntfs', 'filesystem', 0,
+                       uuid='%016X' % dev.unpack('<Q', 0x48))]
+
+
+def _find_swap(dev):
+    for page_size in SWAP_PAGE_SIZES:
+        if dev.at(page_size - 10, 10) in (b'SWAPSPACE2', b'SWAP-SPACE'):
+            return [_signature('swap', 'other', page_size - 10,
+                               uuid=_uuid(dev.at(1024 + 12, 16)),
+                               label=_label(dev.at(1024 + 28, 16)))]
+    return []
+
+
+def _find_iso9660(dev):
+    if dev.at(0x8001, 5) != b'CD001':
+        return []
+    return [_signature('iso9660', 'filesystem', 0x8001,
+                       label=_label(dev.at(0x8028, 32)))]
+
+
+def _find_f2fs(dev):
+    if dev.unpack('<I', 1024) != 0xf2f52010:
+        return []
+    return [_signature('f2fs', 'filesystem', 1024,
+                       uuid=_uuid(dev.at(1024 + 0x6c, 16)))]
+
+
+def scan_signatures(path, sector_size=None):
+    """ Look for metadata signatures on path (a block device or an image),
+        reading its first and last megabyte once.
+
+    :param sector_size: logical sector size of the device, used to find the
+                        GPT header.  Both 512 and 4096 are tried if None.
+    :returns: dictionary with keys:
+              device: path
+              size: size in bytes
+              ptable: 'gpt', 'dos' or None, as get_part_table_type
+              signatures: list of dictionaries, ordered by offset, each with
+                          type (blkid TYPE or PTTYPE), usage, offset in bytes
+                          and, where present, uuid, label and version.
+                          bcache signatures also have role, set_uuid and
+                          for backing devices cache_mode.
+    :raises: IOError/OSError if path cannot be read.
+    """
+    dev = _DeviceData(path)
+    sector_sizes = (sector_size,) if sector_size else (512, 4096)
+    gpt = _find_gpt(dev, sector_sizes)
+    dos = _find_dos(dev)
+    filesystems = (_find_vfat(dev) + _find_ntfs(dev))
+    signatures = (gpt + (dos if not filesystems else []) + filesystems +
+                  _find_md(dev) + _find_lvm(dev) + _find_luks(dev) +
+                  _find_bcache(dev) + _find_zfs(dev) + _find_ext(dev) +
+                  _find_xfs(dev) + _find_btrfs(dev) + _find_swap(dev) +
+                  _find_iso9660(dev) + _find_f2fs(dev))
+    signatures.sort(key=lambda sig: sig['offset'])
+    ptable = None
+    if gpt:
+        ptable = 'gpt'
+    elif dos:
+        ptable = 'dos'
+    LOG.debug('Found signatures on %s: %s', path,
+              [sig['type'] for sig in signatures])
+    return {'device': path, 'size': dev.size, 'ptable': ptable,
+            'signatures': signatures}
+
+
+def find_signature(scan, sig_type):
+    """ Return the first signature of type sig_type in the result of
+        scan_signatures, or None. """
+    for sig in scan['signatures']:
+        if sig['type'] == sig_type:
+            return sig
+    return None
+
+
+# vi: ts=4 expandtab syntax=python
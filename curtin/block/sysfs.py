@@ -0,0 +1,117 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+""" Reads of sysfs attributes and device path resolution, memoised while a
+    SysfsCache is active in the calling thread. """
+
+from contextlib import contextmanager
+import os
+import threading
+
+from curtin import udev
+from curtin import util
+
+_local = threading.local()
+
+# incremented by invalidate(), so that the caches of every thread forget
+# what they read
+_GENERATION = [0]
+
+
+def _generation():
+    return (udev.settle_generation(), _GENERATION[0])
+
+
+class SysfsCache(object):
+    """ Contents of sysfs files and resolved paths read during one step of
+        block-meta.  Everything is forgotten when udev settles, which
+        follows the commands that change block devices, on invalidate() or
+        on clear().
+    """
+
+    def __init__(self):
+        self._files = {}
+        self._realpaths = {}
+        self._generation = _generation()
+
+    def clear(self):
+        self._files.clear()
+        self._realpaths.clear()
+        self._generation = _generation()
+
+    def _check_generation(self):
+        if self._generation != _generation():
+            self.clear()
+
+    def load_file(self, path):
+        self._check_generation()
+        if path not in self._files:
+            # errors are not kept, the file may appear later
+            self._files[path] = util.load_file(path)
+        return self._files[path]
+
+    def realpath(self, path):
+        self._check_generation()
+        if path not in self._realpaths:
+            self._realpaths[path] = os.path.realpath(path)
+        return self._realpaths[path]
+
+
+def current():
+    """ Return the SysfsCache active in this thread, or None. """
+    return getattr(_local, 'cache', None)
+
+
+@contextmanager
+def cached():
+    """ Memoise sysfs reads in this thread for the duration of the block,
+        nested blocks sharing the outermost cache. """
+    if current() is not None:
+        yield current()
+        return
+    _local.cache = SysfsCache()
+    try:
+        yield _local.cache
+    finally:
+        _local.cache = None
+
+
+def invalidate():
+    """ Forget what the active caches of all threads read.  For use after
+        changing block devices without waiting for udev. """
+    _GENERATION[0] += 1
+
+
+def load_file(path):
+    """ util.load_file of path, through the active cache if any. """
+    cache = current()
+    if cache is None:
+        return util.load_file(path)
+    return cache.load_file(path)
+
+
+def realpath(path):
+    """ os.path.realpath of path, through the active cache if any. """
+    cache = current()
+    if cache is None:
+        return os.path.realpath(path)
+    return cache.realpath(path)
+
+
+def read_attrs(sysfs_path, attrs, default=None):
+    """ Read several attributes of the sysfs directory sysfs_path at once.
+
+    :param attrs: names of files below sysfs_path, e.g. 'size' or
+                  'queue/logical_block_size'
+    :returns: dictionary of attribute name to its stripped content, or to
+              default for attributes which cannot be read
+    """
+    values = {}
+    for attr in attrs:
+        try:
+            values[attr] = load_file(os.path.join(sysfs_path, attr)).strip()
+        except (IOError, OSError):
+            values[attr] = default
+    return values
+
+
+# vi: ts=4 expandtab syntax=python
@@ -0,0 +1,244 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+""" Snapshot of the block device topology read from sysfs and the udev
+    database, without running lsblk, blkid or udevadm for each device. """
+
+import os
+import time
+
+from curtin import util
+from curtin.log import LOG
+from curtin.udev import UDEV_DATA_DIR
+from . import path_to_kname
+
+SYS_CLASS_BLOCK = '/sys/class/block'
+
+# udev database properties matching the tags reported by blkid
+UDEV_BLKID_KEYS = {
+    'ID_FS_TYPE': 'TYPE',
+    'ID_FS_UUID': 'UUID',
+    'ID_FS_LABEL': 'LABEL',
+    'ID_PART_TABLE_TYPE': 'PTTYPE',
+    'ID_PART_TABLE_UUID': 'PTUUID',
+    'ID_PART_ENTRY_UUID': 'PARTUUID',
+}
+
+
+def _read_sysfs(path, default=None):
+    try:
+        return util.load_file(path).strip()
+    except (IOError, OSError):
+        return default
+
+
+def _read_sysfs_int(path, default=None):
+    value = _read_sysfs(path)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+def _listdir(path):
+    try:
+        return sorted(os.listdir(path))
+    except OSError:
+        return []
+
+
+def read_udev_data(path):
+    """ Parse a udev database file (/run/udev/data/b<major>:<minor>).
+
+    :returns: tuple of (list of /dev symlinks, dict of udev properties)
+    """
+    links = []
+    properties = {}
+    try:
+        content = util.load_file(path)
+    except (IOError, OSError):
+        return links, properties
+    for line in content.splitlines():
+        if line.startswith('S:'):
+            links.append(os.path.join('/dev', line[2:]))
+        elif line.startswith('E:') and '=' in line:
+            key, value = line[2:].split('=', 1)
+            properties[key] = value
+    return links, properties
+
+
+class BlockTopology(object):
+    """ Block devices known to the kernel, read in one walk of
+        /sys/class/block and the matching /run/udev/data entries.
+
+        Device entries are dictionaries keyed by kname with the keys:
+        kname, devpath, majmin, devtype, size (bytes),
+        logical_sector_size, physical_sector_size, removable, ro,
+        partition (number or None), start (sectors or None), parent,
+        partitions, holders, slaves, links and properties (udev).
+
+        The snapshot is taken on first use.  After changing devices, call
+        invalidate() to drop it (or the entry of one device) and have it
+        read again when next used, or refresh() to read it again now.
+    """
+    def __init__(self, sysfs_dir=SYS_CLASS_BLOCK, udev_data_dir=UDEV_DATA_DIR):
+        self.sysfs_dir = sysfs_dir
+        self.udev_data_dir = udev_data_dir
+        self._devices = None
+        self._stale = set()
+
+    def refresh(self):
+        """ Read the topology of all block devices. """
+        start = time.time()
+        devices = {}
+        for kname in _listdir(self.sysfs_dir):
+            device = self._read_device(kname)
+            if device:
+                devices[kname] = device
+        self._devices = devices
+        self._stale = set()
+        LOG.debug('Read block topology of %s devices in %.3f seconds',
+                  len(devices), time.time() - start)
+        return self
+
+    def invalidate(self, device=None):
+        """ Drop the snapshot, or only the entry of device, so it is read
+            again on next use. """
+        if device is None:
+            self._devices = None
+            self._stale = set()
+        else:
+            self._stale.add(self._kname(device))
+
+    @property
+    def devices(self):
+        if self._devices is None:
+            self.refresh()
+        while self._stale:
+            kname = self._stale.pop()
+            device = self._read_device(kname)
+            if device:
+                self._devices[kname] = device
+            else:
+                self._devices.pop(kname, None)
+        return self._devices
+
+    def _kname(self, device):
+        if device.startswith(self.sysfs_dir + os.path.sep):
+            return os.path.basename(os.path.normpath(device))
+        return path_to_kname(device)
+
+    def _read_device(self, kname):
+        syspath = os.path.join(self.sysfs_dir, kname)
+        majmin = _read_sysfs(os.path.join(syspath, 'dev'))
+        if majmin is None:
+            return None
+
+        uevent = {}
+        for line in (_read_sysfs(os.path.join(syspath, 'uevent')) or
+                     '').splitlines():
+            if '=' in line:
+                key, value = line.split('=', 1)
+                uevent[key] = value
+
+        partition = _read_sysfs_int(os.path.join(syspath, 'partition'))
+        parent = None
+        queue_path = syspath
+        if partition is not None:
+            parent = os.path.basename(
+                os.path.dirname(os.path.realpath(syspath)))
+            queue_path = os.path.join(self.sysfs_dir, parent)
+
+        links, properties = read_udev_data(
+            os.path.join(self.udev_data_dir, 'b' + majmin))
+
+        return {
+            'kname': kname,
+            'devpath': '/dev/' + kname.replace('!', '/'),
+            'majmin': majmin,
+            'devtype': uevent.get('DEVTYPE'),
+            'size': (_read_sysfs_int(os.path.join(syspath, 'size'), 0) *
+                     512),
+            'logical_sector_size': _read_sysfs_int(
+                os.path.join(queue_path, 'queue/logical_block_size')),
+            'physical_sector_size': _read_sysfs_int(
+                os.path.join(queue_path, 'queue/physical_block_size')),
+            'removable': _read_sysfs_int(
+                os.path.join(queue_path, 'removable'), 0) == 1,
+            'ro': _read_sysfs_int(os.path.join(syspath, 'ro'), 0) == 1,
+            'partition': partition,
+            'start': _read_sysfs_int(os.path.join(syspath, 'start')),
+            'parent': parent,
+            'partitions': [
+                child for child in _listdir(syspath)
+                if os.path.exists(os.path.join(syspath, child, 'partition'))],
+            'holders': _listdir(os.path.join(syspath, 'holders')),
+            'slaves': _listdir(os.path.join(syspath, 'slaves')),
+            'links': links,
+            'properties': properties,
+        }
+
+    def __contains__(self, device):
+        return self._kname(device) in self.devices
+
+    def knames(self):
+        return sorted(self.devices.keys())
+
+    def get(self, device):
+        """ Return the entry of device (a kname, /dev or /sys path).
+
+        :raises: KeyError if device is not a block device in the snapshot.
+        """
+        kname = self._kname(device)
+        try:
+            return self.devices[kname]
+        except KeyError:
+            raise KeyError('block device %s (kname=%s) not found in '
+                           'topology' % (device, kname))
+
+    def partitions(self, device):
+        return list(self.get(device)['partitions'])
+
+    def holders(self, device):
+        return list(self.get(device)['holders'])
+
+    def slaves(self, device):
+        return list(self.get(device)['slaves'])
+
+    def links(self, device):
+        return list(self.get(device)['links'])
+
+    def signatures(self, device):
+        """ Return the filesystem and partition table identifiers udev
+            recorded for device, using the blkid tag names (TYPE, UUID,
+            LABEL, PTTYPE, PTUUID, PARTUUID). """
+        properties = self.get(device)['properties']
+        return dict((tag, properties[key])
+                    for key, tag in UDEV_BLKID_KEYS.items()
+                    if properties.get(key))
+
+    def descendants(self, device):
+        """ Return the knames of the partitions of device and of everything
+            holding device or its partitions, recursively. """
+        found = []
+        pending = [self._kname(device)]
+        while pending:
+            entry = self.devices.get(pending.pop(0))
+            if not entry:
+                continue
+            for kname in entry['partitions'] + entry['holders']:
+                if kname not in found:
+                    found.append(kname)
+                    pending.append(kname)
+        return found
+
+    def find_by_link(self, link):
+        """ Return the kname of the device with the /dev symlink link. """
+        for kname, entry in self.devices.items():
+            if link in entry['links']:
+                return kname
+        return None
+
+
+# vi: ts=4 expandtab syntax=python
@@ -4,17 +4,20 @@ from collections import OrderedDict, namedtuple
 from curtin import (block, config, paths, util)
 from curtin.block import schemas
 from curtin.block import (bcache, clear_holders, dasd, iscsi, lvm, mdadm, mkfs,
-                          multipath, zfs)
+                          multipath, sysfs, zfs)
+from curtin.block import image as block_image
 from curtin import distro
 from curtin.log import LOG, logged_time
 from curtin.reporter import events
 from curtin.storage_config import (extract_storage_ordered_dict,
+                                   get_direct_dependencies,
                                    ptable_uuid_to_flag_entry)
 
 
 from . import populate_one_subcmd
 from curtin.udev import (compose_udev_equality, udevadm_settle,
-                         udevadm_trigger, udevadm_info)
+                         udevadm_trigger, udevadm_info, wait_for_device,
+                         UdevDatabase)
 
 import glob
 import os
@@ -22,6 +25,7 @@ import platform
 import string
 import sys
 import tempfile
+import threading
 import time
 
 FstabData = namedtuple(
@@ -97,9 +101,13 @@ def block_meta(args):
             devices = cfg.get('block-meta', {}).get('devices', [])
         LOG.debug('Declared block devices: %s', devices)
         args.devices = devices
+    if dd_images:
+        devices = devices + [mirror for mirror in get_image_mirrors(cfg)
+                             if mirror not in devices]
 
     LOG.debug('clearing devices=%s', devices)
-    meta_clear(devices, state.get('report_stack_prefix', ''))
+    meta_clear(devices, state.get('report_stack_prefix', ''),
+               max_workers=get_clear_holders_workers(cfg))
 
     # dd-images requires use of meta_simple
     if len(dd_images) > 0 and args.force_mode is False:
@@ -124,9 +132,9 @@ def logtime(msg, func, *args, **kwargs):
         return func(*args, **kwargs)
 
 
-def write_image_to_disk(source, dev):
+def write_image_to_disk(source, dev, mirrors=None):
     """
-    Write disk image to block device
+    Write disk image to block device, and to the block devices in mirrors
     """
     LOG.info('writing image to disk %s, %s', source, dev)
     extractor = {
@@ -137,14 +145,43 @@ def write_image_to_disk(source, dev):
         'dd-bz2': '|bzcat',
         'dd-gz': '|zcat',
         'dd-xz': '|xzcat',
+        'dd-zst': '|zstdcat',
         'dd-raw': ''
     }
     (devname, devnode) = block.get_dev_name_entry(dev)
-    util.subp(args=['sh', '-c',
-                    ('wget "$1" --progress=dot:mega -O - ' +
-                     extractor[source['type']] + '| dd bs=4M of="$2"'),
-                    '--', source['uri'], devnode])
+    mirror_nodes = [block.get_dev_name_entry(mirror)[1]
+                    for mirror in mirrors or []]
+    if block_image.supported(source['type']):
+        state = util.load_command_environment()
+        stats = block_image.write_image(
+            source, devnode, mirrors=mirror_nodes,
+            stack_prefix=state.get('report_stack_prefix') or '')
+        # mirrors which failed were reported and are left alone
+        mirror_nodes = [node for node in mirror_nodes
+                        if 'error' not in stats['mirrors'][node]]
+    elif mirror_nodes:
+        raise ValueError('image mirrors are not supported for %s images '
+                         'here' % source['type'])
+    elif source.get('bmap') or source.get('checksum'):
+        # the image could not be verified against them
+        raise ValueError('bmap and checksum are not supported for %s '
+                         'images here' % source['type'])
+    else:
+        if source.get('zero_blocks'):
+            LOG.warning('zero_blocks is not supported for %s images here, '
+                        'writing every block of the image', source['type'])
+        # the python running curtin cannot decompress this image
+        util.subp(args=['sh', '-c',
+                        ('wget "$1" --progress=dot:mega -O - ' +
+                         extractor[source['type']] + '| dd bs=4M of="$2"'),
+                        '--', source['uri'], devnode])
     util.subp(['partprobe', devnode])
+    for node in mirror_nodes:
+        try:
+            util.subp(['partprobe', node])
+        except util.ProcessExecutionError as e:
+            LOG.warning('Failed to re-read the partition table of image '
+                        'mirror %s: %s', node, e)
     udevadm_settle()
     # Images from MAAS have well-known/required paths present
     # on the rootfs partition.  Use these values to select the
@@ -213,10 +250,84 @@ def devsync(devpath):
     raise OSError('Failed to find device at path: %s', devpath)
 
 
+class PartitionIndex(object):
+    """ Per-disk index of the partitions in a storage config, built in one
+        pass so that partition numbering and neighbour lookups do not rescan
+        the whole config for every partition.  The answers are the same as
+        those of the scans in determine_partition_number,
+        find_previous_partition, find_extended_partition and
+        getnumberoflogicaldisks.
+    """
+    def __init__(self, storage_config):
+        self.storage_config = storage_config
+        self._default_numbers = {}
+        self._previous = {}
+        self._last = {}
+        self._extended = {}
+        self._logical_count = {}
+        partition_count = {}
+        logical_partition_count = {}
+        for item_id, item in storage_config.items():
+            device = item.get('device')
+            flag = item.get('flag')
+            if device and flag == "logical":
+                self._logical_count[device] = (
+                    self._logical_count.get(device, 0) + 1)
+            if item.get('type') != 'partition':
+                continue
+            partition_count[device] = partition_count.get(device, 0) + 1
+            if flag == "logical":
+                logical_partition_count[device] = (
+                    logical_partition_count.get(device, 0) + 1)
+                self._default_numbers[item_id] = (
+                    4 + logical_partition_count[device])
+            else:
+                self._default_numbers[item_id] = partition_count[device]
+            self._previous[item_id] = self._last.get(device)
+            if flag == "extended":
+                self._extended.setdefault(device, item_id)
+            else:
+                self._last[device] = item_id
+
+    def __contains__(self, partition_id):
+        return partition_id in self._default_numbers
+
+    def default_number(self, partition_id):
+        return self._default_numbers[partition_id]
+
+    def previous_partition(self, disk_id, part_id):
+        if part_id in self._previous:
+            return self._previous[part_id]
+        return self._last.get(disk_id)
+
+    def extended_partition(self, disk_id):
+        return self._extended.get(disk_id)
+
+    def logical_count(self, disk_id):
+        return self._logical_count.get(disk_id, 0)
+
+
+# set by meta_custom for the storage config it handles
+_PARTITION_INDEX = None
+
+
+def get_partition_index(storage_config):
+    """ Return the PartitionIndex of storage_config if one was built. """
+    index = _PARTITION_INDEX
+    if index is not None and index.storage_config is storage_config:
+        return index
+    return None
+
+
 def determine_partition_number(partition_id, storage_config):
     vol = storage_config.get(partition_id)
     partnumber = vol.get('number')
-    if vol.get('flag') == "logical":
+    index = get_partition_index(storage_config)
+    if not partnumber and index is not None and partition_id in index:
+        LOG.warn('partition \'number\' key not set in config:\n%s',
+                 util.json_dumps(vol))
+        partnumber = index.default_number(partition_id)
+    elif vol.get('flag') == "logical":
         if not partnumber:
             LOG.warn('partition \'number\' key not set in config:\n%s',
                      util.json_dumps(vol))
@@ -256,6 +367,19 @@ def sanitize_dname(dname):
     return ''.join(c if c in valid else '-' for c in dname)
 
 
+# set by meta_custom to a UdevDatabase for the run
+_UDEV_DB = None
+
+
+def get_udev_info(path):
+    """ Return udevadm_info of path, from the UdevDatabase of this
+        meta_custom run if there is one. """
+    db = _UDEV_DB
+    if db is None:
+        return udevadm_info(path=path)
+    return db.get(path)
+
+
 def make_dname_byid(path, error_msg=None, info=None):
     """ Returns a list of udev equalities for a given disk path
 
@@ -269,7 +393,7 @@ def make_dname_byid(path, error_msg=None, info=None):
     """
     error_msg = str(path) + ("" if not error_msg else " [%s]" % error_msg)
     if info is None:
-        info = udevadm_info(path=path)
+        info = get_udev_info(path)
     devtype = info.get('DEVTYPE')
     if devtype != "disk":
         raise ValueError(
@@ -347,7 +471,7 @@ def make_dname(volume, storage_config):
         matches += [[compose_udev_equality("ENV{CACHED_UUID}", bdev_uuid)]]
         bcache.write_label(sanitize_dname(dname), backing_dev)
     elif vol.get('type') == "lvm_partition":
-        info = udevadm_info(path=path)
+        info = get_udev_info(path)
         dname = info['DM_NAME']
         matches += [[compose_udev_equality("ENV{DM_NAME}", dname)]]
     else:
@@ -414,11 +538,68 @@ def get_poolname(info, storage_config):
     return poolname
 
 
+class VolumePathCache(object):
+    """ Cache of get_path_to_storage_volume results for one block-meta run,
+        keyed by storage config id.
+
+        Entries are dropped with invalidate() when the handler of an item is
+        about to create or destroy its device; this also drops every entry
+        whose path was resolved through that item, e.g. the partitions of a
+        disk.  Hits are only returned while the device path exists, and
+        unless devsync_hits is set, without running devsync again.
+    """
+    def __init__(self, devsync_hits=False):
+        self.devsync_hits = devsync_hits
+        self._paths = {}
+        self._parents = {}
+        self._lock = threading.Lock()
+
+    def get(self, volume):
+        with self._lock:
+            return self._paths.get(volume)
+
+    def add(self, volume, path, parents=None):
+        with self._lock:
+            self._paths[volume] = path
+            self._parents[volume] = set(parents or [])
+
+    def invalidate(self, volume):
+        with self._lock:
+            stale = set([volume])
+            found = True
+            while found:
+                found = False
+                for child, parents in self._parents.items():
+                    if child not in stale and parents & stale:
+                        stale.add(child)
+                        found = True
+            for item_id in stale:
+                self._paths.pop(item_id, None)
+                self._parents.pop(item_id, None)
+
+
+# set by meta_custom when block-meta: {cache-volume-paths: true}
+_VOLUME_PATH_CACHE = None
+
+
 def get_path_to_storage_volume(volume, storage_config):
     # Get path to block device for volume. Volume param should refer to id of
     # volume in storage config
 
+    cache = _VOLUME_PATH_CACHE
+    if cache is not None:
+        volume_path = cache.get(volume)
+        if volume_path and os.path.exists(volume_path):
+            LOG.debug('get_path_to_storage_volume for volume %s: cached %s',
+                      volume, volume_path)
+            if cache.devsync_hits:
+                devsync(volume_path)
+            return volume_path
+        elif volume_path:
+            cache.invalidate(volume)
+
     devsync_vol = None
+    parents = []
     vol = storage_config.get(volume)
     LOG.debug('get_path_to_storage_volume for volume %s(%s)', volume, vol)
     if not vol:
@@ -426,6 +607,7 @@ def get_path_to_storage_volume(volume, storage_config):
 
     # Find path to block device
     if vol.get('type') == "partition":
+        parents.append(vol.get('device'))
         partnumber = determine_partition_number(vol.get('id'), storage_config)
         disk_block_path = get_path_to_storage_volume(vol.get('device'),
                                                      storage_config)
@@ -481,6 +663,7 @@ def get_path_to_storage_volume(volume, storage_config):
         # name of the volgroup the partition belongs to. We can simply append
         # the id of the lvm partition to the path of that directory
         volgroup = storage_config.get(vol.get('volgroup'))
+        parents.append(vol.get('volgroup'))
         if not volgroup:
             raise ValueError("lvm volume group '%s' could not be found"
                              % vol.get('volgroup'))
@@ -506,6 +689,7 @@ def get_path_to_storage_volume(volume, storage_config):
         # block devs are in the slaves dir there. Then, those blockdevs can be
         # checked against the kname of the devs in the config for the desired
         # bcache device. This is not very elegant though
+        parents.append(vol.get('backing_device'))
         backing_device_path = get_path_to_storage_volume(
             vol.get('backing_device'), storage_config)
         backing_device_kname = block.path_to_kname(backing_device_path)
@@ -526,6 +710,9 @@ def get_path_to_storage_volume(volume, storage_config):
         devsync_vol = volume_path
     devsync(devsync_vol)
 
+    if cache is not None:
+        cache.add(volume, volume_path, parents)
+
     LOG.debug('return volume path %s', volume_path)
     return volume_path
 
@@ -575,6 +762,49 @@ def dasd_handler(info, storage_config):
                 "Dasd %s failed to format" % dasd_device.devname)
 
 
+# ids of disks wiped by prewipe_disks before the disk handlers run
+_PREWIPED_DISKS = set()
+
+
+def get_wipe_settings(cfg):
+    """Return a tuple of (workers, bandwidth) for wiping disks concurrently,
+       as set by block-meta: {wipe-workers: N, wipe-bandwidth: SIZE} in cfg,
+       where SIZE is the combined bytes per second to write, e.g. 500M.
+    """
+    bmcfg = cfg.get('block-meta', {})
+    value = bmcfg.get('wipe-workers', 1)
+    try:
+        workers = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(
+            "block-meta 'wipe-workers' must be an integer, got: %s" % value)
+    bandwidth = bmcfg.get('wipe-bandwidth')
+    if bandwidth:
+        bandwidth = util.human2bytes(bandwidth)
+    return (max(workers, 1), bandwidth or None)
+
+
+def prewipe_disks(storage_config, workers, bandwidth=None):
+    """Wipe every disk in storage_config with a wipe setting, up to workers
+       disks at a time, and record them in _PREWIPED_DISKS so disk_handler
+       does not wipe them again.  Disks on a dasd are left to disk_handler,
+       as the dasd may need formatting first.
+    """
+    dasds = set(item.get('device_id') for item in storage_config.values()
+                if item.get('type') == 'dasd')
+    disks = [item for item in storage_config.values()
+             if item.get('type') == 'disk' and
+             config.value_as_boolean(item.get('wipe')) and
+             not config.value_as_boolean(item.get('preserve')) and
+             item.get('device_id') not in dasds]
+    if not disks:
+        return
+    jobs = [(get_path_to_storage_volume(disk['id'], storage_config),
+             disk['wipe']) for disk in disks]
+    block.wipe_volumes(jobs, max_workers=workers, bandwidth=bandwidth)
+    _PREWIPED_DISKS.update(disk['id'] for disk in disks)
+
+
 def disk_handler(info, storage_config):
     _dos_names = ['dos', 'msdos']
     ptable = info.get('ptable')
@@ -597,7 +827,9 @@ def disk_handler(info, storage_config):
                  "table" % disk)
     else:
         # wipe the disk and create the partition table if instructed to do so
-        if config.value_as_boolean(info.get('wipe')):
+        if info.get('id') in _PREWIPED_DISKS:
+            LOG.debug("disk '%s' was already wiped", info.get('id'))
+        elif config.value_as_boolean(info.get('wipe')):
             block.wipe_volume(disk, mode=info.get('wipe'))
         if config.value_as_boolean(ptable):
             LOG.info("labeling device: '%s' with '%s' partition table", disk,
@@ -612,6 +844,7 @@ def disk_handler(info, storage_config):
                 util.subp(["parted", disk, "--script", "mklabel", "msdos"])
             elif ptable == "vtoc":
                 util.subp(["fdasd", "-c", "/dev/null", disk])
+        invalidate_sfdisk_info(disk)
         holders = clear_holders.get_holders(disk)
         if len(holders) > 0:
             LOG.info('Detected block holders on disk %s: %s', disk, holders)
@@ -624,6 +857,9 @@ def disk_handler(info, storage_config):
 
 
 def getnumberoflogicaldisks(device, storage_config):
+    index = get_partition_index(storage_config)
+    if index is not None:
+        return index.logical_count(device)
     logicaldisks = 0
     for key, item in storage_config.items():
         if item.get('device') == device and item.get('flag') == "logical":
@@ -632,6 +868,13 @@ def getnumberoflogicaldisks(device, storage_config):
 
 
 def find_previous_partition(disk_id, part_id, storage_config):
+    index = get_partition_index(storage_config)
+    if index is not None:
+        previous_id = index.previous_partition(disk_id, part_id)
+        if previous_id is None:
+            return None
+        return determine_partition_number(previous_id, storage_config)
+
     last_partnum = None
     for item_id, command in storage_config.items():
         if item_id == part_id:
@@ -656,6 +899,10 @@ def find_extended_partition(part_device, storage_config):
         :param: storage_config: Ordered dict of storage configation
         :returns: string: item_id if found or None
     """
+    index = get_partition_index(storage_config)
+    if index is not None:
+        return index.extended_partition(part_device)
+
     for item_id, item in storage_config.items():
         if item.get('type') == "partition" and \
            item.get('device') == part_device and \
@@ -714,9 +961,37 @@ def verify_exists(devpath):
         raise RuntimeError("Device %s does not exist" % devpath)
 
 
-def verify_size(devpath, expected_size_bytes, sfdisk_info=None):
+# set by meta_custom to a dictionary of disk kname to the partition table
+# read from it, so preserved partitions on a disk share one read
+_SFDISK_INFO = None
+
+
+def get_sfdisk_info(devpath):
+    """ Return block.sfdisk_info for devpath, reusing the partition table of
+        its disk when it was already read during this meta_custom run.
+    """
+    cache = _SFDISK_INFO
+    if cache is None:
+        return block.sfdisk_info(devpath)
+    (disk, _partnum) = block.get_blockdev_for_partition(devpath)
+    key = block.path_to_kname(disk)
+    sfdisk_info = cache.get(key)
     if not sfdisk_info:
         sfdisk_info = block.sfdisk_info(devpath)
+        if sfdisk_info:
+            cache[key] = sfdisk_info
+    return sfdisk_info
+
+
+def invalidate_sfdisk_info(disk):
+    """ Forget the partition table read from disk, which is being changed. """
+    if _SFDISK_INFO is not None:
+        _SFDISK_INFO.pop(block.path_to_kname(disk), None)
+
+
+def verify_size(devpath, expected_size_bytes, sfdisk_info=None):
+    if not sfdisk_info:
+        sfdisk_info = get_sfdisk_info(devpath)
 
     part_info = block.get_partition_sfdisk_info(devpath,
                                                 sfdisk_info=sfdisk_info)
@@ -740,7 +1015,7 @@ def verify_ptable_flag(devpath, expected_flag, sfdisk_info=None):
             'Cannot verify unknown partition flag: %s' % expected_flag)
 
     if not sfdisk_info:
-        sfdisk_info = block.sfdisk_info(devpath)
+        sfdisk_info = get_sfdisk_info(devpath)
 
     entry = block.get_partition_sfdisk_info(devpath, sfdisk_info=sfdisk_info)
     LOG.debug("Device %s ptable entry: %s", devpath, util.json_dumps(entry))
@@ -767,7 +1042,7 @@ def verify_ptable_flag(devpath, expected_flag, sfdisk_info=None):
 
 def partition_verify_sfdisk(devpath, info):
     verify_exists(devpath)
-    sfdisk_info = block.sfdisk_info(devpath)
+    sfdisk_info = get_sfdisk_info(devpath)
     if not sfdisk_info:
         raise RuntimeError('Failed to extract sfdisk info from %s' % devpath)
     verify_size(devpath, int(util.human2bytes(info['size'])),
@@ -792,6 +1067,103 @@ def partition_verify_fdasd(disk_path, partnumber, info):
         raise RuntimeError("dasd partitions do not support flags")
 
 
+def find_previous_partition_number(info, partnumber, disk_ptable,
+                                   storage_config):
+    """ Return the number of the partition whose placement determines where
+        partition info starts: the extended partition for the first logical
+        partition on a msdos disk, otherwise the preceding partition.
+
+        :returns: integer partition number or None if not found
+    """
+    device = info.get('device')
+    if partnumber == 5 and disk_ptable == "msdos":
+        extended_part_id = find_extended_partition(device, storage_config)
+        if not extended_part_id:
+            msg = ("Logical partition id=%s requires an extended partition"
+                   " and no extended partition '(type: partition, flag: "
+                   "extended)' was found in the storage config.")
+            LOG.error(msg, info['id'])
+            raise RuntimeError(msg, info['id'])
+        return determine_partition_number(extended_part_id, storage_config)
+
+    return find_previous_partition(device, info['id'], storage_config)
+
+
+def calc_partition_offset(partnumber, flag, disk_ptable, alignment_offset,
+                          previous_start_sectors=None,
+                          previous_size_sectors=None):
+    """ Return the start sector of a new partition given the start and size
+        (in sectors) of the partition found by find_previous_partition_number.
+    """
+    # Align to 1M at the beginning of the disk and at logical partitions
+    if partnumber == 1:
+        # start of disk
+        return alignment_offset
+
+    # further partitions
+    if disk_ptable == "gpt" or flag != "logical":
+        # msdos primary and any gpt part start after former partition end
+        return previous_start_sectors + previous_size_sectors
+
+    # msdos extended/logical partitions
+    if partnumber == 5:
+        # First logical partition
+        # start at extended partition start + alignment_offset
+        return previous_start_sectors + alignment_offset
+
+    # Further logical partitions
+    # start at former logical partition end + alignment_offset
+    return (previous_start_sectors + previous_size_sectors +
+            alignment_offset)
+
+
+def calc_partition_length(info, storage_config, logical_block_size_bytes,
+                          alignment_offset):
+    """ Return the length of partition info in sectors, minus one. """
+    length_bytes = util.human2bytes(info.get('size'))
+    # start sector is part of the sectors that define the partitions size
+    # so length has to be "size in sectors - 1"
+    length_sectors = int(length_bytes / logical_block_size_bytes) - 1
+    # logical partitions can't share their start sector with the extended
+    # partition and logical partitions can't go head-to-head, so we have to
+    # realign and for that increase size as required
+    if info.get('flag') == "extended":
+        logdisks = getnumberoflogicaldisks(info.get('device'), storage_config)
+        length_sectors = length_sectors + (logdisks * alignment_offset)
+    return length_sectors
+
+
+def get_logical_block_size(disk):
+    """ Return the logical sector size of disk, defaulting to 512. """
+    disk_kname = block.path_to_kname(disk)
+    # consider the disks logical sector size when calculating sectors
+    try:
+        (logical_block_size_bytes, _) = block.get_blockdev_sector_size(disk)
+        LOG.debug("%s logical_block_size_bytes: %s",
+                  disk_kname, logical_block_size_bytes)
+    except OSError as e:
+        LOG.warning("Couldn't read block size, using default size 512: %s", e)
+        logical_block_size_bytes = 512
+    return logical_block_size_bytes
+
+
+def get_msdos_partition_type(flag):
+    """ Return the parted mkpart type for a partition flag. """
+    if flag and flag == 'prep':
+        raise ValueError(
+            'PReP partitions require a GPT partition table')
+    if flag in ["extended", "logical", "primary"]:
+        return flag
+    return "primary"
+
+
+def get_sgdisk_typecode(flag):
+    """ Return the sgdisk typecode for a partition flag. """
+    if flag and flag in SGDISK_FLAGS:
+        return SGDISK_FLAGS[flag]
+    return SGDISK_FLAGS['linux']
+
+
 def partition_handler(info, storage_config):
     device = info.get('device')
     size = info.get('size')
@@ -806,29 +1178,12 @@ def partition_handler(info, storage_config):
     disk = get_path_to_storage_volume(device, storage_config)
     partnumber = determine_partition_number(info.get('id'), storage_config)
     disk_kname = block.path_to_kname(disk)
+    logical_block_size_bytes = get_logical_block_size(disk)
 
-    # consider the disks logical sector size when calculating sectors
-    try:
-        (logical_block_size_bytes, _) = block.get_blockdev_sector_size(disk)
-        LOG.debug("%s logical_block_size_bytes: %s",
-                  disk_kname, logical_block_size_bytes)
-    except OSError as e:
-        LOG.warning("Couldn't read block size, using default size 512: %s", e)
-        logical_block_size_bytes = 512
-
+    previous_start_sectors = previous_size_sectors = None
     if partnumber > 1:
-        pnum = None
-        if partnumber == 5 and disk_ptable == "msdos":
-            extended_part_id = find_extended_partition(device, storage_config)
-            if not extended_part_id:
-                msg = ("Logical partition id=%s requires an extended partition"
-                       " and no extended partition '(type: partition, flag: "
-                       "extended)' was found in the storage config.")
-                LOG.error(msg, info['id'])
-                raise RuntimeError(msg, info['id'])
-            pnum = determine_partition_number(extended_part_id, storage_config)
-        else:
-            pnum = find_previous_partition(device, info['id'], storage_config)
+        pnum = find_previous_partition_number(info, partnumber, disk_ptable,
+                                              storage_config)
 
         # In case we fail to find previous partition let's error out now
         if pnum is None:
@@ -842,50 +1197,22 @@ def partition_handler(info, storage_config):
         (previous_start_sectors, previous_size_sectors) = (
             calc_partition_info(partition_kname, logical_block_size_bytes))
 
-    # Align to 1M at the beginning of the disk and at logical partitions
     alignment_offset = int((1 << 20) / logical_block_size_bytes)
-    if partnumber == 1:
-        # start of disk
-        offset_sectors = alignment_offset
-    else:
-        # further partitions
-        if disk_ptable == "gpt" or flag != "logical":
-            # msdos primary and any gpt part start after former partition end
-            offset_sectors = previous_start_sectors + previous_size_sectors
-        else:
-            # msdos extended/logical partitions
-            if flag == "logical":
-                if partnumber == 5:
-                    # First logical partition
-                    # start at extended partition start + alignment_offset
-                    offset_sectors = (previous_start_sectors +
-                                      alignment_offset)
-                else:
-                    # Further logical partitions
-                    # start at former logical partition end + alignment_offset
-                    offset_sectors = (previous_start_sectors +
-                                      previous_size_sectors +
-                                      alignment_offset)
-
+    offset_sectors = calc_partition_offset(
+        partnumber, flag, disk_ptable, alignment_offset,
+        previous_start_sectors, previous_size_sectors)
     length_bytes = util.human2bytes(size)
-    # start sector is part of the sectors that define the partitions size
-    # so length has to be "size in sectors - 1"
-    length_sectors = int(length_bytes / logical_block_size_bytes) - 1
-    # logical partitions can't share their start sector with the extended
-    # partition and logical partitions can't go head-to-head, so we have to
-    # realign and for that increase size as required
-    if info.get('flag') == "extended":
-        logdisks = getnumberoflogicaldisks(device, storage_config)
-        length_sectors = length_sectors + (logdisks * alignment_offset)
+    length_sectors = calc_partition_length(
+        info, storage_config, logical_block_size_bytes, alignment_offset)
 
     # Handle preserve flag
     create_partition = True
     if config.value_as_boolean(info.get('preserve')):
+        part_path = block.dev_path(
+            block.partition_kname(disk_kname, partnumber))
         if disk_ptable == 'vtoc':
             partition_verify_fdasd(disk, partnumber, info)
         else:
-            part_path = block.dev_path(
-                block.partition_kname(disk_kname, partnumber))
             partition_verify_sfdisk(part_path, info)
         LOG.debug(
             '%s partition %s already present, skipping create',
@@ -900,33 +1227,10 @@ def partition_handler(info, storage_config):
         LOG.debug("partnum: %s offset_sectors: %s length_sectors: %s",
                   partnumber, offset_sectors, length_sectors)
 
-        # Pre-Wipe the partition if told to do so, do not wipe dos extended
-        # partitions as this may damage the extended partition table
-        if config.value_as_boolean(info.get('wipe')):
-            LOG.info("Preparing partition location on disk %s", disk)
-            if info.get('flag') == "extended":
-                LOG.warn("extended partitions do not need wiping, "
-                         "so skipping: '%s'" % info.get('id'))
-            else:
-                # wipe the start of the new partition first by zeroing 1M at
-                # the length of the previous partition
-                wipe_offset = int(offset_sectors * logical_block_size_bytes)
-                LOG.debug('Wiping 1M on %s at offset %s', disk, wipe_offset)
-                # We don't require exclusive access as we're wiping data at an
-                # offset and the current holder maybe part of the current
-                # storage configuration.
-                block.zero_file_at_offsets(disk, [wipe_offset],
-                                           exclusive=False)
+        prewipe_partition(info, disk, offset_sectors, logical_block_size_bytes)
 
         if disk_ptable == "msdos":
-            if flag and flag == 'prep':
-                raise ValueError(
-                    'PReP partitions require a GPT partition table')
-
-            if flag in ["extended", "logical", "primary"]:
-                partition_type = flag
-            else:
-                partition_type = "primary"
+            partition_type = get_msdos_partition_type(flag)
             cmd = ["parted", disk, "--script", "mkpart", partition_type,
                    "%ss" % offset_sectors, "%ss" % str(offset_sectors +
                                                        length_sectors)]
@@ -935,10 +1239,7 @@ def partition_handler(info, storage_config):
 
             util.subp(cmd, capture=True)
         elif disk_ptable == "gpt":
-            if flag and flag in SGDISK_FLAGS:
-                typecode = SGDISK_FLAGS[flag]
-            else:
-                typecode = SGDISK_FLAGS['linux']
+            typecode = get_sgdisk_typecode(flag)
             cmd = ["sgdisk", "--new", "%s:%s:%s" % (partnumber, offset_sectors,
                    length_sectors + offset_sectors),
                    "--typecode=%s:%s" % (partnumber, typecode), disk]
@@ -948,6 +1249,7 @@ def partition_handler(info, storage_config):
             dasd_pt.add_partition(partnumber, length_bytes)
         else:
             raise ValueError("parent partition has invalid partition table")
+        sysfs.invalidate()
 
         # ensure partition exists
         if multipath.is_mpath_device(disk):
@@ -962,12 +1264,46 @@ def partition_handler(info, storage_config):
         else:
             part_path = block.dev_path(block.partition_kname(disk_kname,
                                                              partnumber))
-            block.rescan_block_devices([disk])
-        udevadm_settle(exists=part_path)
+            block.register_partitions(disk, [partnumber])
+        wait_for_device(part_path)
+        invalidate_sfdisk_info(disk)
 
+    partition_finish(info, storage_config, part_path, create_partition,
+                     partition_type)
+
+
+def prewipe_partition(info, disk, offset_sectors, logical_block_size_bytes):
+    """ Zero the start of a partition's location on disk before it is added
+        to the partition table, if the partition is configured with wipe.
+    """
+    # Pre-Wipe the partition if told to do so, do not wipe dos extended
+    # partitions as this may damage the extended partition table
+    if config.value_as_boolean(info.get('wipe')):
+        LOG.info("Preparing partition location on disk %s", disk)
+        if info.get('flag') == "extended":
+            LOG.warn("extended partitions do not need wiping, "
+                     "so skipping: '%s'" % info.get('id'))
+        else:
+            # wipe the start of the new partition first by zeroing 1M at
+            # the length of the previous partition
+            wipe_offset = int(offset_sectors * logical_block_size_bytes)
+            LOG.debug('Wiping 1M on %s at offset %s', disk, wipe_offset)
+            # We don't require exclusive access as we're wiping data at an
+            # offset and the current holder maybe part of the current
+            # storage configuration.
+            block.zero_file_at_offsets(disk, [wipe_offset],
+                                       exclusive=False)
+
+
+def partition_finish(info, storage_config, part_path, created,
+                     partition_type=None):
+    """ Apply the wipe and name settings of partition info once it is
+        present at part_path.
+    """
+    device = info.get('device')
     wipe_mode = info.get('wipe')
     if wipe_mode:
-        if wipe_mode == 'superblock' and create_partition:
+        if wipe_mode == 'superblock' and created:
             # partition creation pre-wipes partition superblock locations
             pass
         else:
@@ -979,6 +1315,165 @@ def partition_handler(info, storage_config):
         make_dname(info.get('id'), storage_config)
 
 
+PartitionLayout = namedtuple(
+    "PartitionLayout", ('id', 'number', 'offset_sectors', 'length_sectors',
+                        'partition_type', 'flag'))
+
+# disks whose partitions were written by partition_batch_handler, mapping
+# disk id to a dictionary of partition id to partition device path
+_PARTITION_BATCHES = {}
+
+
+def calc_partition_layout(disk_id, storage_config, logical_block_size_bytes):
+    """ Compute the placement of every partition on disk_id from the storage
+        config alone, using the same rules as partition_handler.
+
+        :returns: list of PartitionLayout in storage config order
+    """
+    disk_ptable = storage_config.get(disk_id).get('ptable')
+    alignment_offset = int((1 << 20) / logical_block_size_bytes)
+    # partition number -> (start, size) in sectors
+    placed = {}
+    layout = []
+    for item_id, info in storage_config.items():
+        if info.get('type') != 'partition' or info.get('device') != disk_id:
+            continue
+        if not info.get('size'):
+            raise ValueError(
+                "size must be specified for partition to be created")
+        flag = info.get('flag')
+        partnumber = determine_partition_number(item_id, storage_config)
+        previous_start_sectors = previous_size_sectors = None
+        if partnumber > 1:
+            pnum = find_previous_partition_number(
+                info, partnumber, disk_ptable, storage_config)
+            if pnum not in placed:
+                raise RuntimeError(
+                    'Cannot find previous partition on disk %s' % disk_id)
+            (previous_start_sectors, previous_size_sectors) = placed[pnum]
+
+        offset_sectors = calc_partition_offset(
+            partnumber, flag, disk_ptable, alignment_offset,
+            previous_start_sectors, previous_size_sectors)
+        length_sectors = calc_partition_length(
+            info, storage_config, logical_block_size_bytes, alignment_offset)
+        placed[partnumber] = (offset_sectors, length_sectors + 1)
+
+        partition_type = None
+        if disk_ptable == 'msdos':
+            partition_type = get_msdos_partition_type(flag)
+        layout.append(PartitionLayout(item_id, partnumber, offset_sectors,
+                                      length_sectors, partition_type, flag))
+
+    return layout
+
+
+def partition_table_cmd(disk, disk_ptable, layout):
+    """ Return a single command which adds every partition in layout. """
+    if disk_ptable == "msdos":
+        cmd = ["parted", disk, "--script"]
+        for part in layout:
+            cmd.extend(["mkpart", part.partition_type,
+                        "%ss" % part.offset_sectors,
+                        "%ss" % (part.offset_sectors + part.length_sectors)])
+            if part.flag == 'boot':
+                cmd.extend(['set', str(part.number), 'boot', 'on'])
+        return cmd
+    elif disk_ptable == "gpt":
+        cmd = ["sgdisk"]
+        for part in layout:
+            cmd.extend([
+                "--new", "%s:%s:%s" % (part.number, part.offset_sectors,
+                                       part.offset_sectors +
+                                       part.length_sectors),
+                "--typecode=%s:%s" % (part.number,
+                                      get_sgdisk_typecode(part.flag))])
+        cmd.append(disk)
+        return cmd
+
+    raise ValueError("cannot batch partitions on partition table type: %s" %
+                     disk_ptable)
+
+
+def can_batch_partitions(disk_id, storage_config):
+    """ Return True if the partitions on disk_id can be written in a single
+        partition table transaction: a gpt or msdos table with no preserved
+        partitions.
+    """
+    if storage_config.get(disk_id).get('ptable') not in ('gpt', 'msdos'):
+        return False
+    return not any(
+        config.value_as_boolean(item.get('preserve'))
+        for item in storage_config.values()
+        if item.get('type') == 'partition' and item.get('device') == disk_id)
+
+
+def create_partition_table(disk_id, storage_config):
+    """ Write every partition of disk_id with one partitioning command,
+        register them with the kernel and wait for udev to process them.
+
+        :returns: dictionary mapping partition id to partition device path
+    """
+    disk_ptable = storage_config.get(disk_id).get('ptable')
+    disk = get_path_to_storage_volume(disk_id, storage_config)
+    disk_kname = block.path_to_kname(disk)
+    logical_block_size_bytes = get_logical_block_size(disk)
+    layout = calc_partition_layout(disk_id, storage_config,
+                                   logical_block_size_bytes)
+
+    LOG.info("adding partitions %s to disk '%s' (ptable: '%s')",
+             [part.id for part in layout], disk_id, disk_ptable)
+    for part in layout:
+        LOG.debug("partnum: %s offset_sectors: %s length_sectors: %s",
+                  part.number, part.offset_sectors, part.length_sectors)
+        prewipe_partition(storage_config[part.id], disk, part.offset_sectors,
+                          logical_block_size_bytes)
+
+    util.subp(partition_table_cmd(disk, disk_ptable, layout), capture=True)
+    sysfs.invalidate()
+    block.register_partitions(disk, [part.number for part in layout])
+
+    part_paths = OrderedDict(
+        (part.id, block.dev_path(block.partition_kname(disk_kname,
+                                                       part.number)))
+        for part in layout)
+    for part_path in part_paths.values():
+        wait_for_device(part_path)
+    return part_paths
+
+
+def partition_batch_handler(info, storage_config):
+    """ Handle a partition like partition_handler, but create all partitions
+        of its disk in one transaction when the first of them is handled.
+
+        Disks which cannot be batched (see can_batch_partitions) or which
+        are multipath devices are handled by partition_handler.
+    """
+    device = info.get('device')
+    if not device:
+        raise ValueError("device must be set for partition to be created")
+
+    if device not in _PARTITION_BATCHES:
+        if not can_batch_partitions(device, storage_config):
+            return partition_handler(info, storage_config)
+        disk = get_path_to_storage_volume(device, storage_config)
+        if multipath.is_mpath_device(disk):
+            return partition_handler(info, storage_config)
+        _PARTITION_BATCHES[device] = create_partition_table(device,
+                                                            storage_config)
+        invalidate_sfdisk_info(disk)
+        if _VOLUME_PATH_CACHE is not None:
+            for part_id in _PARTITION_BATCHES[device]:
+                _VOLUME_PATH_CACHE.invalidate(part_id)
+
+    partition_type = None
+    if storage_config.get(device).get('ptable') == 'msdos':
+        partition_type = get_msdos_partition_type(info.get('flag'))
+    partition_finish(info, storage_config,
+                     _PARTITION_BATCHES[device][info['id']], True,
+                     partition_type)
+
+
 def format_handler(info, storage_config):
     volume = info.get('volume')
     if not volume:
@@ -1076,7 +1571,7 @@ def get_volume_spec(device_path):
 
        https://wiki.ubuntu.com/FSTAB
     """
-    info = udevadm_info(path=device_path)
+    info = get_udev_info(device_path)
     block_type = _get_volume_type(device_path)
     LOG.debug('volspec: path=%s type=%s', device_path, block_type)
     LOG.debug('info[DEVLINKS] = %s', info['DEVLINKS'])
@@ -1628,8 +2123,8 @@ def bcache_verify_backingdev(backingdev):
 def bcache_verify(cachedev, backingdev, cache_mode):
     bcache_verify_cachedev(cachedev)
     bcache_verify_backingdev(backingdev)
-    cache_info = bcache.superblock_asdict(cachedev)
-    backing_info = bcache.superblock_asdict(backingdev)
+    cache_info = bcache.read_superblock(cachedev) or {}
+    backing_info = bcache.read_superblock(backingdev) or {}
     verify_bcache_cset_uuid_match(backingdev, cache_info, backing_info)
     if cache_mode:
         verify_cache_mode(backingdev, backing_info, cache_mode)
@@ -1873,11 +2368,105 @@ def zfsroot_update_storage_config(storage_config):
     return ret
 
 
-def meta_clear(devices, report_prefix=''):
+def get_parallel_workers(cfg):
+    """Return the number of storage config items meta_custom may handle at
+       the same time, as set by block-meta: {parallel: N} in cfg.
+    """
+    value = cfg.get('block-meta', {}).get('parallel', 1)
+    try:
+        workers = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(
+            "block-meta 'parallel' must be an integer, got: %s" % value)
+    return max(workers, 1)
+
+
+def get_image_mirrors(cfg):
+    """Return the devices which a dd- image is written to as well as the
+       target device, as set by block-meta: {image-mirrors: [...]} in cfg.
+    """
+    mirrors = cfg.get('block-meta', {}).get('image-mirrors') or []
+    if not isinstance(mirrors, list):
+        raise ValueError(
+            "block-meta 'image-mirrors' must be a list of devices, got: %s" %
+            mirrors)
+    return list(OrderedDict.fromkeys(mirrors))
+
+
+def get_clear_holders_workers(cfg):
+    """Return the number of independent groups of holders meta_clear may shut
+       down at the same time, as set by block-meta: {clear-holders-workers: N}
+       in cfg.
+    """
+    value = cfg.get('block-meta', {}).get('clear-holders-workers', 1)
+    try:
+        workers = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(
+            "block-meta 'clear-holders-workers' must be an integer, got: %s" %
+            value)
+    return max(workers, 1)
+
+
+def get_handler_dependencies(storage_config):
+    """Return a dictionary mapping each storage config id to the set of ids
+       which must be handled before it.
+
+    Besides the references declared in the config, this orders actions that
+    share state outside of the storage config: partitions on the same device,
+    logical volumes in the same volume group and datasets in the same zpool
+    are handled in config order, as are all raid entries (mdadm_create pauses
+    the udev queue) and all mounts.  Users of a partition wait for every
+    partition on its device, since adding a partition re-reads the table.
+
+    :param: storage_config: Ordered dict of storage configation
+    """
+    dasds = dict((item.get('device_id'), item_id)
+                 for item_id, item in storage_config.items()
+                 if item.get('type') == 'dasd')
+    partitions = {}
+    chains = {}
+    depends = OrderedDict()
+    for item_id, item in storage_config.items():
+        item_type = item.get('type')
+        deps = set(get_direct_dependencies(item))
+        chain = None
+        if item_type == 'partition':
+            chain = (item_type, item.get('device'))
+            partitions.setdefault(item.get('device'), []).append(item_id)
+        elif item_type == 'lvm_partition':
+            chain = (item_type, item.get('volgroup'))
+        elif item_type == 'zfs':
+            chain = (item_type, item.get('pool'))
+        elif item_type in ('raid', 'mount'):
+            chain = (item_type,)
+        elif item_type == 'disk' and item.get('device_id') in dasds:
+            deps.add(dasds[item.get('device_id')])
+
+        if chain is not None:
+            if chain in chains:
+                deps.add(chains[chain])
+            chains[chain] = item_id
+        depends[item_id] = deps
+
+    for item_id, deps in depends.items():
+        if storage_config[item_id].get('type') == 'partition':
+            continue
+        for dep in list(deps):
+            dep_cfg = storage_config.get(dep, {})
+            if dep_cfg.get('type') == 'partition':
+                deps.update(partitions[dep_cfg.get('device')])
+
+    return depends
+
+
+def meta_clear(devices, report_prefix='', max_workers=1):
     """ Run clear_holders on specified list of devices.
 
     :param: devices: a list of block devices (/dev/XXX) to be cleared
     :param: report_prefix: a string to pass to the ReportEventStack
+    :param: max_workers: number of independent groups of holders to shut
+            down at the same time
     """
     # shut down any already existing storage layers above any disks used in
     # config that have 'wipe' set
@@ -1886,9 +2475,11 @@ def meta_clear(devices, report_prefix=''):
             reporting_enabled=True, level='INFO',
             description="removing previous storage devices"):
         clear_holders.start_clear_holders_deps()
-        clear_holders.clear_holders(devices)
+        holders_scan = clear_holders.HoldersScan()
+        clear_holders.clear_holders(devices, holders_scan=holders_scan,
+                                    max_workers=max_workers)
         # if anything was not properly shut down, stop installation
-        clear_holders.assert_clear(devices)
+        clear_holders.assert_clear(devices, holders_scan=holders_scan)
 
 
 def meta_custom(args):
@@ -1897,6 +2488,7 @@ def meta_custom(args):
     partitions on which disks to create. It also contains information about
     overlays (raid, lvm, bcache) which need to be setup.
     """
+    global _PARTITION_INDEX, _VOLUME_PATH_CACHE, _SFDISK_INFO, _UDEV_DB
 
     command_handlers = {
         'dasd': dasd_handler,
@@ -1920,23 +2512,78 @@ def meta_custom(args):
 
     storage_config_dict = zfsroot_update_storage_config(storage_config_dict)
 
-    # set up reportstack
-    stack_prefix = state.get('report_stack_prefix', '')
-
-    for item_id, command in storage_config_dict.items():
-        handler = command_handlers.get(command['type'])
-        if not handler:
-            raise ValueError("unknown command type '%s'" % command['type'])
-        with events.ReportEventStack(
-                name=stack_prefix, reporting_enabled=True, level="INFO",
-                description="configuring %s: %s" % (command['type'],
-                                                    command['id'])):
-            try:
-                handler(command, storage_config_dict)
-            except Exception as error:
-                LOG.error("An error occured handling '%s': %s - %s" %
-                          (item_id, type(error).__name__, error))
-                raise
+    try:
+        _PARTITION_INDEX = PartitionIndex(storage_config_dict)
+        _SFDISK_INFO = {}
+        _UDEV_DB = UdevDatabase()
+
+        bmcfg = cfg.get('block-meta', {})
+        _VOLUME_PATH_CACHE = None
+        if config.value_as_boolean(bmcfg.get('cache-volume-paths')):
+            _VOLUME_PATH_CACHE = VolumePathCache(
+                devsync_hits=config.value_as_boolean(
+                    bmcfg.get('devsync-cached-paths')))
+
+        _PREWIPED_DISKS.clear()
+        (wipe_workers, wipe_bandwidth) = get_wipe_settings(cfg)
+        if wipe_workers > 1:
+            with events.ReportEventStack(
+                    name=state.get('report_stack_prefix', ''),
+                    reporting_enabled=True, level="INFO",
+                    description="wiping disks with %s workers" % wipe_workers):
+                prewipe_disks(storage_config_dict, wipe_workers,
+                              wipe_bandwidth)
+
+        if config.value_as_boolean(bmcfg.get('batch-partitions')):
+            LOG.info('blockmeta: writing partition tables one disk at a time')
+            _PARTITION_BATCHES.clear()
+            command_handlers['partition'] = partition_batch_handler
+
+        # set up reportstack
+        stack_prefix = state.get('report_stack_prefix', '')
+
+        def handle_item(item_id):
+            command = storage_config_dict[item_id]
+            handler = command_handlers.get(command['type'])
+            if not handler:
+                raise ValueError("unknown command type '%s'" % command['type'])
+            if _VOLUME_PATH_CACHE is not None:
+                # the handler may (re)create the device for item_id
+                _VOLUME_PATH_CACHE.invalidate(item_id)
+            with events.ReportEventStack(
+                    name=stack_prefix, reporting_enabled=True, level="INFO",
+                    description="configuring %s: %s" % (command['type'],
+                                                        command['id'])):
+                try:
+                    # sysfs reads are memoised for the step, until udev settles
+                    with sysfs.cached():
+                        handler(command, storage_config_dict)
+                except Exception as error:
+                    LOG.error("An error occured handling '%s': %s - %s" %
+                              (item_id, type(error).__name__, error))
+                    raise
+
+        workers = get_parallel_workers(cfg)
+        if workers > 1:
+            # refuse unknown types before any handler has started
+            for command in storage_config_dict.values():
+                if command['type'] not in command_handlers:
+                    raise ValueError(
+                        "unknown command type '%s'" % command['type'])
+            LOG.info('blockmeta: handling storage config with %s workers',
+                     workers)
+            util.run_in_dependency_order(
+                storage_config_dict.keys(), handle_item,
+                depends=get_handler_dependencies(storage_config_dict),
+                max_workers=workers)
+        else:
+            for item_id in storage_config_dict:
+                handle_item(item_id)
+    finally:
+        _PARTITION_INDEX = None
+        _VOLUME_PATH_CACHE = None
+        _SFDISK_INFO = None
+        _UDEV_DB = None
 
     if args.umount:
         util.do_umount(state['target'], recursive=True)
@@ -2032,7 +2679,12 @@ def meta_simple(args):
     if len(dd_images):
         # we have at least one dd-able image
         # we will only take the first one
-        rootdev = write_image_to_disk(dd_images[0], devname)
+        mirrors = get_image_mirrors(cfg)
+        for mirror in mirrors:
+            if not block.is_valid_device(mirror):
+                raise Exception("image mirror '%s' is not a valid device" %
+                                mirror)
+        rootdev = write_image_to_disk(dd_images[0], devname, mirrors=mirrors)
         util.subp(['mount', rootdev, state['target']])
         return 0
 
@@ -25,7 +25,8 @@ CMD_ARGUMENTS = (
     ((('-m', '--mode'),
       {'help': 'mode for wipe.', 'action': 'store',
        'default': 'superblock',
-       'choices': ['zero', 'superblock', 'superblock-recursive', 'random']}),
+       'choices': ['zero', 'superblock', 'superblock-recursive', 'random',
+                   'zeroout', 'discard', 'fast-zero']}),
      ('devices',
       {'help': 'devices to wipe', 'default': [], 'nargs': '+'}),
      )
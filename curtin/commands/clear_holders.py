@@ -31,10 +31,10 @@ def clear_holders_main(args):
         raise ValueError('invalid devices specified')
 
     block.clear_holders.start_clear_holders_deps()
+    holders_scan = block.clear_holders.HoldersScan()
     if args.shutdown_plan:
         # get current holders and plan how to shut them down
-        holder_trees = [block.clear_holders.gen_holders_tree(path)
-                        for path in devices]
+        holder_trees = holders_scan.holders_trees(devices)
         LOG.info('Current device storage tree:\n%s',
                  '\n'.join(block.clear_holders.format_holders_tree(tree)
                            for tree in holder_trees))
@@ -43,12 +43,13 @@ def clear_holders_main(args):
         LOG.info('Shutdown Plan:\n%s', "\n".join(map(str, ordered_devs)))
 
     else:
-        block.clear_holders.clear_holders(devices, try_preserve=args.preserve)
+        block.clear_holders.clear_holders(devices, try_preserve=args.preserve,
+                                          holders_scan=holders_scan)
         if args.preserve:
             print('ran clear_holders attempting to preserve data. however, '
                   'hotplug support for some devices may cause holders to '
                   'restart ')
-        block.clear_holders.assert_clear(devices)
+        block.clear_holders.assert_clear(devices, holders_scan=holders_scan)
 
 
 CMD_ARGUMENTS = (
@@ -4,6 +4,8 @@ import os
 import shutil
 import sys
 import tempfile
+import threading
+import time
 
 import curtin.config
 from curtin.log import LOG
@@ -86,11 +88,12 @@ def _extract_root_fsimage(path, target):
         os.rmdir(mp)
 
 
-def extract_root_layered_fsimage_url(uri, target):
+def extract_root_layered_fsimage_url(uri, target, download_workers=1):
     ''' Build images list to consider from a layered structure
 
     uri: URI of the layer file
     target: Target file system to provision
+    download_workers: number of remote layers to download at the same time
 
     return: None
     '''
@@ -100,45 +103,138 @@ def extract_root_layered_fsimage_url(uri, target):
     LOG.debug("Considering fsimages: '%s'", ",".join(image_stack))
 
     tmp_dir = None
+    downloads = None
     try:
-        # Download every remote images if remote url
+        # Download every remote images if remote url, mounting each layer
+        # as soon as it has arrived
         if url_helper.urlparse(path).scheme != "":
             tmp_dir = tempfile.mkdtemp()
-            image_stack = _download_layered_images(image_stack, tmp_dir)
-
-        # Check that all images exists on disk and are not empty
-        for img in image_stack:
-            if not os.path.isfile(img) or os.path.getsize(img) <= 0:
-                raise ValueError("Failed to use fsimage: '%s' doesn't exist " +
-                                 "or is invalid", img)
+            downloads = _download_layered_images(image_stack, tmp_dir,
+                                                 workers=download_workers)
+            fetch = downloads.wait
+        else:
+            # Check that all images exists on disk before mounting any
+            for img in image_stack:
+                _check_fsimage(img)
+            fetch = None
 
-        return _extract_root_layered_fsimage(image_stack, target)
+        return _extract_root_layered_fsimage(image_stack, target, fetch=fetch)
     finally:
+        if downloads is not None:
+            downloads.close()
         if tmp_dir and os.path.exists(tmp_dir):
             shutil.rmtree(tmp_dir)
 
 
-def _download_layered_images(image_stack, tmp_dir):
-    local_image_stack = []
-    try:
-        for img_url in image_stack:
-            dest_path = os.path.join(tmp_dir,
-                                     os.path.basename(img_url))
-            url_helper.download(img_url, dest_path, retries=3)
-            local_image_stack.append(dest_path)
-    except url_helper.UrlError as e:
-        LOG.error("Failed to download '%s'" % img_url)
-        raise e
-    return local_image_stack
-
-
-def _extract_root_layered_fsimage(image_stack, target):
+def _check_fsimage(img):
+    # Check that an image exists on disk and is not empty
+    if not os.path.isfile(img) or os.path.getsize(img) <= 0:
+        raise ValueError("Failed to use fsimage: '%s' doesn't exist " +
+                         "or is invalid", img)
+    return img
+
+
+# seconds close() waits for cancelled layer downloads to stop
+LAYER_CANCEL_TIMEOUT = 10
+
+
+class _DownloadCancelled(Exception):
+    pass
+
+
+class _LayerDownloads(object):
+    ''' Download the layers of an image stack into tmp_dir, up to workers
+        at the same time and lowest layer first, so that each layer can be
+        mounted as soon as it has arrived.  No further layer is started once
+        one failed to download, and close() stops those in progress. '''
+
+    def __init__(self, image_stack, tmp_dir, workers=1):
+        self._urls = list(image_stack)
+        self._paths = dict((url, os.path.join(tmp_dir, os.path.basename(url)))
+                           for url in self._urls)
+        self._pending = list(self._urls)
+        self._done = set()
+        self._errors = {}
+        self._cancelled = threading.Event()
+        self._cond = threading.Condition()
+        self._threads = []
+        for _ in range(max(min(workers, len(self._urls)), 1)):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                if not self._pending or self._errors:
+                    return
+                img_url = self._pending.pop(0)
+            try:
+                url_helper.download(img_url, self._paths[img_url],
+                                    reporthook=self._check_cancelled,
+                                    retries=3)
+                _check_fsimage(self._paths[img_url])
+            except _DownloadCancelled:
+                LOG.debug("Cancelled download of layer '%s'", img_url)
+                return
+            except Exception as e:
+                LOG.error("Failed to download layer '%s': %s", img_url, e)
+                with self._cond:
+                    self._errors[img_url] = e
+                    self._cond.notify_all()
+            else:
+                LOG.debug("Downloaded layer '%s'", img_url)
+                with self._cond:
+                    self._done.add(img_url)
+                    self._cond.notify_all()
+
+    def _check_cancelled(self, *args):
+        # called by url_helper.download for every chunk
+        if self._cancelled.is_set():
+            raise _DownloadCancelled()
+
+    def wait(self, img_url):
+        ''' Wait for the layer img_url and return its local path.  Raises
+            the download error of the lowest layer which failed, which may
+            not be img_url. '''
+        with self._cond:
+            while img_url not in self._done and not self._errors:
+                self._cond.wait()
+            for url in self._urls:
+                if url in self._errors:
+                    raise self._errors[url]
+        return self._paths[img_url]
+
+    def close(self):
+        ''' Stop the downloads still in progress at their next chunk and
+            start no more.  Downloads which do not stop within
+            LAYER_CANCEL_TIMEOUT seconds are left to their daemon threads.
+        '''
+        self._cancelled.set()
+        with self._cond:
+            del self._pending[:]
+        deadline = time.time() + LAYER_CANCEL_TIMEOUT
+        for thread in self._threads:
+            thread.join(max(deadline - time.time(), 0))
+
+
+def _download_layered_images(image_stack, tmp_dir, workers=1):
+    return _LayerDownloads(image_stack, tmp_dir, workers=workers)
+
+
+def _extract_root_layered_fsimage(image_stack, target, fetch=None):
+    ''' Mount the images of image_stack lowest first and copy their overlay
+        to target.  fetch, if given, is called with each image just before
+        it is mounted and returns the local path to mount. '''
     mp_base = tempfile.mkdtemp()
     mps = []
     try:
         # Create a mount point for each image file and mount the image
         try:
             for img in image_stack:
+                if fetch is not None:
+                    img = fetch(img)
                 mp = os.path.join(mp_base, os.path.basename(img) + ".dir")
                 os.mkdir(mp)
                 util.subp(['mount', '-o', 'loop,ro', img, mp], capture=True)
@@ -212,6 +308,19 @@ def copy_to_target(source, target):
                     '--', source, target])
 
 
+def get_download_workers(source):
+    """Return the number of layers of a fsimage-layered source to download
+       at the same time, as set by its download_workers.
+    """
+    value = source.get('download_workers', 1)
+    try:
+        workers = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(
+            "source 'download_workers' must be an integer, got: %s" % value)
+    return max(workers, 1)
+
+
 def _path_from_file_url(url):
     return url[7:] if url.startswith("file://") else url
 
@@ -250,7 +359,9 @@ def extract(args):
             elif source['type'] == "fsimage":
                 extract_root_fsimage_url(source['uri'], target=target)
             elif source['type'] == "fsimage-layered":
-                extract_root_layered_fsimage_url(source['uri'], target=target)
+                extract_root_layered_fsimage_url(
+                    source['uri'], target=target,
+                    download_workers=get_download_workers(source))
             else:
                 extract_root_tgz_url(source['uri'], target=target)
 
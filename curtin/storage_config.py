@@ -1,6 +1,7 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 from collections import namedtuple, OrderedDict
 import copy
+import heapq
 import operator
 import os
 import re
@@ -248,6 +249,20 @@ def _validate_dep_type(source_id, dep_key, dep_id, sconfig):
     return result
 
 
+def get_direct_dependencies(item_cfg):
+    """ Return a list of the storage config ids which item_cfg refers to
+        through its dependency keys, see _stype_to_deps."""
+    deps = []
+    for dep_key in sorted(_stype_to_deps(item_cfg.get('type'))):
+        dep_value = item_cfg.get(dep_key)
+        if not dep_value:
+            continue
+        if not isinstance(dep_value, list):
+            dep_value = [dep_value]
+        deps.extend(dep_value)
+    return deps
+
+
 def find_item_dependencies(item_id, config, validate=True):
     """ Walk a storage config collecting any dependent device ids."""
 
@@ -371,6 +386,142 @@ def merge_config_trees_to_list(config_trees):
     return merged
 
 
+def get_dependency_index(config):
+    """ Return a dict mapping (dep_key, dep_id) to the list of ids of the
+        items in config which refer to dep_id through dep_key, in config
+        order.  This answers "which items share this dependency" without
+        scanning the config.
+    """
+    dep_keys = set()
+    for stype in STORAGE_CONFIG_TYPES:
+        dep_keys.update(_stype_to_deps(stype))
+
+    index = {}
+    for item_id, item_cfg in config.items():
+        for dep_key in dep_keys:
+            dep_value = item_cfg.get(dep_key)
+            # list values never compare equal to a single dependency id
+            if dep_value is None or isinstance(dep_value, (list, dict)):
+                continue
+            index.setdefault((dep_key, dep_value), []).append(item_id)
+    return index
+
+
+def get_dependency_levels(config, validate=True):
+    """ Return a dict mapping each item id in config to its dependency level.
+
+        The level of an item is the number of distinct ids in the config tree
+        that get_config_tree builds for it: the item, the items it depends
+        on, the items sharing each of those dependencies and, recursively,
+        the same for each dependency.  Dependency sets are computed once per
+        item and shared between items with the same single dependency, so
+        this is roughly linear in the size of the config.
+    """
+    if not config or not isinstance(config, OrderedDict):
+        raise ValueError('Invalid config. Must be non-empty OrderedDict')
+
+    same_deps = get_dependency_index(config)
+    dep_sets = {}
+    edge_sets = {}
+    visiting = set()
+
+    def _edge_set(dep_key, dep):
+        # the items sharing dep_key: dep, dep itself and everything below dep
+        key = (dep_key, dep)
+        if key not in edge_sets:
+            edge = set(same_deps.get(key, []))
+            edge.add(dep)
+            edge.update(_dep_set(dep))
+            edge_sets[key] = frozenset(edge)
+        return edge_sets[key]
+
+    def _dep_set(item_id):
+        if item_id in dep_sets:
+            return dep_sets[item_id]
+        if item_id in visiting:
+            raise ValueError(
+                'Dependency cycle in storage config at id=%s' % item_id)
+        visiting.add(item_id)
+        item_cfg = config[item_id]
+        edges = []
+        for dep_key in _stype_to_deps(item_cfg.get('type')):
+            if dep_key not in item_cfg:
+                continue
+            dep_value = item_cfg[dep_key]
+            if not isinstance(dep_value, list):
+                dep_value = [dep_value]
+            for dep in dep_value:
+                if validate:
+                    _validate_dep_type(item_id, dep_key, dep, config)
+                edges.append(_edge_set(dep_key, dep))
+        visiting.discard(item_id)
+        if len(edges) == 1:
+            deps = edges[0]
+        else:
+            deps = frozenset().union(*edges)
+        dep_sets[item_id] = deps
+        return deps
+
+    levels = {}
+    for item_id in config:
+        deps = _dep_set(item_id)
+        levels[item_id] = len(deps) + (0 if item_id in deps else 1)
+    return levels
+
+
+def sort_config_by_dependency(config, validate=True):
+    """ Return the item configs of the OrderedDict config as a list sorted
+        from the least to the most dependent item.
+
+        This produces the same order as merging the get_config_tree of every
+        item with merge_config_trees_to_list: items are ordered by
+        dependency level, then by type and then by the _stype_to_order_key
+        of the type.  The list is built with a topological (Kahn) sort over
+        the direct dependencies using that order to pick between items
+        which are ready, so an item never precedes what it depends on.
+    """
+    levels = get_dependency_levels(config, validate=validate)
+    position = dict((item_id, pos) for pos, item_id in enumerate(config))
+    order_getters = {}
+
+    def _sort_key(item_id):
+        item_cfg = config[item_id]
+        item_type = item_cfg['type']
+        if item_type not in order_getters:
+            order_getters[item_type] = operator.itemgetter(
+                *list(_stype_to_order_key(item_type)))
+        return (levels[item_id], item_type,
+                order_getters[item_type](item_cfg), position[item_id])
+
+    users = dict((item_id, []) for item_id in config)
+    pending = {}
+    for item_id, item_cfg in config.items():
+        deps = set(dep for dep in get_direct_dependencies(item_cfg)
+                   if dep in config and dep != item_id)
+        pending[item_id] = len(deps)
+        for dep in deps:
+            users[dep].append(item_id)
+
+    ready = [_sort_key(item_id) + (item_id,)
+             for item_id, count in pending.items() if count == 0]
+    heapq.heapify(ready)
+    merged = []
+    while ready:
+        item_id = heapq.heappop(ready)[-1]
+        merged.append(config[item_id])
+        for user in users[item_id]:
+            pending[user] -= 1
+            if pending[user] == 0:
+                heapq.heappush(ready, _sort_key(user) + (user,))
+
+    if len(merged) != len(config):
+        unsorted = sorted(set(config) - set(cfg['id'] for cfg in merged))
+        raise ValueError(
+            'Dependency cycle in storage config between ids: %s' % unsorted)
+
+    return merged
+
+
 def config_tree_to_list(config_tree):
     """ ConfigTrees are OrderedDicts which insert dependent storage configs
         from leaf to root.  Reversing this insertion order creates a list
@@ -1356,16 +1507,11 @@ def extract_storage_config(probe_data, strict=False):
               yaml.dump({'storage': ordered},
                         indent=4, default_flow_style=False))
 
-    LOG.debug("Generating storage config dependencies")
-    ctrees = []
-    for cfg in ordered:
-        tree = get_config_tree(cfg.get('id'), final_config)
-        ctrees.append(tree)
-
-    LOG.debug("Merging storage config dependencies")
+    LOG.debug("Sorting storage config by dependencies")
+    sconfig = OrderedDict((cfg['id'], cfg) for cfg in ordered)
     merged_config = {
         'version': 1,
-        'config': merge_config_trees_to_list(ctrees)
+        'config': sort_config_by_dependency(sconfig) if sconfig else [],
     }
     LOG.debug("Merged storage config:\n%s",
               yaml.dump({'storage': merged_config},
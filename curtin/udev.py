@@ -1,7 +1,14 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+import copy
 import shlex
 import os
+import re
+import socket
+import stat
+import struct
+import threading
+import time
 
 from curtin import util
 from curtin.log import logged_call, LOG
@@ -13,6 +20,37 @@ except AttributeError:
     import pipes
     shlex_quote = pipes.quote
 
+# linux/netlink.h
+NETLINK_KOBJECT_UEVENT = 15
+# multicast groups of uevents: raw kernel events, and events re-broadcast by
+# udev once its rules for the device have run
+UEVENT_GROUP_KERNEL = 1
+UEVENT_GROUP_UDEV = 2
+UEVENT_BUFFER_SIZE = 64 * 1024
+# udev prefixes its events with a struct udev_monitor_netlink_header,
+# starting with this prefix and magic, then (in host byte order)
+# header_size, properties_off and properties_len
+UDEV_MONITOR_PREFIX = b'libudev\0'
+UDEV_MONITOR_MAGIC = 0xfeedcafe
+# seconds wait_for_device listens for events before using udevadm settle
+UDEV_WAIT_TIMEOUT = 30
+# where udev keeps the properties of each device it has processed
+UDEV_DATA_DIR = '/run/udev/data'
+
+# incremented whenever udev is known to have processed events, so that
+# caches of device state loaded before then are reloaded
+_SETTLE_GENERATION = [0]
+
+
+def _settled():
+    _SETTLE_GENERATION[0] += 1
+
+
+def settle_generation():
+    """Return a number which changes whenever udev has settled, for caches
+    of device state to tell when they may be out of date."""
+    return _SETTLE_GENERATION[0]
+
 
 def compose_udev_equality(key, value):
     """Return a udev comparison clause, like `ACTION=="add"`."""
@@ -56,12 +94,136 @@ def udevadm_settle(exists=None, timeout=None):
     if exists:
         # skip the settle if the requested path already exists
         if os.path.exists(exists):
+            _settled()
             return
         settle_cmd.extend(['--exit-if-exists=%s' % exists])
     if timeout:
         settle_cmd.extend(['--timeout=%s' % timeout])
 
     util.subp(settle_cmd)
+    _settled()
+
+
+def parse_uevent(data):
+    """Return the properties of a uevent received from netlink, either as
+    sent by the kernel (ACTION@DEVPATH followed by KEY=VALUE strings) or as
+    re-broadcast by udev (a libudev header followed by KEY=VALUE strings).
+    """
+    if data.startswith(UDEV_MONITOR_PREFIX):
+        magic = struct.unpack_from('>I', data, 8)[0]
+        if magic != UDEV_MONITOR_MAGIC:
+            raise ValueError('Invalid udev monitor magic: 0x%x' % magic)
+        (_header_size, offset, length) = struct.unpack_from('=III', data, 12)
+        data = data[offset:offset + length]
+    else:
+        data = data.split(b'\0', 1)[-1]
+    event = {}
+    for field in data.split(b'\0'):
+        if b'=' in field:
+            key, value = field.decode('utf-8', 'replace').split('=', 1)
+            event[key] = value
+    return event
+
+
+class NetlinkUeventSource(object):
+    """Uevents of the netlink multicast group, by default those that udev
+    has finished processing."""
+
+    def __init__(self, group=UEVENT_GROUP_UDEV):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                  NETLINK_KOBJECT_UEVENT)
+        try:
+            self.sock.bind((0, group))
+        except Exception:
+            self.sock.close()
+            raise
+
+    def receive(self, timeout):
+        """Return the properties of the next event, or None if there was
+        none within timeout seconds."""
+        self.sock.settimeout(timeout)
+        try:
+            data = self.sock.recv(UEVENT_BUFFER_SIZE)
+        except socket.timeout:
+            return None
+        try:
+            return parse_uevent(data)
+        except (ValueError, struct.error) as e:
+            LOG.debug('Ignoring invalid uevent: %s', e)
+            return {}
+
+    def close(self):
+        self.sock.close()
+
+
+def uevent_matches(event, path):
+    """Return True if event is for the device node or udev symlink path."""
+    names = event.get('DEVLINKS', '').split()
+    devname = event.get('DEVNAME')
+    if devname:
+        # the kernel names the node relative to /dev, udev does not
+        names.append(os.path.join('/dev', devname))
+    return path in names
+
+
+def udev_processed(path):
+    """Return True once udev has processed the device at path.  A udev
+    symlink exists only once udev made it, but devtmpfs creates device
+    nodes before udev sees their event, so for a node this is when udev has
+    written its database entry (UDEV_DATA_DIR/b<MAJOR>:<MINOR>)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if os.path.islink(path) or not stat.S_ISBLK(st.st_mode):
+        return True
+    return os.path.exists(os.path.join(
+        UDEV_DATA_DIR, 'b%s:%s' % (os.major(st.st_rdev),
+                                   os.minor(st.st_rdev))))
+
+
+@logged_call()
+def wait_for_device(path, timeout=UDEV_WAIT_TIMEOUT, source=None):
+    """Wait until udev has processed the device with node or symlink path,
+    listening for its event rather than waiting for the whole udev queue
+    to empty as udevadm settle does.
+
+    :param source: object with receive(timeout) returning the properties of
+                   the next uevent or None, and close(); a
+                   NetlinkUeventSource is opened if not given.
+    The device is done once its udev event arrives or udev_processed(path),
+    not when its node merely exists.  If neither happens within timeout
+    seconds, or netlink cannot be used, this falls back to udevadm_settle.
+    """
+    owned = source is None
+    if owned:
+        try:
+            source = NetlinkUeventSource()
+        except (IOError, OSError) as e:
+            LOG.debug('Cannot listen for uevents, using udevadm settle: %s',
+                      e)
+            return udevadm_settle()
+    try:
+        # checked only once listening so that an event cannot be missed
+        if udev_processed(path):
+            _settled()
+            return
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            event = source.receive(remaining) if remaining > 0 else None
+            if event is None:
+                break
+            if uevent_matches(event, path) or udev_processed(path):
+                LOG.debug('udev processed %s', path)
+                _settled()
+                return
+    finally:
+        if owned:
+            source.close()
+    LOG.debug('No uevent for %s within %ss, using udevadm settle', path,
+              timeout)
+    udevadm_settle()
 
 
 def udevadm_trigger(devices):
@@ -84,10 +246,15 @@ def udevadm_info(path=None):
 
     info_cmd = ['udevadm', 'info', '--query=property', '--export', path]
     output, _ = util.subp(info_cmd, capture=True)
+    return _parse_udev_properties(output.splitlines())
+
 
+def _parse_udev_properties(lines):
+    """ Return the dictionary udevadm_info returns for lines of KEY='VALUE'
+        as printed by udevadm info --query=property --export. """
     # strip for trailing empty line
     info = {}
-    for line in output.splitlines():
+    for line in lines:
         if not line:
             continue
         # maxsplit=1 gives us key and remaininng part of line is value
@@ -129,4 +296,109 @@ def udevadm_info(path=None):
     return info
 
 
+class UdevDatabase(object):
+    """ Properties of block devices as udevadm_info returns them, read from
+        the udev database file of each device (/run/udev/data/b<MAJ:MIN>)
+        and its sysfs uevent rather than by running udevadm.
+
+        The properties of a device are cached until udev rewrites its
+        database file, so lookups see the changes handlers make without
+        reloading any other device.  Devices which have no database file
+        are queried with udevadm_info.
+    """
+
+    def __init__(self, data_dir=UDEV_DATA_DIR, sysfs='/sys'):
+        self._lock = threading.Lock()
+        self._data_dir = data_dir
+        self._sysfs = sysfs
+        self._cache = {}
+
+    def invalidate(self):
+        """ Forget the properties of every device. """
+        with self._lock:
+            self._cache.clear()
+
+    def _majmin(self, path):
+        """ Return MAJOR:MINOR of the block device at a /dev or /sys path,
+            or None if it is not one. """
+        if re.match(r'^[0-9]+:[0-9]+$', path):
+            return path
+        if path.startswith(self._sysfs + '/'):
+            try:
+                return util.load_file(os.path.join(path, 'dev')).strip()
+            except (IOError, OSError):
+                return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISBLK(st.st_mode):
+            return None
+        return '%s:%s' % (os.major(st.st_rdev), os.minor(st.st_rdev))
+
+    def _load(self, majmin, data_file):
+        sysdev = os.path.join(self._sysfs, 'dev', 'block', majmin)
+        props = [('SUBSYSTEM', 'block')]
+        uevent = util.load_file(os.path.join(sysdev, 'uevent'))
+        for line in uevent.splitlines():
+            if '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            if key == 'DEVNAME':
+                value = os.path.join('/dev', value)
+            props.append((key, value))
+        devpath = os.path.realpath(sysdev)
+        props.append(('DEVPATH',
+                      devpath[len(os.path.realpath(self._sysfs)):]))
+        links = []
+        tags = []
+        current_tags = []
+        for line in util.load_file(data_file).splitlines():
+            if line.startswith('S:'):
+                links.append(os.path.join('/dev', line[2:]))
+            elif line.startswith('E:') and '=' in line:
+                props.append(tuple(line[2:].split('=', 1)))
+            elif line.startswith('I:'):
+                props.append(('USEC_INITIALIZED', line[2:]))
+            elif line.startswith('G:'):
+                tags.append(line[2:])
+            elif line.startswith('Q:'):
+                current_tags.append(line[2:])
+        if links:
+            props.append(('DEVLINKS', ' '.join(links)))
+        if tags:
+            props.append(('TAGS', ':%s:' % ':'.join(tags)))
+        if current_tags:
+            props.append(('CURRENT_TAGS', ':%s:' % ':'.join(current_tags)))
+        return _parse_udev_properties(
+            "%s='%s'" % (key, value) for (key, value) in props)
+
+    def get(self, path):
+        """ Return the udevadm_info dictionary for the device at path, a
+            /dev or /sys path or MAJOR:MINOR. """
+        if not path:
+            raise ValueError('Invalid path: "%s"' % path)
+        majmin = self._majmin(path)
+        info = None
+        if majmin:
+            data_file = os.path.join(self._data_dir, 'b' + majmin)
+            try:
+                st = os.stat(data_file)
+                stamp = (st.st_ino, st.st_mtime, st.st_size)
+                with self._lock:
+                    cached = self._cache.get(majmin)
+                if cached and cached[0] == stamp:
+                    info = cached[1]
+                else:
+                    info = self._load(majmin, data_file)
+                    with self._lock:
+                        self._cache[majmin] = (stamp, info)
+            except (IOError, OSError) as e:
+                LOG.debug('No udev database entry for %s (%s): %s', path,
+                          majmin, e)
+        if info is None:
+            return udevadm_info(path)
+        return copy.deepcopy(info)
+
+
 # vi: ts=4 expandtab syntax=python
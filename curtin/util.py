@@ -15,6 +15,7 @@ import subprocess
 import stat
 import sys
 import tempfile
+import threading
 import time
 
 # avoid the dependency to python3-six as used in cloud-init
@@ -416,6 +417,90 @@ class LogTimer(object):
                      (self.msg, time.time() - self.start))
 
 
+def run_in_dependency_order(items, func, depends=None, max_workers=1):
+    """Call func(item) for each item, never before its dependencies finish.
+
+    :param items: list of hashable items.  Among items that are ready to run,
+                  list order decides which one is started first.
+    :param func: callable invoked as func(item).
+    :param depends: dictionary mapping an item to an iterable of items which
+                    must complete before it is started.  Dependencies not
+                    present in items are ignored.
+    :param max_workers: maximum number of concurrent calls to func.  With the
+                        default of 1 every call is made in the calling thread.
+    :returns: dictionary mapping each item to the value returned by func.
+    :raises: the first exception raised by func once all calls already in
+             progress have returned; no new items are started after an error.
+             ValueError if the dependencies contain a cycle.
+    """
+    items = list(items)
+    if depends is None:
+        depends = {}
+    known = set(items)
+    pending = dict((item, set(dep for dep in depends.get(item, ())
+                              if dep in known and dep != item))
+                   for item in items)
+    remaining = list(items)
+    done = set()
+    results = {}
+
+    def _next_ready():
+        for item in remaining:
+            if pending[item].issubset(done):
+                return item
+        return None
+
+    if max_workers <= 1:
+        while remaining:
+            item = _next_ready()
+            if item is None:
+                raise ValueError('dependency cycle among: %s' % remaining)
+            remaining.remove(item)
+            results[item] = func(item)
+            done.add(item)
+        return results
+
+    running = set()
+    errors = []
+    cond = threading.Condition()
+
+    def _worker(item):
+        try:
+            result = func(item)
+        except Exception as error:
+            with cond:
+                errors.append(error)
+        else:
+            with cond:
+                results[item] = result
+                done.add(item)
+        finally:
+            with cond:
+                running.discard(item)
+                cond.notify()
+
+    with cond:
+        while remaining or running:
+            while not errors and len(running) < max_workers:
+                item = _next_ready()
+                if item is None:
+                    break
+                remaining.remove(item)
+                running.add(item)
+                worker = threading.Thread(target=_worker, args=(item,))
+                worker.daemon = True
+                worker.start()
+            if not running:
+                if errors:
+                    break
+                raise ValueError('dependency cycle among: %s' % remaining)
+            cond.wait()
+
+    if errors:
+        raise errors[0]
+    return results
+
+
 def is_mounted(target, src=None, opts=None):
     # return whether or not src is mounted on target
     mounts = ""
@@ -912,8 +997,8 @@ def sanitize_source(source):
         # already sanitized?
         return source
     supported = ['tgz', 'dd-tgz', 'tbz', 'dd-tbz', 'txz', 'dd-txz', 'dd-tar',
-                 'dd-bz2', 'dd-gz', 'dd-xz', 'dd-raw', 'fsimage',
-                 'fsimage-layered']
+                 'dd-bz2', 'dd-gz', 'dd-xz', 'dd-zst', 'dd-raw', 'dd-qcow2',
+                 'dd-sparse', 'fsimage', 'fsimage-layered']
     deftype = 'tgz'
     for i in supported:
         prefix = i + ":"
@@ -1,21 +1,32 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+import ctypes
+import errno
 import functools
 import json
+import mmap
 import os
 import mock
+import struct
 import sys
 import textwrap
 
 from collections import OrderedDict
+from contextlib import contextmanager
+from unittest import skipUnless
 
-from .helpers import CiTestCase, simple_mocked_open
+from .helpers import CiTestCase, populate_dir, simple_mocked_open
 from curtin import util
 from curtin import block
 
 
 class TestBlock(CiTestCase):
 
+    def setUp(self):
+        super(TestBlock, self).setUp()
+        self.add_patch('curtin.block._DISK_LINKS', 'm_disk_links',
+                       autospec=None, new=block.DiskLinkIndex())
+
     @mock.patch("curtin.block.util")
     def test_get_volume_uuid(self, mock_util):
         path = "/dev/sda1"
@@ -91,7 +102,7 @@ class TestBlock(CiTestCase):
 
         path = block.lookup_disk(serial)
 
-        mock_os_listdir.assert_called_with("/dev/disk/by-id/")
+        mock_os_listdir.assert_any_call("/dev/disk/by-id")
         mock_os_path_realpath.assert_called_with("/dev/disk/by-id/sda_%s" %
                                                  serial)
         self.assertTrue(mock_os_path_exists.called)
@@ -101,11 +112,44 @@ class TestBlock(CiTestCase):
             mock_os_path_exists.return_value = False
             block.lookup_disk(serial)
 
+        # the mocked realpath cannot tell the old links are gone
+        block.invalidate_disk_links()
         with self.assertRaises(ValueError):
             mock_os_path_exists.return_value = True
             mock_os_listdir.return_value = ["other"]
             block.lookup_disk(serial)
 
+    @mock.patch("curtin.block.multipath")
+    @mock.patch("curtin.block.os.path.realpath")
+    @mock.patch("curtin.block.os.path.exists")
+    @mock.patch("curtin.block.os.listdir")
+    def test_lookup_disk_scans_links_once(self, m_listdir, m_exists,
+                                          m_realpath, m_mpath):
+        links = {'/dev/disk/by-id/virtio-aaa': '/dev/vda',
+                 '/dev/disk/by-id/virtio-aaa-part1': '/dev/vda1',
+                 '/dev/disk/by-id/virtio-bbb': '/dev/vdb'}
+        m_listdir.side_effect = lambda path: (
+            [os.path.basename(link) for link in links]
+            if path == '/dev/disk/by-id' else [])
+        m_exists.return_value = True
+        m_realpath.side_effect = lambda path: links.get(path, path)
+        m_mpath.is_mpath_device.return_value = False
+        m_mpath.is_mpath_member.return_value = False
+
+        self.assertEqual('/dev/vda', block.lookup_disk('aaa'))
+        self.assertEqual('/dev/vdb', block.lookup_disk('bbb'))
+        self.assertEqual('/dev/disk/by-id/virtio-bbb',
+                         block.disk_to_byid_path('vdb'))
+        self.assertEqual(3, m_listdir.call_count)
+
+        # a new disk is found by rescanning, a stale link is skipped
+        links['/dev/disk/by-id/virtio-ccc'] = '/dev/vdc'
+        self.assertEqual('/dev/vdc', block.lookup_disk('ccc'))
+        self.assertEqual(6, m_listdir.call_count)
+        links['/dev/disk/by-id/virtio-bbb'] = '/dev/vdd'
+        self.assertIsNone(block.disk_to_byid_path('vdb'))
+        self.assertEqual(9, m_listdir.call_count)
+
     @mock.patch("curtin.block.multipath")
     @mock.patch("curtin.block.os.path.realpath")
     @mock.patch("curtin.block.os.path.exists")
@@ -127,7 +171,7 @@ class TestBlock(CiTestCase):
 
         path = block.lookup_disk(wwn)
 
-        mock_os_listdir.assert_called_with("/dev/disk/by-id/")
+        mock_os_listdir.assert_any_call("/dev/disk/by-id")
         mock_os_path_realpath.assert_called_with("/dev/disk/by-id/" +
                                                  expected_link)
         self.assertTrue(mock_os_path_exists.called)
@@ -157,27 +201,33 @@ class TestBlock(CiTestCase):
         with self.assertRaises(ValueError):
             block.get_device_mapper_links(self.random_string())
 
-    @mock.patch("curtin.block.get_dev_disk_byid")
-    def test_disk_to_byid_path(self, mock_byid):
+    @mock.patch("curtin.block.os.path.realpath")
+    @mock.patch("curtin.block.os.listdir")
+    @mock.patch("curtin.block.os.path.exists")
+    def test_disk_to_byid_path(self, m_exists, m_listdir, m_realpath):
         """ disk_to_byid path returns a /dev/disk/by-id path """
         mapping = {
-            '/dev/sda': '/dev/disk/by-id/scsi-abcdef',
+            '/dev/disk/by-id/scsi-abcdef': '/dev/sda',
         }
-        mock_byid.return_value = mapping
+        m_exists.return_value = True
+        m_listdir.return_value = ['scsi-abcdef']
+        m_realpath.side_effect = lambda path: mapping.get(path, path)
 
         byid_path = block.disk_to_byid_path('/dev/sda')
-        self.assertEqual(mapping['/dev/sda'], byid_path)
+        self.assertEqual('/dev/disk/by-id/scsi-abcdef', byid_path)
 
-    @mock.patch("curtin.block.get_dev_disk_byid")
-    def test_disk_to_byid_path_notfound(self, mock_byid):
+    @mock.patch("curtin.block.os.path.realpath")
+    @mock.patch("curtin.block.os.listdir")
+    @mock.patch("curtin.block.os.path.exists")
+    def test_disk_to_byid_path_notfound(self, m_exists, m_listdir,
+                                        m_realpath):
         """ disk_to_byid path returns None for not found devices """
-        mapping = {
-            '/dev/sda': '/dev/disk/by-id/scsi-abcdef',
-        }
-        mock_byid.return_value = mapping
+        m_exists.return_value = True
+        m_listdir.return_value = ['scsi-abcdef']
+        m_realpath.return_value = '/dev/sda'
 
         byid_path = block.disk_to_byid_path('/dev/sdb')
-        self.assertEqual(mapping.get('/dev/sdb'), byid_path)
+        self.assertIsNone(byid_path)
 
     @mock.patch("curtin.block.os.path.exists")
     def test__get_dev_disk_by_prefix_returns_empty_dict(self, m_exists):
@@ -192,6 +242,40 @@ class TestBlock(CiTestCase):
         self.assertEqual(None, block.disk_to_byid_path('/dev/sdb'))
 
 
+class TestDiskLinkIndex(CiTestCase):
+
+    def setUp(self):
+        super(TestDiskLinkIndex, self).setUp()
+        self.root = self.tmp_dir()
+        self.by_id = os.path.join(self.root, 'by-id')
+        os.mkdir(self.by_id)
+        self.index = block.DiskLinkIndex(root=self.root)
+
+    def _link(self, name, devname):
+        link = os.path.join(self.by_id, name)
+        os.symlink(os.path.join(self.root, devname), link)
+        return link
+
+    def test_find_links_rescans_if_any_link_is_stale(self):
+        disk = self._link('virtio-abc', 'vda')
+        part = self._link('virtio-abc-part1', 'vda1')
+        self.assertEqual([disk, part],
+                         self.index.find_links('by-id', 'virtio-abc'))
+        os.unlink(part)
+        self.assertEqual([disk], self.index.find_links('by-id', 'virtio-abc'))
+
+    @mock.patch('curtin.block.settle_generation')
+    def test_rescans_after_udev_settles(self, m_generation):
+        m_generation.return_value = 1
+        disk = self._link('virtio-abc', 'vda')
+        self.assertEqual([disk], self.index.find_links('by-id', 'virtio-abc'))
+        part = self._link('virtio-abc-part1', 'vda1')
+        self.assertEqual([disk], self.index.find_links('by-id', 'virtio-abc'))
+        m_generation.return_value = 2
+        self.assertEqual([disk, part],
+                         self.index.find_links('by-id', 'virtio-abc'))
+
+
 class TestSysBlockPath(CiTestCase):
     @mock.patch("os.path.exists")
     def test_existing_valid_devname(self, m_os_path_exists):
@@ -393,6 +477,83 @@ class TestWipeFile(CiTestCase):
             self.assertEqual([], mock_os_close.call_args_list)
 
 
+class TestDirectWipeFile(CiTestCase):
+
+    def setUp(self):
+        super(TestDirectWipeFile, self).setUp()
+        self.pagesize = mmap.PAGESIZE
+        self.flen = 5 * self.pagesize + 512
+        self.myfile = self.tmp_path("direct_wipe")
+        util.write_file(self.myfile, self.flen * b'\1', omode="wb")
+
+        # tmpfs does not support O_DIRECT, open the file without it
+        @contextmanager
+        def fake_open(path, exclusive=True, direct=False):
+            with open(path, 'rb+') as fp:
+                yield fp
+
+        self.add_patch('curtin.block.exclusive_open', 'm_open',
+                       side_effect=fake_open)
+
+    @skipUnless(hasattr(os, 'pwrite'), 'os.pwrite not available')
+    def test_writes_zeros_with_queue_depth(self):
+        block.direct_wipe_file(self.myfile, buflen=2 * self.pagesize,
+                               queue_depth=3, exclusive=False)
+        self.m_open.assert_called_with(self.myfile, exclusive=False,
+                                       direct=True)
+        found = util.load_file(self.myfile, decode=False)
+        self.assertEqual(self.flen * b'\0', found)
+
+    @skipUnless(hasattr(os, 'pwrite'), 'os.pwrite not available')
+    def test_writes_keystream(self):
+        block.direct_wipe_file(self.myfile, keystream=True,
+                               buflen=self.pagesize, queue_depth=2)
+        found = util.load_file(self.myfile, decode=False)
+        self.assertEqual(self.flen, len(found))
+        self.assertNotIn(self.pagesize * b'\1', found)
+        self.assertNotIn(self.pagesize * b'\0', found)
+
+    @skipUnless(hasattr(os, 'pwrite'), 'os.pwrite not available')
+    @mock.patch('curtin.block.os.pwrite')
+    def test_write_error_raised(self, m_pwrite):
+        m_pwrite.side_effect = OSError(errno.EIO, 'io error')
+        with self.assertRaises(OSError):
+            block.direct_wipe_file(self.myfile, buflen=self.pagesize)
+
+    def test_keystream_reads(self):
+        keystream = block.RandomKeystream(reseed=2)
+        reads = [bytes(keystream.read(4096)) for _ in range(4)]
+        self.assertEqual([4096] * 4, [len(buf) for buf in reads])
+        self.assertEqual(4, len(set(reads)))
+
+    def test_keystream_does_not_repeat_itself(self):
+        keystream = block.RandomKeystream()
+        blocks = set()
+        for _ in range(256):
+            buf = bytes(keystream.read(64 * 1024))
+            blocks.update(buf[i:i + 512] for i in range(0, len(buf), 512))
+        self.assertEqual(256 * 128, len(blocks))
+
+    @mock.patch('curtin.block.direct_wipe_file')
+    @mock.patch('curtin.block.can_direct_wipe')
+    def test_wipe_file_uses_direct_writer(self, m_can_direct, m_direct):
+        m_can_direct.return_value = True
+        block.wipe_file(self.myfile, exclusive=False)
+        m_direct.assert_called_with(self.myfile, buflen=4 * 1024 * 1024,
+                                    exclusive=False, limiter=None)
+        self.assertEqual(self.flen * b'\1',
+                         util.load_file(self.myfile, decode=False))
+
+    @mock.patch('curtin.block.direct_wipe_file')
+    @mock.patch('curtin.block.can_direct_wipe')
+    def test_wipe_file_falls_back_on_einval(self, m_can_direct, m_direct):
+        m_can_direct.return_value = True
+        m_direct.side_effect = OSError(errno.EINVAL, 'no O_DIRECT')
+        block.wipe_file(self.myfile)
+        self.assertEqual(self.flen * b'\0',
+                         util.load_file(self.myfile, decode=False))
+
+
 class TestWipeVolume(CiTestCase):
     dev = '/dev/null'
 
@@ -415,11 +576,23 @@ class TestWipeVolume(CiTestCase):
         mock_quick_zero.assert_called_with(self.dev, exclusive=True,
                                            partitions=True, strict=False)
 
+    @mock.patch('curtin.block.sysfs.invalidate')
+    @mock.patch('curtin.block.quick_zero')
+    def test_wipe_invalidates_sysfs_cache(self, mock_quick_zero,
+                                          mock_invalidate):
+        block.wipe_volume(self.dev, mode='superblock')
+        self.assertEqual(1, mock_invalidate.call_count)
+        mock_quick_zero.side_effect = OSError('gone')
+        with self.assertRaises(OSError):
+            block.wipe_volume(self.dev, mode='superblock')
+        self.assertEqual(2, mock_invalidate.call_count)
+
     @mock.patch('curtin.block.wipe_file')
     def test_wipe_zero(self, mock_wipe_file):
         with simple_mocked_open():
             block.wipe_volume(self.dev, exclusive=True, mode='zero')
-            mock_wipe_file.assert_called_with(self.dev, exclusive=True)
+            mock_wipe_file.assert_called_with(self.dev, exclusive=True,
+                                              limiter=None)
 
     @mock.patch('curtin.block.wipe_file')
     def test_wipe_random(self, mock_wipe_file):
@@ -427,13 +600,134 @@ class TestWipeVolume(CiTestCase):
             block.wipe_volume(self.dev, mode='random')
             mock_open.assert_called_with('/dev/urandom', 'rb')
             mock_wipe_file.assert_called_with(
-                self.dev, exclusive=True,
+                self.dev, exclusive=True, limiter=None,
                 reader=mock_open.return_value.__enter__().read)
 
     def test_bad_input(self):
         with self.assertRaises(ValueError):
             block.wipe_volume(self.dev, mode='invalidmode')
 
+    @mock.patch('curtin.block.get_blockdev_queue_limit')
+    @mock.patch('curtin.block.is_block_device')
+    @mock.patch('curtin.block.wipe_file')
+    @mock.patch('curtin.block.ioctl_wipe_file')
+    def test_wipe_ioctl_modes(self, m_ioctl_wipe, m_wipe_file, m_is_block,
+                              m_limit):
+        m_is_block.return_value = True
+        m_limit.return_value = 2147450880
+        for mode, request in [('zeroout', block.BLKZEROOUT),
+                              ('discard', block.BLKDISCARD),
+                              ('fast-zero', block.BLKZEROOUT)]:
+            m_ioctl_wipe.reset_mock()
+            block.wipe_volume(self.dev, mode=mode, exclusive=False)
+            m_ioctl_wipe.assert_called_with(self.dev, request,
+                                            exclusive=False, limiter=None)
+        self.assertEqual(
+            [mock.call(self.dev, 'discard_max_bytes'),
+             mock.call(self.dev, 'write_zeroes_max_bytes')],
+            m_limit.call_args_list)
+        self.assertEqual(0, m_wipe_file.call_count)
+
+    @mock.patch('curtin.block.get_blockdev_queue_limit')
+    @mock.patch('curtin.block.is_block_device')
+    @mock.patch('curtin.block.wipe_file')
+    @mock.patch('curtin.block.ioctl_wipe_file')
+    def test_wipe_ioctl_modes_fall_back_when_unsupported(
+            self, m_ioctl_wipe, m_wipe_file, m_is_block, m_limit):
+        m_is_block.return_value = True
+        m_limit.return_value = 0
+        for mode in ['discard', 'fast-zero']:
+            block.wipe_volume(self.dev, mode=mode)
+        self.assertEqual(0, m_ioctl_wipe.call_count)
+        self.assertEqual(
+            [mock.call(self.dev, exclusive=True, limiter=None)] * 2,
+            m_wipe_file.call_args_list)
+
+    @mock.patch('curtin.block.is_block_device')
+    @mock.patch('curtin.block.wipe_file')
+    @mock.patch('curtin.block.ioctl_wipe_file')
+    def test_wipe_zeroout_falls_back_on_ioctl_error(
+            self, m_ioctl_wipe, m_wipe_file, m_is_block):
+        m_is_block.return_value = True
+        m_ioctl_wipe.side_effect = IOError(errno.EOPNOTSUPP, 'unsupported')
+        block.wipe_volume(self.dev, mode='zeroout')
+        m_wipe_file.assert_called_with(self.dev, exclusive=True, limiter=None)
+
+    @mock.patch('curtin.block.is_block_device')
+    @mock.patch('curtin.block.ioctl_wipe_file')
+    def test_wipe_zeroout_raises_other_errors(self, m_ioctl_wipe,
+                                              m_is_block):
+        m_is_block.return_value = True
+        m_ioctl_wipe.side_effect = IOError(errno.EIO, 'io error')
+        with self.assertRaises(IOError):
+            block.wipe_volume(self.dev, mode='zeroout')
+
+
+class TestWipeVolumes(CiTestCase):
+
+    def setUp(self):
+        super(TestWipeVolumes, self).setUp()
+        self.add_patch('curtin.block.wipe_volume', 'm_wipe')
+        self.add_patch('curtin.block.get_wipe_spindles', 'm_spindles')
+        self.add_patch('curtin.util.run_in_dependency_order', 'm_run')
+        self.spindles = {'/dev/sda': {'sda'}, '/dev/sdb': {'sdb'},
+                         '/dev/md0': {'sdc', 'sdd'}, '/dev/sdc1': {'sdc'},
+                         '/dev/mapper/mpatha': {'sde', 'sdf'},
+                         '/dev/sdf': {'sdf'}}
+        self.m_spindles.side_effect = lambda path: set(self.spindles[path])
+
+    def test_jobs_sharing_disks_run_in_order(self):
+        jobs = [('/dev/sda', 'zero'), ('/dev/md0', 'zero'),
+                ('/dev/sdf', 'superblock'), ('/dev/sdc1', 'random'),
+                ('/dev/mapper/mpatha', 'zero'), ('/dev/sdb', 'zero')]
+        block.wipe_volumes(jobs, max_workers=4)
+        self.m_run.assert_called_with(mock.ANY, mock.ANY,
+                                      depends={3: [1], 4: [2]},
+                                      max_workers=4)
+
+    def test_wipe_job_calls_wipe_volume_with_limiter(self):
+        block.wipe_volumes([('/dev/sda', 'zero')], bandwidth=1024 ** 2)
+        items, wipe_job = self.m_run.call_args[0]
+        self.assertEqual([0], list(items))
+        wipe_job(0)
+        self.m_wipe.assert_called_with('/dev/sda', mode='zero',
+                                       exclusive=True, strict=False,
+                                       limiter=mock.ANY)
+        limiter = self.m_wipe.call_args[1]['limiter']
+        self.assertEqual(1024 ** 2, limiter.bytes_per_second)
+
+
+class TestBandwidthLimiter(CiTestCase):
+
+    @mock.patch('curtin.block.time')
+    def test_consume_sleeps_when_over_rate(self, m_time):
+        m_time.time.return_value = 100.0
+        limiter = block.BandwidthLimiter(1000)
+        limiter.consume(500)
+        limiter.consume(1000)
+        limiter.consume(500)
+        self.assertEqual([mock.call(0.5), mock.call(1.5)],
+                         m_time.sleep.call_args_list)
+
+
+class TestIoctlWipeFile(CiTestCase):
+
+    @mock.patch('curtin.block.fcntl.ioctl')
+    @mock.patch('curtin.block.exclusive_open')
+    @mock.patch('curtin.block.util.file_size')
+    def test_ioctl_in_ranges(self, m_size, m_open, m_ioctl):
+        m_size.return_value = 5 * 1024
+        fileno = m_open.return_value.__enter__.return_value.fileno
+        fileno.return_value = 7
+        block.ioctl_wipe_file('/dev/vdb', block.BLKDISCARD, exclusive=False,
+                              range_bytes=2048)
+        m_open.assert_called_with('/dev/vdb', exclusive=False)
+        self.assertEqual(
+            [mock.call(7, block.BLKDISCARD, struct.pack('QQ', 0, 2048)),
+             mock.call(7, block.BLKDISCARD, struct.pack('QQ', 2048, 2048)),
+             mock.call(7, block.BLKDISCARD, struct.pack('QQ', 4096, 1024))],
+            m_ioctl.call_args_list)
+
 
 class TestBlockKnames(CiTestCase):
     """Tests for some of the kname functions in block"""
@@ -589,6 +883,30 @@ class TestPartTableSignature(CiTestCase):
         self.assertFalse(block.check_vtoc_signature(self.blockdev))
 
 
+class TestIsZfsMember(CiTestCase):
+
+    def setUp(self):
+        super(TestIsZfsMember, self).setUp()
+        self.add_patch('curtin.block.signatures.scan_signatures', 'm_scan')
+        self.add_patch('curtin.block._lsblock', 'm_lsblock')
+
+    def test_zfs_member(self):
+        self.m_scan.return_value = {'signatures': [
+            {'type': 'zfs_member', 'usage': 'filesystem', 'offset': 0}]}
+        self.assertTrue(block.is_zfs_member('/dev/vdb1'))
+        self.m_scan.assert_called_with('/dev/vdb1')
+        self.assertEqual(0, self.m_lsblock.call_count)
+
+    def test_not_zfs_member(self):
+        self.m_scan.return_value = {'signatures': [
+            {'type': 'ext4', 'usage': 'filesystem', 'offset': 1024}]}
+        self.assertFalse(block.is_zfs_member('/dev/vdb1'))
+
+    def test_unreadable_device_is_not_zfs_member(self):
+        self.m_scan.side_effect = IOError('No such device')
+        self.assertFalse(block.is_zfs_member('/dev/vdb1'))
+
+
 class TestNonAscii(CiTestCase):
     @mock.patch('curtin.block.util.subp')
     def test_lsblk(self, mock_subp):
@@ -825,6 +1143,8 @@ class TestSfdiskInfo(CiTestCase):
                        'm_get_blockdev_for_partition')
         self.add_patch('curtin.block.util.subp', 'm_subp')
         self.add_patch('curtin.block.util.load_json', 'm_load_json')
+        self.add_patch('curtin.block.read_partition_table',
+                       'm_read_partition_table', return_value=None)
         self.device = '/dev/vdb3'
         self.disk = '/dev/vdb'
         self.part = '3'
@@ -863,5 +1183,166 @@ class TestSfdiskInfo(CiTestCase):
             self.m_subp.call_args_list)
         self.assertEqual([], self.m_load_json.call_args_list)
 
+    def test_sfdisk_info_reads_partition_table_without_sfdisk(self):
+        """verify sfdisk_info does not run sfdisk if the table is read."""
+        self.m_read_partition_table.return_value = self.expected
+        self.assertEqual(self.expected, block.sfdisk_info(self.device))
+        self.assertEqual([mock.call(self.disk)],
+                         self.m_read_partition_table.call_args_list)
+        self.assertEqual([], self.m_subp.call_args_list)
+
+
+class TestRegisterPartitions(CiTestCase):
+
+    def setUp(self):
+        super(TestRegisterPartitions, self).setUp()
+        self.add_patch('curtin.block.read_partition_table', 'm_read_ptable')
+        self.add_patch('curtin.block.blkpg_partition', 'm_blkpg')
+        self.add_patch('curtin.block.rescan_block_devices', 'm_rescan')
+        self.add_patch('curtin.block._kernel_partitions', 'm_kernel_parts',
+                       return_value={})
+        self.disk = '/dev/sda'
+        self.m_read_ptable.return_value = {
+            'label': 'dos', 'device': self.disk, 'sectorsize': 512,
+            'partitions': [
+                {'node': '/dev/sda1', 'start': 2048, 'size': 4096,
+                 'type': '83'},
+                {'node': '/dev/sda2', 'start': 8192, 'size': 16384,
+                 'type': 'f'},
+                {'node': '/dev/sda5', 'start': 10240, 'size': 2048,
+                 'type': '83'}]}
+
+    def test_register_partitions(self):
+        block.register_partitions(self.disk, [1, 5])
+        self.assertEqual(
+            [mock.call(self.disk, block.BLKPG_ADD_PARTITION, 1, 2048 * 512,
+                       4096 * 512),
+             mock.call(self.disk, block.BLKPG_ADD_PARTITION, 5, 10240 * 512,
+                       2048 * 512)],
+            self.m_blkpg.call_args_list)
+        self.assertEqual(0, self.m_rescan.call_count)
+
+    @mock.patch('curtin.block.sysfs.invalidate')
+    def test_register_partitions_invalidates_sysfs_cache(self,
+                                                         m_invalidate):
+        block.register_partitions(self.disk, [1])
+        self.assertEqual(2, m_invalidate.call_count)
+
+    def test_register_partitions_resizes_existing_partition(self):
+        self.m_blkpg.side_effect = [OSError(errno.EBUSY, 'busy'), None]
+        block.register_partitions(self.disk, [1])
+        self.assertEqual(
+            [block.BLKPG_ADD_PARTITION, block.BLKPG_RESIZE_PARTITION],
+            [args[0][1] for args in self.m_blkpg.call_args_list])
+        self.assertEqual(0, self.m_rescan.call_count)
+
+    def test_register_partitions_rescans_on_failure(self):
+        self.m_blkpg.side_effect = OSError(errno.EINVAL, 'invalid')
+        block.register_partitions(self.disk, [1, 5])
+        self.assertEqual(1, self.m_blkpg.call_count)
+        self.m_rescan.assert_called_with([self.disk])
+
+    def test_register_partitions_rescans_for_extended_partitions(self):
+        block.register_partitions(self.disk, [2])
+        self.assertEqual(0, self.m_blkpg.call_count)
+        self.m_rescan.assert_called_with([self.disk])
+
+    def test_register_partitions_deletes_stale_partitions(self):
+        # partitions 3 and 6 are from a previous table, 2 is extended
+        self.m_kernel_parts.return_value = {
+            1: (2048, 4096), 2: (8192, 2), 3: (40960, 2048),
+            5: (10240, 2048), 6: (12288, 2048)}
+        block.register_partitions(self.disk, [1])
+        self.assertEqual(
+            [mock.call(self.disk, block.BLKPG_DEL_PARTITION, 3, 0, 0),
+             mock.call(self.disk, block.BLKPG_DEL_PARTITION, 6, 0, 0),
+             mock.call(self.disk, block.BLKPG_ADD_PARTITION, 1, 2048 * 512,
+                       4096 * 512)],
+            self.m_blkpg.call_args_list)
+        self.assertEqual(0, self.m_rescan.call_count)
+
+    def test_register_partitions_rescans_if_stale_partition_is_busy(self):
+        self.m_kernel_parts.return_value = {3: (40960, 2048)}
+        self.m_blkpg.side_effect = OSError(errno.EBUSY, 'busy')
+        block.register_partitions(self.disk, [1])
+        self.m_rescan.assert_called_with([self.disk])
+
+    def test_register_partitions_rescans_if_other_partition_differs(self):
+        self.m_kernel_parts.return_value = {5: (10240, 4096)}
+        block.register_partitions(self.disk, [1])
+        self.assertEqual(0, self.m_blkpg.call_count)
+        self.m_rescan.assert_called_with([self.disk])
+
+    def test_register_partitions_rescans_unknown_partition(self):
+        block.register_partitions(self.disk, [3])
+        self.m_rescan.assert_called_with([self.disk])
+        self.m_read_ptable.return_value = None
+        block.register_partitions(self.disk, [1])
+        self.assertEqual(2, self.m_rescan.call_count)
+        self.assertEqual(0, self.m_blkpg.call_count)
+
+
+class TestKernelPartitions(CiTestCase):
+
+    def test_kernel_partitions(self):
+        sysfs_dir = self.tmp_dir()
+        populate_dir(sysfs_dir, {
+            'sda/sda1/partition': '1\n', 'sda/sda1/start': '2048\n',
+            'sda/sda1/size': '4096\n', 'sda/size': '65536\n'})
+        with mock.patch('curtin.block.get_sysfs_partitions',
+                        return_value=[os.path.join(sysfs_dir, 'sda/sda1')]):
+            self.assertEqual({1: (2048, 4096)},
+                             block._kernel_partitions('/dev/sda'))
+
+
+class TestBlkpgPartition(CiTestCase):
+
+    @mock.patch('curtin.block.os.close')
+    @mock.patch('curtin.block.os.open')
+    @mock.patch('curtin.block.fcntl.ioctl')
+    def test_blkpg_partition(self, m_ioctl, m_open, m_close):
+        partitions = []
+
+        def ioctl(fd, request, arg):
+            (op, flags, datalen, data) = block.BLKPG_IOCTL_ARG.unpack(arg)
+            partitions.append((op, datalen, block.BLKPG_PARTITION.unpack(
+                ctypes.string_at(data, datalen))[:3]))
+
+        m_ioctl.side_effect = ioctl
+        block.blkpg_partition('/dev/sda', block.BLKPG_ADD_PARTITION, 3,
+                              1048576, 4096)
+        m_open.assert_called_with('/dev/sda', os.O_RDONLY)
+        m_ioctl.assert_called_with(m_open.return_value, block.BLKPG,
+                                   mock.ANY)
+        m_close.assert_called_with(m_open.return_value)
+        self.assertEqual(
+            [(block.BLKPG_ADD_PARTITION, 152, (1048576, 4096, 3))],
+            partitions)
+
+
+class TestReadPartitionTable(CiTestCase):
+
+    def setUp(self):
+        super(TestReadPartitionTable, self).setUp()
+        self.add_patch('curtin.block.util.load_file', 'm_load_file',
+                       return_value='4096\n')
+        self.add_patch('curtin.block.sys_block_path', 'm_sys_block_path')
+        self.add_patch('curtin.block.partition_table.read_partition_table',
+                       'm_read')
+
+    def test_read_partition_table(self):
+        self.assertEqual(self.m_read.return_value,
+                         block.read_partition_table('/dev/sda'))
+        self.m_read.assert_called_with('/dev/sda', 4096)
+
+    def test_read_partition_table_skips_device_mapper(self):
+        self.assertIsNone(block.read_partition_table('/dev/dm-0'))
+        self.assertEqual([], self.m_read.call_args_list)
+
+    def test_read_partition_table_returns_none_on_errors(self):
+        for error in (IOError('no such device'), ValueError('bad crc')):
+            self.m_read.side_effect = error
+            self.assertIsNone(block.read_partition_table('/dev/sda'))
+
 
 # vi: ts=4 expandtab syntax=python
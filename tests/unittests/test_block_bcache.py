@@ -445,4 +445,44 @@ class TestBlockBcache(CiTestCase):
         m_wait.assert_called_with(stop_path, retries=bcache.BCACHE_RETRIES)
 
 
+class TestReadSuperblock(CiTestCase):
+
+    def setUp(self):
+        super(TestReadSuperblock, self).setUp()
+        self.add_patch('curtin.block.bcache.get_signatures', 'm_signatures')
+
+    def test_read_superblock_backing(self):
+        """read_superblock matches the bcache-super-show keys it has."""
+        self.m_signatures.return_value = {'signatures': [
+            {'type': 'bcache', 'usage': 'other', 'offset': 4096,
+             'version': 1, 'role': 'backing',
+             'uuid': 'f36394c0-3cc0-4423-8d6f-ffac130f171a',
+             'set_uuid': '01da3829-ea92-4600-bd40-7f95974f3087',
+             'cache_mode': 'writeback'}]}
+        sbdict = bcache.read_superblock('/dev/vdb')
+        expected = TestBlockBcache.expected['backing']
+        self.assertEqual(dict((key, expected[key]) for key in sbdict),
+                         sbdict)
+        self.assertEqual(
+            ['cset.uuid', 'dev.data.cache_mode', 'dev.label', 'dev.uuid',
+             'sb.magic', 'sb.version'], sorted(sbdict))
+        self.m_signatures.assert_called_with('/dev/vdb')
+
+    def test_read_superblock_caching(self):
+        self.m_signatures.return_value = {'signatures': [
+            {'type': 'bcache', 'usage': 'other', 'offset': 4096,
+             'version': 3, 'role': 'caching', 'label': 'cache'}]}
+        sbdict = bcache.read_superblock('/dev/vdc')
+        self.assertEqual('3 [caching device]', sbdict['sb.version'])
+        self.assertEqual('cache', sbdict['dev.label'])
+        self.assertNotIn('dev.data.cache_mode', sbdict)
+
+    def test_read_superblock_none_without_bcache(self):
+        self.m_signatures.return_value = {'signatures': [
+            {'type': 'ext4', 'usage': 'filesystem', 'offset': 1024}]}
+        self.assertIsNone(bcache.read_superblock('/dev/vdb'))
+        self.m_signatures.return_value = None
+        self.assertIsNone(bcache.read_superblock('/dev/vdb'))
+
+
 # vi: ts=4 expandtab syntax=python
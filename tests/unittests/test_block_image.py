@@ -0,0 +1,593 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import bz2
+import errno
+import gzip
+import hashlib
+import io
+import mock
+import os
+import struct
+import tarfile
+import zlib
+from unittest import skipIf
+
+try:
+    import lzma
+except ImportError:
+    # python2
+    lzma = None
+
+from .helpers import CiTestCase
+from curtin import block, url_helper
+from curtin.block import image
+
+# an image which is not a multiple of the block size, nor all zeroes
+IMAGE = (b'\0' * 10000 + os.urandom(5000) + b'curtin' * 1000)
+
+
+def gzip_data(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as fp:
+        fp.write(data)
+    return out.getvalue()
+
+
+def tar_data(data, mode='w', extra=None):
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode=mode) as tar:
+        info = tarfile.TarInfo('dir')
+        info.type = tarfile.DIRTYPE
+        tar.addfile(info)
+        info = tarfile.TarInfo('dir/disk.img')
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+        if extra is not None:
+            info = tarfile.TarInfo('dir/README')
+            info.size = len(extra)
+            tar.addfile(info, io.BytesIO(extra))
+    return out.getvalue()
+
+
+class TestWriteImage(CiTestCase):
+
+    def setUp(self):
+        super(TestWriteImage, self).setUp()
+        self.target = self.tmp_path('disk')
+        with open(self.target, 'wb') as fp:
+            fp.truncate(64 * 1024)
+
+    def _write(self, stype, data, **source):
+        path = self.tmp_path('image')
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        mirrors = source.pop('mirrors', None)
+        source.update({'type': stype, 'uri': 'file://' + path})
+        return image.write_image(source, self.target, block_size=4096,
+                                 mirrors=mirrors)
+
+    def _written(self, length=len(IMAGE)):
+        with open(self.target, 'rb') as fp:
+            return fp.read(length)
+
+    def test_formats(self):
+        formats = [('dd-raw', IMAGE),
+                   ('dd-gz', gzip_data(IMAGE)),
+                   ('dd-bz2', bz2.compress(IMAGE)),
+                   ('dd-tgz', gzip_data(tar_data(IMAGE))),
+                   ('dd-tbz', bz2.compress(tar_data(IMAGE))),
+                   ('dd-tar', tar_data(IMAGE)),
+                   ('dd-tar', tar_data(IMAGE, mode='w:bz2'))]
+        if lzma:
+            formats += [('dd-xz', lzma.compress(IMAGE)),
+                        ('dd-txz', lzma.compress(tar_data(IMAGE)))]
+        for stype, data in formats:
+            with open(self.target, 'wb') as fp:
+                fp.truncate(64 * 1024)
+            stats = self._write(stype, data)
+            self.assertEqual(IMAGE, self._written(), stype)
+            self.assertEqual(len(IMAGE), stats['bytes'])
+
+    def test_concatenated_streams(self):
+        half = len(IMAGE) // 2
+        self._write('dd-gz', gzip_data(IMAGE[:half]) + gzip_data(IMAGE[half:]))
+        self.assertEqual(IMAGE, self._written())
+        self._write('dd-bz2', (bz2.compress(IMAGE[:half]) +
+                               bz2.compress(IMAGE[half:])))
+        self.assertEqual(IMAGE, self._written())
+
+    @skipIf(lzma is None, 'lzma not available')
+    def test_decompressed_output_is_bounded(self):
+        zeroes = b'\0' * (8 * image.IMAGE_CHUNK_SIZE)
+        for compression, data in (('gz', gzip_data(zeroes)),
+                                  ('bz2', bz2.compress(zeroes)),
+                                  ('xz', lzma.compress(zeroes))):
+            chunks = list(image._decompress([data], compression))
+            self.assertEqual(zeroes, b''.join(chunks))
+            self.assertLessEqual(max(len(c) for c in chunks),
+                                 image.IMAGE_CHUNK_SIZE)
+
+    @skipIf(lzma is None, 'lzma not available')
+    def test_truncated_image_raises(self):
+        data = lzma.compress(IMAGE)
+        with self.assertRaisesRegexp(ValueError, 'truncated'):
+            self._write('dd-xz', data[:len(data) // 2])
+
+    def test_checksum(self):
+        data = gzip_data(IMAGE)
+        digest = hashlib.sha256(data).hexdigest()
+        self._write('dd-gz', data, checksum='sha256:' + digest.upper())
+        self.assertEqual(IMAGE, self._written())
+        with self.assertRaisesRegexp(ValueError, 'sha256 checksum of'):
+            self._write('dd-gz', data, checksum='sha256:' + '0' * 64)
+        with self.assertRaisesRegexp(ValueError, 'not of the form'):
+            self._write('dd-gz', data, checksum=digest)
+
+    def test_checksum_covers_files_after_the_image(self):
+        data = tar_data(IMAGE, extra=os.urandom(4 * image.IMAGE_CHUNK_SIZE))
+        digest = hashlib.sha256(data).hexdigest()
+        self._write('dd-tar', data, checksum='sha256:' + digest)
+        self.assertEqual(IMAGE, self._written())
+        with self.assertRaisesRegexp(ValueError, 'sha256 checksum of'):
+            self._write('dd-tar', data[:-512] + b'\1' * 512,
+                        checksum='sha256:' + digest)
+
+    def test_missing_image_raises(self):
+        with self.assertRaises(IOError):
+            image.write_image({'type': 'dd-raw',
+                               'uri': self.tmp_path('missing')}, self.target)
+
+    def _mirror(self, name):
+        path = self.tmp_path(name)
+        with open(path, 'wb') as fp:
+            fp.truncate(64 * 1024)
+        return path
+
+    def test_mirrors(self):
+        mirrors = [self._mirror('mirror1'), self._mirror('mirror2')]
+        stats = self._write('dd-gz', gzip_data(IMAGE), mirrors=mirrors)
+        self.assertEqual(IMAGE, self._written())
+        for mirror in mirrors:
+            with open(mirror, 'rb') as fp:
+                self.assertEqual(IMAGE, fp.read(len(IMAGE)))
+            self.assertEqual(len(IMAGE), stats['mirrors'][mirror]['bytes'])
+
+    def test_failing_mirror_is_isolated(self):
+        mirror = self._mirror('mirror')
+        missing = self.tmp_path('missing/disk')
+        stats = self._write('dd-raw', IMAGE, mirrors=[missing, mirror])
+        self.assertEqual(IMAGE, self._written())
+        with open(mirror, 'rb') as fp:
+            self.assertEqual(IMAGE, fp.read(len(IMAGE)))
+        self.assertIn('error', stats['mirrors'][missing])
+        self.assertEqual(len(IMAGE), stats['mirrors'][mirror]['bytes'])
+
+    def test_failing_target_raises(self):
+        mirror = self._mirror('mirror')
+        self.target = self.tmp_path('missing/disk')
+        with self.assertRaises(OSError):
+            self._write('dd-raw', IMAGE, mirrors=[mirror])
+        with self.assertRaisesRegexp(ValueError, 'mirror of itself'):
+            self._write('dd-raw', IMAGE, mirrors=[self.target])
+
+    def test_supported(self):
+        self.assertTrue(image.supported('dd-tgz'))
+        self.assertFalse(image.supported('tgz'))
+        with mock.patch('curtin.block.image.zstandard', None):
+            self.assertFalse(image.supported('dd-zst'))
+
+
+class TestBlockWriter(CiTestCase):
+
+    zero = b'\0' * 4096
+    data = b'\x01' * 4096
+    # data, zeroes spanning two blocks of 16KiB, data, then zeroes at the
+    # end of which three pieces aligned to 4KiB are found
+    image = data + zero * 6 + data[:100] + zero[:100] + data + zero * 4
+
+    def setUp(self):
+        super(TestBlockWriter, self).setUp()
+        self.target = self.tmp_path('disk')
+        self.add_patch('curtin.block.image.block.is_block_device',
+                       'm_is_block')
+        self.m_is_block.return_value = False
+        self.add_patch('curtin.block.image.block.get_blockdev_queue_limit',
+                       'm_limit')
+        self.limits = {}
+        self.m_limit.side_effect = lambda path, name: self.limits.get(name, 0)
+        self.add_patch('curtin.block.image.fcntl.ioctl', 'm_ioctl')
+
+    def _target(self, content):
+        with open(self.target, 'wb') as fp:
+            fp.write(content)
+
+    def _write(self, zero_blocks, chunk=5000):
+        writer = image._BlockWriter(self.target, block_size=16384,
+                                    zero_blocks=zero_blocks, zero_size=4096)
+        with writer:
+            for pos in range(0, len(self.image), chunk):
+                writer.write(self.image[pos:pos + chunk])
+        with open(self.target, 'rb') as fp:
+            return writer, fp.read()
+
+    def test_write(self):
+        self._target(b'\xff' * 8192)
+        writer, content = self._write('write')
+        self.assertEqual(self.image, content)
+        self.assertEqual(0, writer.zeroed)
+
+    def test_punch_file_skips_zeroes_past_its_end(self):
+        self._target(b'\xff' * 8192)
+        writer, content = self._write('punch')
+        self.assertEqual(self.image, content)
+        # only the zeroes before the end of the file are written
+        self.assertEqual(4096 * 8, writer.zeroed)
+        self.assertEqual(0, self.m_ioctl.call_count)
+
+    def test_zero_device_file(self):
+        self._target(b'\xff' * len(self.image))
+        writer, content = self._write('zero-device')
+        self.assertEqual(self.image, content)
+        self.assertEqual(4096 * 9, writer.zeroed)
+
+    def test_punch_device_with_zeroout(self):
+        self.m_is_block.return_value = True
+        self.limits['write_zeroes_max_bytes'] = 1024 * 1024
+        self._target(b'\xff' * len(self.image))
+        writer, content = self._write('punch')
+        self.assertEqual(
+            [mock.call(mock.ANY, block.BLKZEROOUT,
+                       struct.pack('QQ', 4096, 4096 * 6)),
+             mock.call(mock.ANY, block.BLKZEROOUT,
+                       struct.pack('QQ', 4096 * 9, 4096 * 3))],
+            self.m_ioctl.call_args_list)
+        self.assertEqual(4096 * 9, writer.zeroed)
+        # the data pieces are written, partial pieces of zeroes too
+        self.assertEqual(self.data, content[:4096])
+        self.assertEqual(self.data[:100] + self.zero[:100] + self.data,
+                         content[4096 * 7:4096 * 8 + 200])
+
+    def test_punch_device_with_discard_only_if_it_zeroes(self):
+        self.m_is_block.return_value = True
+        self.limits['discard_max_bytes'] = 1024 * 1024
+        self._target(b'\xff' * len(self.image))
+        writer, content = self._write('punch')
+        self.assertEqual(0, self.m_ioctl.call_count)
+        self.assertEqual(self.image, content)
+        self.limits['discard_zeroes_data'] = 1
+        writer, content = self._write('punch')
+        self.assertEqual(block.BLKDISCARD, self.m_ioctl.call_args[0][1])
+
+    def test_punch_device_falls_back_to_writing(self):
+        self.m_is_block.return_value = True
+        self.limits['write_zeroes_max_bytes'] = 1024 * 1024
+        self.m_ioctl.side_effect = IOError(errno.EOPNOTSUPP, 'no')
+        self._target(b'\xff' * len(self.image))
+        writer, content = self._write('punch')
+        self.assertEqual(self.image, content)
+        self.assertEqual(0, writer.zeroed)
+        self.assertEqual(1, self.m_ioctl.call_count)
+
+    def test_zero_device_block_device(self):
+        self.m_is_block.return_value = True
+        self.limits['write_zeroes_max_bytes'] = 1024 * 1024
+        self._target(b'\xff' * len(self.image))
+        with mock.patch('curtin.block.image.block.ioctl_wipe_file') as m_wipe:
+            writer, content = self._write('zero-device')
+        m_wipe.assert_called_with(self.target, block.BLKZEROOUT,
+                                  exclusive=False)
+        self.assertEqual(4096 * 9, writer.zeroed)
+        self.assertEqual(0, self.m_ioctl.call_count)
+
+    def test_zero_device_without_write_zeroes_falls_back_to_punch(self):
+        self.m_is_block.return_value = True
+        self._target(b'\xff' * len(self.image))
+        with mock.patch('curtin.block.image.block.ioctl_wipe_file') as m_wipe:
+            writer, content = self._write('zero-device')
+        self.assertEqual(0, m_wipe.call_count)
+        self.assertEqual(0, self.m_ioctl.call_count)
+        # without discard either, the zeroes of the image are written
+        self.assertEqual(self.image, content)
+        self.assertEqual(0, writer.zeroed)
+
+    def test_unknown_mode_raises(self):
+        self._target(b'')
+        with self.assertRaisesRegexp(ValueError, 'unknown zero_blocks'):
+            self._write('trim')
+
+
+def qcow2_image(size, clusters, cluster_bits=12, backing=False):
+    """ Build a version 3 qcow2 image of size with guest clusters given as
+        {index: ('data', bytes) or ('compressed', bytes) or ('zero',)}. """
+    cluster_size = 1 << cluster_bits
+    l2_size = cluster_size // 8
+    l1 = [0] * (-(-size // (cluster_size * l2_size)))
+    l2_tables = {}
+    for index in sorted(clusters):
+        l2_tables.setdefault(index // l2_size, [0] * l2_size)
+    # header, l1 table, l2 tables then clusters
+    host = (2 + len(l2_tables)) * cluster_size
+    body = b''
+    for table, l1_index in enumerate(sorted(l2_tables)):
+        l1[l1_index] = (2 + table) * cluster_size | 1 << 63
+    for index in sorted(clusters):
+        l2 = l2_tables[index // l2_size]
+        kind = clusters[index][0]
+        if kind == 'zero':
+            l2[index % l2_size] = 1
+        elif kind == 'data':
+            # data clusters are aligned, compressed ones need not be
+            body = body.ljust(-(-len(body) // cluster_size) * cluster_size,
+                              b'\0')
+            l2[index % l2_size] = (host + len(body)) | 1 << 63
+            body += clusters[index][1]
+        else:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -12)
+            data = compressor.compress(clusters[index][1]) + compressor.flush()
+            offset = host + len(body)
+            sectors = ((offset + len(data) - 1) >> 9) - (offset >> 9)
+            sectors <<= 62 - (cluster_bits - 8)
+            l2[index % l2_size] = 1 << 62 | sectors | offset
+            body += data
+    header = struct.pack('>4sIQIIQIIQQIIQ', b'QFI\xfb', 3,
+                         512 if backing else 0, 0, cluster_bits, size, 0,
+                         len(l1), cluster_size, 0, 0, 0, 0)
+    header += struct.pack('>QQQII', 0, 0, 0, 4, 104)
+    tables = b''.join(struct.pack('>%dQ' % len(l2_tables[i]), *l2_tables[i])
+                      for i in sorted(l2_tables))
+    return (header.ljust(cluster_size, b'\0') +
+            struct.pack('>%dQ' % len(l1), *l1).ljust(cluster_size, b'\0') +
+            tables + body)
+
+
+def sparse_chunk(chunk_type, blocks, payload=b''):
+    return struct.pack('<HHII', chunk_type, 0, blocks,
+                       12 + len(payload)) + payload
+
+
+def sparse_image(chunks, blocks):
+    return struct.pack('<IHHHHIIII', 0xed26ff3a, 1, 0, 28, 12, 4096, blocks,
+                       len(chunks), 0) + b''.join(chunks)
+
+
+class TestSparseImages(CiTestCase):
+
+    def setUp(self):
+        super(TestSparseImages, self).setUp()
+        self.target = self.tmp_path('disk')
+
+    def _write(self, stype, data, target=b'', **source):
+        with open(self.target, 'wb') as fp:
+            fp.write(target)
+        path = self.tmp_path('image')
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        source.update({'type': stype, 'uri': path})
+        stats = image.write_image(source, self.target, block_size=16384)
+        with open(self.target, 'rb') as fp:
+            return stats, fp.read()
+
+    def test_qcow2(self):
+        a, b, c, d = (bytes(bytearray([n])) * 4096 for n in range(1, 5))
+        clusters = {0: ('data', a), 1: ('data', b), 2: ('zero',),
+                    3: ('compressed', c), 4: ('compressed', d),
+                    # the second l2 table, after a cluster with no entry
+                    600: ('data', a)}
+        size = 600 * 4096 + 1000
+        stats, content = self._write('dd-qcow2', qcow2_image(size, clusters),
+                                     target=b'\xff' * 4096 * 2)
+        self.assertEqual(size, len(content))
+        expected = a + b + b'\0' * 4096 + c + d
+        self.assertEqual(expected, content[:len(expected)])
+        self.assertEqual(b'\0' * (595 * 4096),
+                         content[len(expected):600 * 4096])
+        self.assertEqual(a[:1000], content[600 * 4096:])
+        self.assertEqual(size, stats['bytes'])
+        # the zero clusters past the end of the file are not written
+        self.assertEqual(596 * 4096, stats['zeroed'])
+
+    def test_qcow2_runs(self):
+        clusters = [('data', 0x10000, 4096), ('data', 0x11000, 4096),
+                    ('data', 0x20000, 4096), ('zero', None, 0),
+                    ('zero', None, 0), ('compressed', 0x30000, 700),
+                    ('compressed', 0x302bc, 900)]
+        self.assertEqual(
+            [['data', 2, 0x10000, 0x12000,
+              [(0x10000, 4096), (0x11000, 4096)]],
+             ['data', 1, 0x20000, 0x21000, [(0x20000, 4096)]],
+             ['zero', 2, None, None, [(None, 0)]],
+             ['compressed', 2, 0x30000, 0x30640,
+              [(0x30000, 700), (0x302bc, 900)]]],
+            list(image._qcow2_runs(clusters)))
+
+    def test_qcow2_unsupported(self):
+        with self.assertRaisesRegexp(ValueError, 'backing file'):
+            self._write('dd-qcow2', qcow2_image(4096, {}, backing=True))
+        with self.assertRaisesRegexp(ValueError, 'not a qcow2 image'):
+            self._write('dd-qcow2', IMAGE)
+        with self.assertRaisesRegexp(ValueError, 'checksum is not supported'):
+            self._write('dd-qcow2', qcow2_image(4096, {}),
+                        checksum='sha256:00')
+
+    def test_android_sparse(self):
+        data = os.urandom(4096 * 2)
+        chunks = [sparse_chunk(0xcac1, 2, data),
+                  sparse_chunk(0xcac2, 1, b'\xaa\xbb\xcc\xdd'),
+                  sparse_chunk(0xcac3, 2),
+                  sparse_chunk(0xcac2, 1, b'\0\0\0\0'),
+                  sparse_chunk(0xcac4, 0, b'\0\0\0\0')]
+        stats, content = self._write('dd-sparse', sparse_image(chunks, 6),
+                                     target=b'\xff' * 4096 * 6)
+        self.assertEqual(data + b'\xaa\xbb\xcc\xdd' * 1024 +
+                         b'\xff' * 8192 + b'\0' * 4096, content)
+        self.assertEqual(8192, stats['skipped'])
+        self.assertEqual(4096 * 6, stats['bytes'])
+
+    def test_android_sparse_invalid(self):
+        with self.assertRaisesRegexp(ValueError, 'not an android sparse'):
+            self._write('dd-sparse', IMAGE)
+        chunks = [sparse_chunk(0xcac1, 2, b'short')]
+        with self.assertRaisesRegexp(ValueError, 'invalid'):
+            self._write('dd-sparse', sparse_image(chunks, 2))
+
+    def _bmap(self, ranges, image_size, checksums=True):
+        xml = ['<?xml version="1.0" ?>', '<bmap version="2.0">',
+               '<ImageSize> %s </ImageSize>' % image_size,
+               '<BlockSize> 4096 </BlockSize>',
+               '<ChecksumType> sha256 </ChecksumType>', '<BlockMap>']
+        for first, last in ranges:
+            digest = hashlib.sha256(
+                IMAGE[first * 4096:(last + 1) * 4096]).hexdigest()
+            text = '%s-%s' % (first, last) if last != first else str(first)
+            xml.append('<Range chksum="%s"> %s </Range>' %
+                       (digest if checksums else '0' * 64, text))
+        xml += ['</BlockMap>', '</bmap>']
+        path = self.tmp_path('image.bmap')
+        with open(path, 'w') as fp:
+            fp.write('\n'.join(xml))
+        return path
+
+    def test_bmap(self):
+        # IMAGE is 21000 bytes, 6 blocks of 4096, the last partial
+        bmap = self._bmap([(0, 0), (2, 3), (5, 5)], len(IMAGE))
+        stats, content = self._write('dd-gz', gzip_data(IMAGE),
+                                     target=b'\xff' * len(IMAGE), bmap=bmap)
+        for start, end in ((0, 4096), (8192, 16384), (20480, len(IMAGE))):
+            self.assertEqual(IMAGE[start:end], content[start:end])
+        self.assertEqual(b'\xff' * 4096, content[4096:8192])
+        self.assertEqual(b'\xff' * 4096, content[16384:20480])
+        self.assertEqual(8192, stats['skipped'])
+
+    def test_bmap_checksum_mismatch(self):
+        bmap = self._bmap([(0, 1)], len(IMAGE), checksums=False)
+        with self.assertRaisesRegexp(ValueError, 'does not match'):
+            self._write('dd-raw', IMAGE, bmap=bmap)
+
+    def test_bmap_only_for_raw_images(self):
+        bmap = self._bmap([(0, 1)], len(IMAGE))
+        with self.assertRaisesRegexp(ValueError, 'only supported for raw'):
+            self._write('dd-tar', tar_data(IMAGE), bmap=bmap)
+
+
+class TestStage(CiTestCase):
+
+    def test_passes_chunks_in_order(self):
+        stage = image._Stage('test', iter([b'a', b'b', b'c'])).start()
+        self.assertEqual([b'a', b'b', b'c'], list(stage))
+
+    def test_error_is_raised_to_consumer(self):
+        def chunks():
+            yield b'a'
+            raise ValueError('broken')
+
+        stage = image._Stage('test', chunks()).start()
+        with self.assertRaisesRegexp(ValueError, 'broken'):
+            list(stage)
+
+    def test_stop_releases_blocked_producer(self):
+        def chunks():
+            while True:
+                yield b'a'
+
+        stage = image._Stage('test', chunks(), depth=1).start()
+        self.assertEqual(b'a', next(iter(stage)))
+        stage.stop()
+        stage.join()
+
+    def test_drain_reads_what_the_consumer_left(self):
+        seen = []
+
+        def chunks():
+            for data in (b'a', b'b', b'c'):
+                seen.append(data)
+                yield data
+
+        stage = image._Stage('test', chunks(), depth=1).start()
+        self.assertEqual(b'a', next(iter(stage)))
+        stage.drain()
+        self.assertEqual([b'a', b'b', b'c'], seen)
+        # an exhausted stage is not waited on again
+        stage.drain()
+        stage.join()
+
+
+class FakeReader(object):
+    """ A UrlReader whose reads return data and then raise error. """
+
+    def __init__(self, data, error=None, code=200):
+        self.data = io.BytesIO(data)
+        self.error = error
+        self.fp = mock.Mock()
+        self.fp.getcode.return_value = code
+
+    def read(self, size):
+        data = self.data.read(size)
+        if not data and self.error:
+            raise self.error
+        return data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        pass
+
+
+class TestFetch(CiTestCase):
+
+    def setUp(self):
+        super(TestFetch, self).setUp()
+        self.add_patch('curtin.block.image.url_helper.UrlReader', 'm_reader')
+        self.add_patch('curtin.block.image.time.sleep', 'm_sleep')
+
+    def test_resumes_interrupted_download(self):
+        dropped = url_helper.UrlError(IOError('connection reset'))
+        self.m_reader.side_effect = [
+            FakeReader(IMAGE[:5000], error=dropped),
+            FakeReader(IMAGE[5000:], code=206)]
+        self.assertEqual(IMAGE, b''.join(image._fetch('http://host/img')))
+        self.assertEqual(
+            [mock.call('http://host/img', headers=None),
+             mock.call('http://host/img', headers={'Range': 'bytes=5000-'})],
+            self.m_reader.call_args_list)
+
+    def test_reads_range(self):
+        self.m_reader.side_effect = [FakeReader(IMAGE[10:20], code=206)]
+        self.assertEqual(IMAGE[10:20], image._read_range('http://host/img',
+                                                         10, 10))
+        self.m_reader.assert_called_with(
+            'http://host/img', headers={'Range': 'bytes=10-19'})
+
+    def test_reads_range_of_file(self):
+        path = self.tmp_path('image')
+        with open(path, 'wb') as fp:
+            fp.write(IMAGE)
+        self.assertEqual(IMAGE[10:20], image._read_range(path, 10, 10))
+        self.assertEqual(IMAGE[-5:], image._read_range(
+            'file://' + path, len(IMAGE) - 5, 10, exact=False))
+        with self.assertRaisesRegexp(ValueError, 'short read'):
+            image._read_range(path, len(IMAGE) - 5, 10)
+
+    def test_server_without_ranges_raises(self):
+        dropped = url_helper.UrlError(IOError('connection reset'))
+        self.m_reader.side_effect = [
+            FakeReader(IMAGE[:5000], error=dropped), FakeReader(IMAGE)]
+        with self.assertRaisesRegexp(ValueError, 'range requests'):
+            b''.join(image._fetch('http://host/img'))
+
+    def test_client_errors_are_not_retried(self):
+        self.m_reader.side_effect = url_helper.UrlError(
+            IOError('not found'), code=404)
+        with self.assertRaises(url_helper.UrlError):
+            b''.join(image._fetch('http://host/img'))
+        self.assertEqual(1, self.m_reader.call_count)
+
+    def test_gives_up_after_retries(self):
+        self.m_reader.side_effect = url_helper.UrlError(
+            IOError('unavailable'), code=503)
+        with self.assertRaises(url_helper.UrlError):
+            b''.join(image._fetch('http://host/img', retries=2))
+        self.assertEqual(3, self.m_reader.call_count)
+
+
+# vi: ts=4 expandtab syntax=python
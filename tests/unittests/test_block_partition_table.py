@@ -0,0 +1,182 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import struct
+import uuid
+import zlib
+
+from .helpers import CiTestCase
+from curtin.block import partition_table
+
+MiB = 1024 * 1024
+LINUX_GUID = uuid.UUID('0fc63daf-8483-4772-8e79-3d69d8477de4')
+ESP_GUID = uuid.UUID('c12a7328-f81f-11d2-ba4b-00a0c93ec93b')
+DISK_GUID = uuid.UUID('877716f7-31d0-4d56-a1ed-4d566efe418e')
+PART_GUID = uuid.UUID('60541caf-e2ac-48cd-bf89-af16051c833f')
+
+
+def gpt_header(lba, alternate, entries_lba, entries, last_lba):
+    header = bytearray(92)
+    struct.pack_into('<8sIII', header, 0, b'EFI PART', 0x10000, 92, 0)
+    struct.pack_into('<QQQQ16sQIII', header, 24, lba, alternate, 34,
+                     last_lba - 33, DISK_GUID.bytes_le, entries_lba, 128,
+                     128, zlib.crc32(entries) & 0xffffffff)
+    struct.pack_into('<I', header, 16, zlib.crc32(bytes(header)) & 0xffffffff)
+    return bytes(header)
+
+
+def gpt_entries(parts):
+    entries = bytearray(128 * 128)
+    for index, (type_guid, first, last, attrs, name) in parts.items():
+        struct.pack_into('<16s16sQQQ72s', entries, (index - 1) * 128,
+                         type_guid.bytes_le, PART_GUID.bytes_le, first, last,
+                         attrs, name.encode('utf-16-le'))
+    return bytes(entries)
+
+
+def mbr_entry(boot, ptype, start, sectors):
+    return struct.pack('<B3sB3sII', boot, b'\0' * 3, ptype, b'\0' * 3, start,
+                       sectors)
+
+
+def mbr(entries, disk_id=0):
+    sector = bytearray(512)
+    struct.pack_into('<I', sector, 0x1b8, disk_id)
+    for slot, entry in enumerate(entries):
+        sector[0x1be + 16 * slot:0x1be + 16 * (slot + 1)] = entry
+    sector[0x1fe:0x200] = b'\x55\xaa'
+    return bytes(sector)
+
+
+class TestReadPartitionTable(CiTestCase):
+
+    size = 64 * MiB
+
+    def _image(self, writes):
+        path = self.tmp_path('disk')
+        with open(path, 'wb') as fp:
+            fp.truncate(self.size)
+            for offset, data in writes:
+                fp.seek(offset)
+                fp.write(data)
+        return path
+
+    def _gpt(self, primary=True, backup=True, pmbr=True):
+        last_lba = self.size // 512 - 1
+        entries = gpt_entries({
+            1: (ESP_GUID, 2048, 4095, 0, 'esp'),
+            3: (LINUX_GUID, 4096, 8191, 1 << 2 | 1 << 60, ''),
+        })
+        writes = []
+        if pmbr:
+            writes += [(0, mbr([mbr_entry(0, 0xee, 1, last_lba)]))]
+        if primary:
+            writes += [(512, gpt_header(1, last_lba, 2, entries, last_lba)),
+                       (1024, entries)]
+        if backup:
+            writes += [(last_lba * 512,
+                        gpt_header(last_lba, 1, last_lba - 32, entries,
+                                   last_lba)),
+                       ((last_lba - 32) * 512, entries)]
+        return writes
+
+    def _read(self, writes, disk='/dev/vda'):
+        return partition_table.read_partition_table(
+            disk, path=self._image(writes))
+
+    def test_no_partition_table(self):
+        self.assertIsNone(self._read([]))
+
+    def test_gpt(self):
+        self.assertEqual({
+            'label': 'gpt',
+            'id': '877716F7-31D0-4D56-A1ED-4D566EFE418E',
+            'device': '/dev/vda',
+            'unit': 'sectors',
+            'firstlba': 34,
+            'lastlba': self.size // 512 - 34,
+            'sectorsize': 512,
+            'partitions': [
+                {'node': '/dev/vda1', 'start': 2048, 'size': 2048,
+                 'type': 'C12A7328-F81F-11D2-BA4B-00A0C93EC93B',
+                 'uuid': '60541CAF-E2AC-48CD-BF89-AF16051C833F',
+                 'name': 'esp'},
+                {'node': '/dev/vda3', 'start': 4096, 'size': 4096,
+                 'type': '0FC63DAF-8483-4772-8E79-3D69D8477DE4',
+                 'uuid': '60541CAF-E2AC-48CD-BF89-AF16051C833F',
+                 'attrs': 'LegacyBIOSBootable GUID:60'},
+            ]}, self._read(self._gpt()))
+
+    def test_gpt_partition_nodes_of_disks_ending_in_a_digit(self):
+        table = self._read(self._gpt(), disk='/dev/nvme0n1')
+        self.assertEqual(['/dev/nvme0n1p1', '/dev/nvme0n1p3'],
+                         [part['node'] for part in table['partitions']])
+
+    def test_gpt_uses_backup_header_if_primary_is_damaged(self):
+        writes = self._gpt() + [(1024 + 10, b'\xff')]
+        table = self._read(writes)
+        self.assertEqual(2, len(table['partitions']))
+        table = self._read(self._gpt(primary=False))
+        self.assertEqual(2, len(table['partitions']))
+
+    def test_gpt_checksum_mismatch_raises(self):
+        with self.assertRaisesRegexp(ValueError, 'checksum mismatch'):
+            self._read(self._gpt(backup=False) + [(512 + 40, b'\x01')])
+        with self.assertRaisesRegexp(ValueError, 'entries checksum mismatch'):
+            self._read(self._gpt(backup=False) + [(1024 + 10, b'\xff')])
+
+    def test_gpt_is_preferred_over_protective_mbr(self):
+        self.assertEqual('gpt', self._read(self._gpt())['label'])
+
+    def test_gpt_with_hybrid_mbr(self):
+        writes = self._gpt(pmbr=False) + [
+            (0, mbr([mbr_entry(0x80, 0x0c, 2048, 2048),
+                     mbr_entry(0, 0xee, 1, 2047)]))]
+        self.assertEqual('gpt', self._read(writes)['label'])
+
+    def test_gpt_without_protective_mbr_is_ignored(self):
+        self.assertIsNone(self._read(self._gpt(pmbr=False)))
+
+    def test_dos_with_leftover_backup_gpt(self):
+        writes = self._gpt(primary=False, pmbr=False) + [
+            (0, mbr([mbr_entry(0, 0x83, 2048, 4096)]))]
+        table = self._read(writes)
+        self.assertEqual('dos', table['label'])
+        self.assertEqual([{'node': '/dev/vda1', 'start': 2048, 'size': 4096,
+                           'type': '83'}], table['partitions'])
+
+    def test_dos_with_logical_partitions(self):
+        ebr1 = mbr([mbr_entry(0, 0x83, 2048, 2048),
+                    mbr_entry(0, 0x05, 6144, 6144)])
+        ebr2 = mbr([mbr_entry(0, 0x82, 2048, 4096)])
+        writes = [(0, mbr([mbr_entry(0x80, 0x83, 2048, 4096),
+                           mbr_entry(0, 0x0f, 8192, 16384)],
+                          disk_id=0xb0dbdde1)),
+                  (8192 * 512, ebr1), ((8192 + 6144) * 512, ebr2)]
+        self.assertEqual({
+            'label': 'dos',
+            'id': '0xb0dbdde1',
+            'device': '/dev/vda',
+            'unit': 'sectors',
+            'sectorsize': 512,
+            'partitions': [
+                {'node': '/dev/vda1', 'start': 2048, 'size': 4096,
+                 'type': '83', 'bootable': True},
+                {'node': '/dev/vda2', 'start': 8192, 'size': 16384,
+                 'type': 'f'},
+                {'node': '/dev/vda5', 'start': 10240, 'size': 2048,
+                 'type': '83'},
+                {'node': '/dev/vda6', 'start': 16384, 'size': 4096,
+                 'type': '82'},
+            ]}, self._read(writes))
+
+    def test_dos_extended_chain_loop_is_bounded(self):
+        ebr = mbr([mbr_entry(0, 0x83, 2048, 2048),
+                   mbr_entry(0, 0x05, 0, 6144)])
+        writes = [(0, mbr([mbr_entry(0, 0x05, 8192, 16384)])),
+                  (8192 * 512, ebr)]
+        table = self._read(writes)
+        self.assertEqual(1 + partition_table.MBR_MAX_LOGICAL,
+                         len(table['partitions']))
+
+
+# vi: ts=4 expandtab syntax=python
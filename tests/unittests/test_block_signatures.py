@@ -0,0 +1,220 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import mock
+import struct
+import uuid
+
+from .helpers import CiTestCase
+from curtin.block import signatures
+
+MiB = 1024 * 1024
+UUID = uuid.UUID('0d1f4cc1-9a2b-4c3d-8e4f-5a6b7c8d9e0f')
+
+
+class TestScanSignatures(CiTestCase):
+
+    def _image(self, writes, size=64 * MiB):
+        """ Create a sparse image of size with data written at offsets. """
+        path = self.tmp_path('image')
+        with open(path, 'wb') as fp:
+            fp.truncate(size)
+            for offset, data in writes:
+                fp.seek(offset)
+                fp.write(data)
+        return path
+
+    def _scan(self, writes, size=64 * MiB, **kwargs):
+        return signatures.scan_signatures(self._image(writes, size), **kwargs)
+
+    def _types(self, scan):
+        return [sig['type'] for sig in scan['signatures']]
+
+    def test_empty_device(self):
+        path = self._image([])
+        self.assertEqual({'device': path, 'size': 64 * MiB, 'ptable': None,
+                          'signatures': []},
+                         signatures.scan_signatures(path))
+
+    def test_small_device(self):
+        scan = self._scan([(0, b'XFSB')], size=4096)
+        self.assertEqual(['xfs'], self._types(scan))
+
+    def test_gpt_with_protective_mbr(self):
+        header = b'EFI PART' + b'\0' * 48 + UUID.bytes_le
+        scan = self._scan([(0x1fe, b'\x55\xaa'), (512, header)])
+        self.assertEqual('gpt', scan['ptable'])
+        self.assertEqual(['dos', 'gpt'], self._types(scan))
+        self.assertEqual(str(UUID), scan['signatures'][1]['uuid'])
+
+    def test_gpt_4k_sector(self):
+        header = b'EFI PART'
+        self.assertEqual('gpt', self._scan([(4096, header)])['ptable'])
+        self.assertIsNone(
+            self._scan([(4096, header)], sector_size=512)['ptable'])
+
+    def test_dos(self):
+        scan = self._scan([(0x1b8, struct.pack('<I', 0xdeadbeef)),
+                           (0x1fe, b'\x55\xaa')])
+        self.assertEqual('dos', scan['ptable'])
+        self.assertEqual([{'type': 'dos', 'usage': 'partition_table',
+                           'offset': 0x1fe, 'uuid': 'deadbeef'}],
+                         scan['signatures'])
+
+    def test_vfat_is_not_listed_as_dos(self):
+        scan = self._scan([(0x52, b'FAT32'), (0x43, b'\x34\x12\xcd\xab'),
+                           (0x47, b'EFI        '), (0x1fe, b'\x55\xaa')])
+        self.assertEqual('dos', scan['ptable'])
+        self.assertEqual([{'type': 'vfat', 'usage': 'filesystem', 'offset': 0,
+                           'uuid': 'ABCD-1234', 'label': 'EFI'}],
+                         scan['signatures'])
+
+    def test_md_0_90(self):
+        size = 64 * MiB + 12345
+        offset = (size & ~0xffff) - 0x10000
+        sb = bytearray(64)
+        struct.pack_into('<III', sb, 0, signatures.MD_MAGIC, 0, 90)
+        struct.pack_into('<I', sb, 20, 0x11111111)
+        struct.pack_into('<III', sb, 52, 0x22222222, 0x33333333, 0x44444444)
+        sig = self._scan([(offset, bytes(sb))], size=size)['signatures'][0]
+        self.assertEqual(
+            {'type': 'linux_raid_member', 'usage': 'raid', 'offset': offset,
+             'version': '0.90.0',
+             'uuid': '11111111:22222222:33333333:44444444'}, sig)
+
+    def test_md_1_x(self):
+        size = 64 * MiB
+        for version, offset in (('1.0', size - 8192), ('1.1', 0),
+                                ('1.2', 4096)):
+            sb = (struct.pack('<II', signatures.MD_MAGIC, 1) + b'\0' * 8 +
+                  UUID.bytes + b'ubuntu:0'.ljust(32, b'\0'))
+            sig = self._scan([(offset, sb)], size=size)['signatures'][0]
+            self.assertEqual(
+                {'type': 'linux_raid_member', 'usage': 'raid',
+                 'offset': offset, 'version': version, 'label': 'ubuntu:0',
+                 'uuid': '0d1f4cc1:9a2b4c3d:8e4f5a6b:7c8d9e0f'}, sig)
+
+    def test_lvm2(self):
+        pvid = b'ABCDEFghijklmnopqrstuvwxyz012345'
+        label = b'LABELONE' + b'\0' * 16 + b'LVM2 001' + pvid
+        sig = self._scan([(512, label)])['signatures'][0]
+        self.assertEqual('LVM2_member', sig['type'])
+        self.assertEqual('ABCDEF-ghij-klmn-opqr-stuv-wxyz-012345',
+                         sig['uuid'])
+
+    def test_luks(self):
+        for version, label in ((1, None), (2, 'cryptroot')):
+            header = bytearray(256)
+            header[0:8] = b'LUKS\xba\xbe' + struct.pack('>H', version)
+            if label:
+                header[24:24 + len(label)] = label.encode()
+            header[168:168 + 36] = str(UUID).encode()
+            sig = self._scan([(0, bytes(header))])['signatures'][0]
+            self.assertEqual('crypto_LUKS', sig['type'])
+            self.assertEqual(str(version), sig['version'])
+            self.assertEqual(str(UUID), sig['uuid'])
+            self.assertEqual(label, sig.get('label'))
+
+    def test_bcache_backing(self):
+        set_uuid = uuid.UUID('11111111-2222-3333-4444-555555555555')
+        sb = bytearray(112)
+        struct.pack_into('<Q', sb, 16, 1)
+        sb[24:40] = signatures.BCACHE_MAGIC
+        sb[40:56] = UUID.bytes
+        sb[56:72] = set_uuid.bytes
+        sb[72:76] = b'root'
+        struct.pack_into('<Q', sb, 104, 1)
+        sig = self._scan([(4096, bytes(sb))])['signatures'][0]
+        self.assertEqual(
+            {'type': 'bcache', 'usage': 'other', 'offset': 4096,
+             'version': 1, 'role': 'backing', 'uuid': str(UUID),
+             'set_uuid': str(set_uuid), 'label': 'root',
+             'cache_mode': 'writeback'}, sig)
+
+    def test_bcache_caching(self):
+        sb = (struct.pack('<Q', 3) + signatures.BCACHE_MAGIC + UUID.bytes)
+        sig = self._scan([(4096 + 16, sb)])['signatures'][0]
+        self.assertEqual('caching', sig['role'])
+        self.assertNotIn('cache_mode', sig)
+
+    def test_bcache_backing_with_feature_bits(self):
+        for version, role in ((5, 'caching'), (6, 'backing')):
+            sb = (struct.pack('<Q', version) + signatures.BCACHE_MAGIC +
+                  UUID.bytes)
+            sig = self._scan([(4096 + 16, sb)])['signatures'][0]
+            self.assertEqual(role, sig['role'], version)
+
+    def test_zfs_label_at_end(self):
+        size = 64 * MiB
+        label = size - 256 * 1024
+        scan = self._scan(
+            [(label + 128 * 1024 + 3072,
+              struct.pack('<Q', signatures.ZFS_UBERBLOCK_MAGIC))], size=size)
+        self.assertEqual([{'type': 'zfs_member', 'usage': 'filesystem',
+                           'offset': label}], scan['signatures'])
+
+    def test_zfs_big_endian(self):
+        magic = struct.pack('>Q', signatures.ZFS_UBERBLOCK_MAGIC)
+        scan = self._scan([(128 * 1024, magic)])
+        self.assertEqual(['zfs_member'], self._types(scan))
+
+    def test_ext(self):
+        for compat, incompat, fstype in ((0, 0, 'ext2'), (4, 0, 'ext3'),
+                                         (4, 0x2c2, 'ext4')):
+            sb = bytearray(136)
+            sb[56:58] = b'\x53\xef'
+            struct.pack_into('<II', sb, 92, compat, incompat)
+            sb[104:120] = UUID.bytes
+            sb[120:126] = b'cloudy'
+            sig = self._scan([(1024, bytes(sb))])['signatures'][0]
+            self.assertEqual(
+                {'type': fstype, 'usage': 'filesystem', 'offset': 1024,
+                 'uuid': str(UUID), 'label': 'cloudy'}, sig)
+
+    def test_xfs_btrfs_swap_iso_f2fs(self):
+        for writes, fstype in (
+                ([(0, b'XFSB'), (32, UUID.bytes)], 'xfs'),
+                ([(0x10040, b'_BHRfS_M'), (0x10020, UUID.bytes)], 'btrfs'),
+                ([(4086, b'SWAPSPACE2'), (1036, UUID.bytes)], 'swap'),
+                ([(0x8001, b'CD001')], 'iso9660'),
+                ([(1024, struct.pack('<I', 0xf2f52010))], 'f2fs')):
+            scan = self._scan(writes)
+            self.assertEqual([fstype], self._types(scan))
+        self.assertEqual(str(UUID), self._scan(
+            [(0, b'XFSB'), (32, UUID.bytes)])['signatures'][0]['uuid'])
+
+    def test_signatures_are_ordered_by_offset(self):
+        scan = self._scan([(1024 + 56, b'\x53\xef'),
+                           (0x1fe, b'\x55\xaa'),
+                           (4096 + 24, signatures.BCACHE_MAGIC)])
+        self.assertEqual(['dos', 'ext2', 'bcache'], self._types(scan))
+        self.assertEqual('bcache',
+                         signatures.find_signature(scan, 'bcache')['type'])
+        self.assertIsNone(signatures.find_signature(scan, 'xfs'))
+
+    def test_missing_device_raises(self):
+        with self.assertRaises(IOError):
+            signatures.scan_signatures(self.tmp_path('missing'))
+
+    def test_reads_head_and_tail_once(self):
+        path = self._image([])
+        reads = []
+        real_open = open
+
+        def m_open(path, mode):
+            fp = real_open(path, mode)
+            m_fp = mock.MagicMock()
+            m_fp.__enter__.return_value = m_fp
+            m_fp.__exit__.side_effect = lambda *args: fp.close()
+            m_fp.seek.side_effect = fp.seek
+            m_fp.tell.side_effect = fp.tell
+            m_fp.read.side_effect = lambda n: reads.append(n) or fp.read(n)
+            return m_fp
+
+        with mock.patch('curtin.block.signatures.open', create=True,
+                        side_effect=m_open):
+            signatures.scan_signatures(path)
+        self.assertEqual([signatures.HEAD_BYTES, signatures.TAIL_BYTES],
+                         reads)
+
+
+# vi: ts=4 expandtab syntax=python
@@ -0,0 +1,107 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import mock
+import threading
+import time
+
+from .helpers import CiTestCase
+from curtin import udev
+from curtin.block import sysfs
+
+
+class TestSysfsCache(CiTestCase):
+
+    def setUp(self):
+        super(TestSysfsCache, self).setUp()
+        self.add_patch('curtin.block.sysfs.util.load_file', 'm_load')
+        self.m_load.side_effect = lambda path: path + '\n'
+        self.add_patch('curtin.block.sysfs.os.path.realpath', 'm_realpath')
+        self.m_realpath.side_effect = lambda path: '/real' + path
+
+    def test_no_cache_reads_every_time(self):
+        self.assertIsNone(sysfs.current())
+        sysfs.load_file('/sys/class/block/sda/size')
+        sysfs.load_file('/sys/class/block/sda/size')
+        sysfs.realpath('/dev/sda')
+        sysfs.realpath('/dev/sda')
+        self.assertEqual(2, self.m_load.call_count)
+        self.assertEqual(2, self.m_realpath.call_count)
+
+    def test_cached_reads_once(self):
+        with sysfs.cached():
+            for _ in range(3):
+                self.assertEqual('/sys/class/block/sda/size\n',
+                                 sysfs.load_file('/sys/class/block/sda/size'))
+                self.assertEqual('/real/dev/sda', sysfs.realpath('/dev/sda'))
+        self.assertEqual([mock.call('/sys/class/block/sda/size')],
+                         self.m_load.call_args_list)
+        self.assertEqual([mock.call('/dev/sda')],
+                         self.m_realpath.call_args_list)
+        self.assertIsNone(sysfs.current())
+
+    def test_nested_cached_shares_cache(self):
+        with sysfs.cached() as outer:
+            with sysfs.cached() as inner:
+                self.assertIs(outer, inner)
+            self.assertIs(outer, sysfs.current())
+        self.assertIsNone(sysfs.current())
+
+    def test_errors_are_not_cached(self):
+        self.m_load.side_effect = [IOError('missing'), 'present\n']
+        with sysfs.cached():
+            with self.assertRaises(IOError):
+                sysfs.load_file('/sys/class/block/sda1/partition')
+            self.assertEqual('present\n', sysfs.load_file(
+                '/sys/class/block/sda1/partition'))
+
+    def test_udev_settle_clears_cache(self):
+        with sysfs.cached():
+            sysfs.load_file('/sys/class/block/sda/size')
+            sysfs.realpath('/dev/sda')
+            udev._settled()
+            sysfs.load_file('/sys/class/block/sda/size')
+            sysfs.realpath('/dev/sda')
+        self.assertEqual(2, self.m_load.call_count)
+        self.assertEqual(2, self.m_realpath.call_count)
+
+    def test_invalidate_clears_cache(self):
+        sysfs.invalidate()
+        with sysfs.cached():
+            sysfs.load_file('/sys/class/block/sda/size')
+            sysfs.invalidate()
+            sysfs.load_file('/sys/class/block/sda/size')
+        self.assertEqual(2, self.m_load.call_count)
+
+    def test_invalidate_clears_caches_of_other_threads(self):
+        reads = []
+
+        def reader(invalidated):
+            with sysfs.cached():
+                reads.append(sysfs.load_file('/sys/class/block/sda/size'))
+                invalidated.wait(5)
+                reads.append(sysfs.load_file('/sys/class/block/sda/size'))
+
+        invalidated = threading.Event()
+        thread = threading.Thread(target=reader, args=(invalidated,))
+        thread.start()
+        while not reads:
+            time.sleep(0.01)
+        sysfs.invalidate()
+        invalidated.set()
+        thread.join()
+        self.assertEqual(2, self.m_load.call_count)
+
+    def test_read_attrs(self):
+        self.m_load.side_effect = ['1\n', IOError('missing'), '2048\n']
+        self.assertEqual(
+            {'partition': '1', 'start': None, 'size': '2048'},
+            sysfs.read_attrs('/sys/class/block/sda1',
+                             ('partition', 'start', 'size')))
+        self.assertEqual(
+            [mock.call('/sys/class/block/sda1/partition'),
+             mock.call('/sys/class/block/sda1/start'),
+             mock.call('/sys/class/block/sda1/size')],
+            self.m_load.call_args_list)
+
+
+# vi: ts=4 expandtab syntax=python
@@ -0,0 +1,207 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import mock
+import os
+
+from .helpers import CiTestCase, populate_dir
+from curtin import block
+from curtin.block import topology
+
+
+class TestBlockTopology(CiTestCase):
+
+    def setUp(self):
+        super(TestBlockTopology, self).setUp()
+        self.tmp = self.tmp_dir()
+        devices = os.path.join(self.tmp, 'devices')
+        populate_dir(devices, {
+            'vda/dev': '252:0\n',
+            'vda/uevent': 'MAJOR=252\nMINOR=0\nDEVNAME=vda\nDEVTYPE=disk\n',
+            'vda/size': '20971520\n',
+            'vda/ro': '0\n',
+            'vda/removable': '0\n',
+            'vda/queue/logical_block_size': '512\n',
+            'vda/queue/physical_block_size': '4096\n',
+            'vda/vda1/dev': '252:1\n',
+            'vda/vda1/uevent': 'DEVNAME=vda1\nDEVTYPE=partition\n',
+            'vda/vda1/partition': '1\n',
+            'vda/vda1/start': '2048\n',
+            'vda/vda1/size': '2097152\n',
+            'vda/vda1/ro': '0\n',
+            'dm-0/dev': '253:0\n',
+            'dm-0/uevent': 'DEVNAME=dm-0\nDEVTYPE=disk\n',
+            'dm-0/size': '2093056\n',
+            'dm-0/queue/logical_block_size': '512\n',
+            'dm-0/queue/physical_block_size': '4096\n',
+        })
+        for sub in ['vda/holders', 'vda/slaves', 'vda/vda1/slaves',
+                    'dm-0/holders']:
+            os.makedirs(os.path.join(devices, sub))
+        for link, target in [('vda/vda1/holders/dm-0', 'dm-0'),
+                             ('dm-0/slaves/vda1', 'vda/vda1')]:
+            os.makedirs(os.path.dirname(os.path.join(devices, link)))
+            os.symlink(os.path.join(devices, target),
+                       os.path.join(devices, link))
+        self.sysfs = os.path.join(self.tmp, 'class')
+        os.makedirs(self.sysfs)
+        for kname, target in [('vda', 'vda'), ('vda1', 'vda/vda1'),
+                              ('dm-0', 'dm-0')]:
+            os.symlink(os.path.join(devices, target),
+                       os.path.join(self.sysfs, kname))
+        self.udev = os.path.join(self.tmp, 'udev')
+        populate_dir(self.udev, {
+            'b252:0': ('S:disk/by-id/virtio-disk0\n'
+                       'S:disk/by-path/virtio-pci-0000:00:05.0\n'
+                       'E:ID_PART_TABLE_TYPE=gpt\n'
+                       'E:ID_PART_TABLE_UUID=7f4a3d4e\n'),
+            'b252:1': ('S:disk/by-id/virtio-disk0-part1\n'
+                       'E:ID_FS_TYPE=crypto_LUKS\n'
+                       'E:ID_FS_UUID=0d1f4cc1\n'
+                       'E:ID_PART_ENTRY_UUID=5a6b\n'
+                       'G:systemd\n'),
+        })
+
+    def _topology(self):
+        return topology.BlockTopology(sysfs_dir=self.sysfs,
+                                      udev_data_dir=self.udev)
+
+    def test_reads_devices(self):
+        topo = self._topology()
+        self.assertEqual(['dm-0', 'vda', 'vda1'], topo.knames())
+        vda = topo.get('vda')
+        self.assertEqual('/dev/vda', vda['devpath'])
+        self.assertEqual('disk', vda['devtype'])
+        self.assertEqual(20971520 * 512, vda['size'])
+        self.assertEqual(512, vda['logical_sector_size'])
+        self.assertEqual(4096, vda['physical_sector_size'])
+        self.assertEqual(['vda1'], topo.partitions('vda'))
+        self.assertIsNone(vda['partition'])
+
+    def test_partition_uses_parent_queue(self):
+        vda1 = self._topology().get('vda1')
+        self.assertEqual(1, vda1['partition'])
+        self.assertEqual(2048, vda1['start'])
+        self.assertEqual('vda', vda1['parent'])
+        self.assertEqual(4096, vda1['physical_sector_size'])
+        self.assertEqual('partition', vda1['devtype'])
+
+    def test_holders_slaves_and_descendants(self):
+        topo = self._topology()
+        self.assertEqual(['dm-0'], topo.holders('vda1'))
+        self.assertEqual(['vda1'], topo.slaves('dm-0'))
+        self.assertEqual(['vda1', 'dm-0'], topo.descendants('vda'))
+
+    def test_udev_links_and_signatures(self):
+        topo = self._topology()
+        self.assertEqual(['/dev/disk/by-id/virtio-disk0-part1'],
+                         topo.links('vda1'))
+        self.assertEqual({'TYPE': 'crypto_LUKS', 'UUID': '0d1f4cc1',
+                          'PARTUUID': '5a6b'}, topo.signatures('vda1'))
+        self.assertEqual({'PTTYPE': 'gpt', 'PTUUID': '7f4a3d4e'},
+                         topo.signatures('vda'))
+        self.assertEqual(
+            'vda', topo.find_by_link('/dev/disk/by-id/virtio-disk0'))
+        self.assertEqual({}, topo.signatures('dm-0'))
+
+    def test_unknown_device_raises_keyerror(self):
+        with self.assertRaises(KeyError):
+            self._topology().get('sdz')
+
+    def test_invalidate_device_rereads_entry(self):
+        topo = self._topology()
+        self.assertEqual(20971520 * 512, topo.get('vda')['size'])
+        with open(os.path.join(self.sysfs, 'vda', 'size'), 'w') as fp:
+            fp.write('8\n')
+        self.assertEqual(20971520 * 512, topo.get('vda')['size'])
+        topo.invalidate('vda')
+        self.assertEqual(8 * 512, topo.get('vda')['size'])
+
+    def test_invalidate_all_rescans(self):
+        topo = self._topology()
+        self.assertIn('dm-0', topo)
+        os.unlink(os.path.join(self.sysfs, 'dm-0'))
+        self.assertIn('dm-0', topo)
+        topo.invalidate()
+        self.assertNotIn('dm-0', topo)
+
+
+class TestGetUnusedBlockdevInfo(CiTestCase):
+
+    def setUp(self):
+        super(TestGetUnusedBlockdevInfo, self).setUp()
+        self.add_patch('curtin.block._lsblock', 'm_lsblock')
+        self.add_patch('curtin.block.get_mounted_majmin', 'm_mounted')
+        self.add_patch('curtin.block.topology.BlockTopology', 'm_topology',
+                       autospec=None)
+        self.topology = self.m_topology.return_value
+        self.entries = {'vda': {'majmin': '252:0'},
+                        'vda1': {'majmin': '252:1'},
+                        'dm-0': {'majmin': '253:0'},
+                        'vdb': {'majmin': '252:16'}}
+        self.topology.__contains__.side_effect = (
+            lambda kname: kname in self.entries)
+        self.topology.get.side_effect = lambda kname: self.entries[kname]
+        self.topology.descendants.side_effect = (
+            lambda kname: ['vda1', 'dm-0'] if kname == 'vda' else [])
+        self.m_lsblock.return_value = {
+            'vda': {'KNAME': 'vda', 'device_path': '/dev/vda'},
+            'vdb': {'KNAME': 'vdb', 'device_path': '/dev/vdb'}}
+
+    def test_holder_mounted_marks_disk_used(self):
+        self.m_mounted.return_value = set(['253:0'])
+        self.assertEqual(['vdb'], list(block.get_unused_blockdev_info()))
+        self.m_lsblock.assert_called_once_with(['--nodeps'])
+
+    def test_nothing_mounted(self):
+        self.m_mounted.return_value = set(['0:22'])
+        self.assertEqual(['vda', 'vdb'],
+                         sorted(block.get_unused_blockdev_info()))
+
+    def test_falls_back_to_lsblk_for_unknown_device(self):
+        del self.entries['vdb']
+        self.m_mounted.return_value = set()
+        self.m_lsblock.side_effect = [
+            self.m_lsblock.return_value,
+            {'vdb': {'MOUNTPOINT': '/mnt'}}]
+        self.assertEqual(['vda'], list(block.get_unused_blockdev_info()))
+        self.assertEqual([mock.call(['--nodeps']), mock.call(['/dev/vdb'])],
+                         self.m_lsblock.call_args_list)
+
+
+class TestGetMountedMajmin(CiTestCase):
+
+    mountinfo = (
+        '22 1 252:1 / / rw,relatime shared:1 - ext4 /dev/vda1 rw\n'
+        '23 1 0:45 / /srv rw,relatime shared:2 - btrfs /dev/vdb2 rw\n'
+        '24 1 0:46 / /tank rw - zfs tank/data rw\n'
+        '25 1 0:5 / /dev rw,nosuid - devtmpfs udev rw\n')
+    swaps = ('Filename\tType\tSize\tUsed\tPriority\n'
+             '/dev/vdc1\tpartition\t1048572\t0\t-2\n'
+             '/swap.img\tfile\t1048572\t0\t-3\n')
+
+    def setUp(self):
+        super(TestGetMountedMajmin, self).setUp()
+        self.add_patch('curtin.block._blockdev_majmin', 'm_majmin')
+        devices = {'/dev/vda1': '252:1', '/dev/vdb2': '252:18',
+                   '/dev/vdc1': '252:33'}
+        self.m_majmin.side_effect = devices.get
+
+    def _mounted(self):
+        mountinfo = self.tmp_path('mountinfo')
+        swaps = self.tmp_path('swaps')
+        with open(mountinfo, 'w') as fp:
+            fp.write(self.mountinfo)
+        with open(swaps, 'w') as fp:
+            fp.write(self.swaps)
+        return block.get_mounted_majmin(mountinfo=mountinfo, swaps=swaps)
+
+    def test_mount_sources_are_resolved(self):
+        """the backing device of an anonymous-dev btrfs mount is in use."""
+        self.assertEqual(set(['252:1', '252:18', '252:33']), self._mounted())
+        self.assertNotIn(mock.call('tank/data'), self.m_majmin.call_args_list)
+
+    def test_anonymous_devices_are_not_reported(self):
+        self.assertFalse(
+            any(majmin.startswith('0:') for majmin in self._mounted()))
+
+# vi: ts=4 expandtab syntax=python
@@ -5,9 +5,10 @@ import os
 import textwrap
 import uuid
 
+from curtin import util
 from curtin.block import clear_holders
 from curtin.util import ProcessExecutionError
-from .helpers import CiTestCase
+from .helpers import CiTestCase, populate_dir
 
 
 class TestClearHolders(CiTestCase):
@@ -655,6 +656,119 @@ class TestClearHolders(CiTestCase):
                                   for e in res[:len(level)]}, level)
                 res = res[len(level):]
 
+    def test_plan_shutdown_holders_trees_shared_holder(self):
+        """a holder found from several trees is planned once, above all"""
+        def tree(name, dev_type, holders=None):
+            return {'device': '/sys/class/block/' + name, 'name': name,
+                    'dev_type': dev_type, 'holders': holders or []}
+
+        bcache = tree('bcache0', 'bcache')
+        md0 = tree('md0', 'raid', [bcache])
+        trees = [
+            tree('vda', 'disk', [tree('vda1', 'partition', [bcache])]),
+            tree('vdb', 'disk', [tree('vdb1', 'partition', [md0])]),
+            tree('vdc', 'disk', [tree('vdc1', 'partition', [md0])]),
+        ]
+        res = [os.path.basename(e['device'])
+               for e in clear_holders.plan_shutdown_holder_trees(trees)]
+        self.assertEqual(1, res.count('bcache0'))
+        self.assertEqual(['bcache0', 'md0'], res[:2])
+        for device in ('vda1', 'vdb1', 'vdc1'):
+            self.assertLess(res.index('md0'), res.index(device))
+            self.assertLess(res.index(device), res.index(device[:-1]))
+
+    def test_plan_shutdown_holders_trees_visits_shared_subtrees_once(self):
+        """planning a deep graph of shared holders is not exponential"""
+        top = {'device': '/sys/class/block/dm-top', 'name': 'dm-top',
+               'dev_type': 'lvm', 'holders': []}
+        layer = [top]
+        for depth in range(40):
+            layer = [{'device': '/sys/class/block/dm-%d-%d' % (depth, i),
+                      'name': 'dm-%d-%d' % (depth, i), 'dev_type': 'lvm',
+                      'holders': layer} for i in range(2)]
+        res = clear_holders.plan_shutdown_holder_trees(layer)
+        self.assertEqual(81, len(res))
+        self.assertEqual('/sys/class/block/dm-top', res[0]['device'])
+        self.assertEqual(set(['dm-39-0', 'dm-39-1']),
+                         set(os.path.basename(e['device'])
+                             for e in res[-2:]))
+
+    def test_plan_shutdown_holders_trees_rejects_cycle(self):
+        """a cycle in the holders trees raises ValueError"""
+        sda = {'device': '/sys/class/block/sda', 'name': 'sda',
+               'dev_type': 'disk', 'holders': []}
+        dm0 = {'device': '/sys/class/block/dm-0', 'name': 'dm-0',
+               'dev_type': 'lvm', 'holders': [sda]}
+        sda['holders'].append(dm0)
+        with self.assertRaises(ValueError):
+            clear_holders.plan_shutdown_holder_trees(sda)
+        vda = {'device': '/sys/class/block/vda', 'name': 'vda',
+               'dev_type': 'disk', 'holders': [dm0]}
+        with self.assertRaises(ValueError):
+            clear_holders.plan_shutdown_holder_trees(vda)
+
+    def test_group_shutdown_plan(self):
+        """devices which do not share a stack are in separate groups"""
+        trees = self.example_holders_trees[1]
+        plan = clear_holders.plan_shutdown_holder_trees(trees)
+        groups = clear_holders.group_shutdown_plan(plan, trees)
+        self.assertEqual(
+            [['bcache1', 'md0', 'bcache2', 'vdb1', 'vdb2', 'vdb3', 'vdb4',
+              'vdb5', 'vdb6', 'vdb7', 'vdb8', 'vdb'], ['vdd1', 'vdd'],
+             ['vdc']],
+            [[os.path.basename(e['device']) for e in group]
+             for group in groups])
+        self.assertEqual(sorted(plan, key=lambda e: e['device']),
+                         sorted(sum(groups, []), key=lambda e: e['device']))
+
+    def test_group_shutdown_plan_joins_shared_slaves(self):
+        """devices built on the same device are grouped with holders_scan"""
+        trees = self.example_holders_trees[1]
+        plan = clear_holders.plan_shutdown_holder_trees(trees)
+        holders_scan = mock.Mock()
+        # vdd1 and vdc share a cache device outside of the trees
+        holders_scan.slaves.side_effect = lambda device: (
+            ['/sys/class/block/nvme0n1']
+            if os.path.basename(device) in ('vdd1', 'vdc') else [])
+        groups = clear_holders.group_shutdown_plan(plan, trees, holders_scan)
+        self.assertEqual(
+            [['vdd1', 'vdd', 'vdc']],
+            [[os.path.basename(e['device']) for e in group]
+             for group in groups[1:]])
+
+    @mock.patch('curtin.block.clear_holders.os.path.exists')
+    def test_clear_holders_shuts_down_groups_in_plan_order(self, m_exists):
+        """clear_holders keeps plan order within a group with many workers"""
+        m_exists.return_value = True
+        calls = []
+        m_shutdown = mock.Mock(side_effect=lambda d: calls.append(
+            os.path.basename(d)))
+        self.add_patch(
+            'curtin.block.clear_holders.DEV_TYPES', 'm_dev_types',
+            autospec=None,
+            new=dict((dev_type, {'shutdown': m_shutdown})
+                     for dev_type in clear_holders.DEV_TYPES))
+        holders_scan = mock.Mock()
+        holders_scan.holders_trees.return_value = (
+            self.example_holders_trees[1])
+        holders_scan.slaves.return_value = []
+        clear_holders.clear_holders(['vdb', 'vdc', 'vdd'],
+                                    holders_scan=holders_scan, max_workers=3)
+        self.assertEqual(15, len(calls))
+        plan = [os.path.basename(e['device']) for e in
+                clear_holders.plan_shutdown_holder_trees(
+                    self.example_holders_trees[1])]
+        for group in clear_holders.group_shutdown_plan(
+                clear_holders.plan_shutdown_holder_trees(
+                    self.example_holders_trees[1]),
+                self.example_holders_trees[1]):
+            names = [os.path.basename(e['device']) for e in group]
+            self.assertEqual(names, [c for c in calls if c in names])
+        calls[:] = []
+        clear_holders.clear_holders(['vdb', 'vdc', 'vdd'],
+                                    holders_scan=holders_scan)
+        self.assertEqual(plan, calls)
+
     def test_format_holders_tree(self):
         """test output of clear_holders.format_holders_tree"""
         test_trees_and_results = [
@@ -731,22 +845,38 @@ class TestClearHolders(CiTestCase):
 
     @mock.patch('curtin.block.clear_holders.os.path.exists')
     @mock.patch('curtin.block.clear_holders.block.sys_block_path')
-    @mock.patch('curtin.block.clear_holders.gen_holders_tree')
-    def test_assert_clear(self, mock_gen_holders_tree, mock_syspath, m_ospe):
+    @mock.patch('curtin.block.clear_holders.HoldersScan')
+    def test_assert_clear(self, mock_scan, mock_syspath, m_ospe):
         def my_sysblock(p, strict=False):
             return '/sys/class/block/%s' % os.path.basename(p)
 
-        mock_gen_holders_tree.return_value = self.example_holders_trees[0][0]
+        m_trees = mock_scan.return_value.holders_trees
+        m_trees.return_value = [self.example_holders_trees[0][0]]
         mock_syspath.side_effect = my_sysblock
         # os.path.exists set to True to include all devices in the call list
         m_ospe.return_value = True
         device = self.test_blockdev
         with self.assertRaises(OSError):
             clear_holders.assert_clear(device)
-            mock_gen_holders_tree.assert_called_with(device)
-        mock_gen_holders_tree.return_value = self.example_holders_trees[1][1]
+        m_trees.assert_called_with([my_sysblock(device)])
+        m_trees.return_value = [self.example_holders_trees[1][1]]
         clear_holders.assert_clear(device)
 
+    @mock.patch('curtin.block.clear_holders.os.path.exists')
+    @mock.patch('curtin.block.clear_holders.block.sys_block_path')
+    def test_assert_clear_refreshes_holders_scan(self, mock_syspath, m_ospe):
+        """assert_clear re-reads sysfs with a holders_scan passed to it"""
+        mock_syspath.side_effect = lambda p, strict=False: p
+        m_ospe.return_value = True
+        holders_scan = mock.Mock()
+        holders_scan.holders_trees.return_value = [
+            self.example_holders_trees[1][1]]
+        clear_holders.assert_clear('/sys/class/block/vdc',
+                                   holders_scan=holders_scan)
+        holders_scan.refresh.assert_called_with()
+        holders_scan.holders_trees.assert_called_with(
+            ['/sys/class/block/vdc'])
+
     @mock.patch('curtin.block.clear_holders.udev')
     @mock.patch('curtin.block.clear_holders.multipath')
     @mock.patch('curtin.block.clear_holders.lvm')
@@ -755,6 +885,8 @@ class TestClearHolders(CiTestCase):
     @mock.patch('curtin.block.clear_holders.util')
     def test_start_clear_holders_deps(self, mock_util, mock_mdadm, mock_zfs,
                                       mock_lvm, mock_mp, mock_udev):
+        mock_util.run_in_dependency_order.side_effect = (
+            util.run_in_dependency_order)
         mock_zfs.zfs_supported.return_value = True
         clear_holders.start_clear_holders_deps()
         mock_mdadm.mdadm_assemble.assert_called_with(
@@ -772,6 +904,8 @@ class TestClearHolders(CiTestCase):
                                             mock_zfs, mock_lvm, mock_mp,
                                             mock_udev):
         """test that we skip zfs modprobe on unsupported platforms"""
+        mock_util.run_in_dependency_order.side_effect = (
+            util.run_in_dependency_order)
         mock_zfs.zfs_supported.return_value = False
         clear_holders.start_clear_holders_deps()
         mock_mdadm.mdadm_assemble.assert_called_with(
@@ -781,6 +915,41 @@ class TestClearHolders(CiTestCase):
         self.assertNotIn(mock.call('zfs'),
                          mock_util.load_kernel_module.call_args_list)
 
+    @mock.patch('curtin.block.clear_holders.udev')
+    @mock.patch('curtin.block.clear_holders.multipath')
+    @mock.patch('curtin.block.clear_holders.lvm')
+    @mock.patch('curtin.block.clear_holders.zfs')
+    @mock.patch('curtin.block.clear_holders.mdadm')
+    @mock.patch('curtin.block.clear_holders._start_mdadm_arrays')
+    def test_start_clear_holders_deps_order(self, m_start_md, mock_mdadm,
+                                            mock_zfs, mock_lvm, mock_mp,
+                                            mock_udev):
+        """md, multipath, then lvm and bcache start in order, settle once"""
+        calls = []
+        mock_mdadm.mdadm_assemble.side_effect = (
+            lambda **kw: calls.append('assemble'))
+        m_start_md.side_effect = lambda: calls.append('md-run')
+        mock_mp.multipath_supported.return_value = True
+        mock_mp.reload.side_effect = lambda: calls.append('multipath')
+        mock_lvm.lvm_scan.side_effect = (
+            lambda multipath: calls.append('lvm'))
+        self.add_patch('curtin.block.clear_holders.util.load_kernel_module',
+                       'm_load_module')
+        self.m_load_module.side_effect = lambda module: calls.append(module)
+        timings = clear_holders.start_clear_holders_deps()
+        self.assertEqual('assemble', calls[0])
+        self.assertEqual(['lvm', 'bcache'], calls[-2:])
+        self.assertEqual(
+            set(['assemble', 'md-run', 'multipath', 'lvm', 'bcache']),
+            set(calls))
+        mock_lvm.lvm_scan.assert_called_with(multipath=True)
+        mock_lvm.activate_volgroups.assert_called_with(multipath=True)
+        mock_udev.udevadm_settle.assert_called_once_with()
+        self.m_load_module.assert_called_with('bcache')
+        self.assertEqual(
+            sorted(['mdadm-assemble', 'mdadm-run', 'multipath', 'lvm',
+                    'bcache', 'zfs', 'settle']), sorted(timings))
+
     @mock.patch('curtin.block.clear_holders.util')
     def test_shutdown_swap_calls_swapoff(self, mock_util):
         """clear_holders.shutdown_swap() calls swapoff on active swap device"""
@@ -803,4 +972,87 @@ class TestClearHolders(CiTestCase):
         clear_holders.shutdown_swap(blockdev)
         self.assertEqual(0, mock_util.subp.call_count)
 
+
+class TestHoldersScan(CiTestCase):
+
+    def setUp(self):
+        super(TestHoldersScan, self).setUp()
+        self.sysfs = self.tmp_dir()
+        self.devices = self.tmp_dir()
+        self.add_patch('curtin.block.clear_holders.get_dmsetup_uuid',
+                       'm_dmsetup_uuid', return_value='LVM-abcdef')
+        self.add_patch('curtin.block.clear_holders.multipath',
+                       'm_multipath', autospec=None)
+        self.m_multipath.is_mpath_partition.return_value = False
+        self.add_patch('curtin.block.sysfs_to_devpath', 'm_devpath',
+                       side_effect=lambda p: '/dev/' + os.path.basename(p))
+        # vda1 and vdb1 are both physical volumes of dm-0
+        self._add('vda', '252:0')
+        self._add('vda/vda1', '252:1', ['dm-0'])
+        self._add('vdb', '252:16')
+        self._add('vdb/vdb1', '252:17', ['dm-0'])
+        self._add('vdc', '252:32')
+        self._add('dm-0', '253:0', slaves=['vda1', 'vdb1'])
+
+    def _add(self, path, majmin, holders=(), slaves=()):
+        kname = os.path.basename(path)
+        files = {path + '/dev': majmin + '\n'}
+        if '/' in path:
+            files[path + '/partition'] = '1\n'
+        populate_dir(self.devices, files)
+        for sub, names in (('holders', holders), ('slaves', slaves)):
+            os.makedirs(os.path.join(self.devices, path, sub))
+            for name in names:
+                os.symlink(os.path.join(self.sysfs, name),
+                           os.path.join(self.devices, path, sub, name))
+        os.symlink(os.path.join(self.devices, path),
+                   os.path.join(self.sysfs, kname))
+
+    def _scan(self):
+        return clear_holders.HoldersScan(sysfs_dir=self.sysfs)
+
+    def test_trees_share_holders(self):
+        """devices holding several base paths are shared between trees"""
+        vda, vdb = self._scan().holders_trees(['vda', '/dev/vdb'])
+        self.assertEqual(os.path.join(self.sysfs, 'vda'), vda['device'])
+        self.assertEqual('disk', vda['dev_type'])
+        vda1 = vda['holders'][0]
+        self.assertEqual(('vda1', 'partition'),
+                         (vda1['name'], vda1['dev_type']))
+        dm0 = vda1['holders'][0]
+        self.assertEqual(('dm-0', 'lvm'), (dm0['name'], dm0['dev_type']))
+        self.assertIs(dm0, vdb['holders'][0]['holders'][0])
+        self.m_dmsetup_uuid.assert_called_once_with(
+            os.path.join(self.sysfs, 'dm-0'))
+        self.assertEqual(['dm-0', 'vda1', 'vdb1', 'vda', 'vdb'],
+                         [os.path.basename(e['device']) for e in
+                          clear_holders.plan_shutdown_holder_trees(
+                              [vda, vdb])])
+
+    def test_refresh_keeps_identified_dev_types(self):
+        """refresh walks sysfs again and keeps device types"""
+        holders_scan = self._scan()
+        holders_scan.holders_trees(['vda', 'vdb'])
+        self.assertEqual(1, self.m_dmsetup_uuid.call_count)
+        holders_scan.refresh()
+        vda = holders_scan.holders_tree('vda')
+        self.assertEqual('lvm', vda['holders'][0]['holders'][0]['dev_type'])
+        self.assertEqual(1, self.m_dmsetup_uuid.call_count)
+
+        os.unlink(os.path.join(self.sysfs, 'dm-0'))
+        os.unlink(os.path.join(self.devices, 'vda/vda1/holders/dm-0'))
+        holders_scan.refresh()
+        self.assertEqual([], holders_scan.holders_tree('vda1')['holders'])
+
+    def test_gone_holder_is_skipped(self):
+        """a holder which no longer exists is left out of the tree"""
+        os.unlink(os.path.join(self.sysfs, 'dm-0'))
+        self.assertEqual([], self._scan().holders_tree('vda1')['holders'])
+
+    def test_missing_device_raises_oserror(self):
+        """a device which does not exist raises OSError"""
+        with self.assertRaises(OSError):
+            self._scan().holders_tree('/dev/vdz')
+
+
 # vi: ts=4 expandtab syntax=python
@@ -3,7 +3,7 @@
 from argparse import Namespace
 from collections import OrderedDict
 import copy
-from mock import patch, call
+from mock import patch, call, ANY
 import os
 import random
 
@@ -106,6 +106,61 @@ class TestGetPathToStorageVolume(CiTestCase):
         self.assertEqual(expected_calls, self.m_lookup.call_args_list)
         self.m_exists.assert_has_calls([call(path)])
 
+    def test_cached_path_skips_lookup_and_devsync(self):
+        volume = 'mydisk'
+        wwn = self.random_string()
+        cfg = {'id': volume, 'type': 'disk', 'wwn': wwn}
+        s_cfg = OrderedDict({volume: cfg})
+        self.m_lookup.return_value = '/dev/sda'
+        self.add_patch('curtin.commands.block_meta._VOLUME_PATH_CACHE',
+                       'm_cache', new=block_meta.VolumePathCache(),
+                       autospec=None)
+        self.assertEqual('/dev/sda',
+                         block_meta.get_path_to_storage_volume(volume, s_cfg))
+        self.assertEqual('/dev/sda',
+                         block_meta.get_path_to_storage_volume(volume, s_cfg))
+        self.assertEqual([call(wwn)], self.m_lookup.call_args_list)
+        self.assertEqual([call('/dev/sda')], self.m_devsync.call_args_list)
+
+    def test_cached_path_resolved_again_if_missing(self):
+        volume = 'mydisk'
+        wwn = self.random_string()
+        cfg = {'id': volume, 'type': 'disk', 'wwn': wwn}
+        s_cfg = OrderedDict({volume: cfg})
+        self.m_lookup.return_value = '/dev/sdb'
+        self.m_exists.side_effect = lambda path: path != '/dev/sda'
+        cache = block_meta.VolumePathCache()
+        cache.add(volume, '/dev/sda')
+        self.add_patch('curtin.commands.block_meta._VOLUME_PATH_CACHE',
+                       'm_cache', new=cache, autospec=None)
+        self.assertEqual('/dev/sdb',
+                         block_meta.get_path_to_storage_volume(volume, s_cfg))
+        self.assertEqual([call(wwn)], self.m_lookup.call_args_list)
+        self.assertEqual('/dev/sdb', cache.get(volume))
+
+
+class TestVolumePathCache(CiTestCase):
+
+    def test_invalidate_drops_derived_paths(self):
+        cache = block_meta.VolumePathCache()
+        cache.add('sda', '/dev/sda')
+        cache.add('sda1', '/dev/sda1', ['sda'])
+        cache.add('bcache0', '/dev/bcache0', ['sda1'])
+        cache.add('sdb', '/dev/sdb')
+        cache.invalidate('sda')
+        self.assertIsNone(cache.get('sda'))
+        self.assertIsNone(cache.get('sda1'))
+        self.assertIsNone(cache.get('bcache0'))
+        self.assertEqual('/dev/sdb', cache.get('sdb'))
+
+    def test_invalidate_keeps_parents(self):
+        cache = block_meta.VolumePathCache()
+        cache.add('sda', '/dev/sda')
+        cache.add('sda1', '/dev/sda1', ['sda'])
+        cache.invalidate('sda1')
+        self.assertIsNone(cache.get('sda1'))
+        self.assertEqual('/dev/sda', cache.get('sda'))
+
 
 class TestBlockMetaSimple(CiTestCase):
     def setUp(self):
@@ -135,6 +190,122 @@ class TestBlockMetaSimple(CiTestCase):
         self.add_patch('curtin.util.subp', 'mock_subp')
         self.add_patch('curtin.util.load_command_environment',
                        'mock_load_env')
+        # image
+        self.add_patch(basepath + 'block_image.supported', 'm_supported')
+        self.add_patch(basepath + 'block_image.write_image', 'm_write_image')
+
+    def test_write_image_to_disk_native(self):
+        source = {
+            'type': 'dd-xz',
+            'uri': 'http://myhost/curtin-unittest-dd.xz'
+        }
+        devname = "fakedisk1p1"
+        devnode = "/dev/" + devname
+        self.mock_block_get_dev_name_entry.return_value = (devname, devnode)
+        self.mock_load_env.return_value = {'report_stack_prefix': 'prefix'}
+        self.m_supported.return_value = True
+
+        block_meta.write_image_to_disk(source, devname)
+
+        self.m_supported.assert_called_with('dd-xz')
+        self.m_write_image.assert_called_with(source, devnode, mirrors=[],
+                                              stack_prefix='prefix')
+        self.mock_subp.assert_has_calls([call(['partprobe', devnode]),
+                                         call(['udevadm', 'settle'])])
+        self.assertEqual(2, self.mock_subp.call_count)
+        paths = ["curtin", "system-data/var/lib/snapd", "snaps"]
+        self.mock_block_get_root_device.assert_called_with([devname],
+                                                           paths=paths)
+
+    def test_write_image_to_disk_mirrors(self):
+        source = {
+            'type': 'dd-xz',
+            'uri': 'http://myhost/curtin-unittest-dd.xz'
+        }
+        self.mock_block_get_dev_name_entry.side_effect = (
+            lambda dev: (dev, '/dev/' + dev))
+        self.mock_load_env.return_value = {}
+        self.m_supported.return_value = True
+
+        block_meta.write_image_to_disk(source, 'sda', mirrors=['sdb', 'sdc'])
+
+        self.m_write_image.assert_called_with(
+            source, '/dev/sda', mirrors=['/dev/sdb', '/dev/sdc'],
+            stack_prefix='')
+        self.mock_subp.assert_has_calls([call(['partprobe', '/dev/sda']),
+                                         call(['partprobe', '/dev/sdb']),
+                                         call(['partprobe', '/dev/sdc']),
+                                         call(['udevadm', 'settle'])])
+        self.mock_block_get_root_device.assert_called_with(
+            ['sda'], paths=ANY)
+
+        self.m_supported.return_value = False
+        with self.assertRaisesRegexp(ValueError, 'not supported'):
+            block_meta.write_image_to_disk(source, 'sda', mirrors=['sdb'])
+
+    def test_write_image_to_disk_failed_mirrors(self):
+        source = {
+            'type': 'dd-xz',
+            'uri': 'http://myhost/curtin-unittest-dd.xz'
+        }
+        self.mock_block_get_dev_name_entry.side_effect = (
+            lambda dev: (dev, '/dev/' + dev))
+        self.mock_load_env.return_value = {}
+        self.m_supported.return_value = True
+        self.m_write_image.return_value = {
+            'bytes': 1024, 'mirrors': {
+                '/dev/sdb': {'error': 'No such device'},
+                '/dev/sdc': {'bytes': 1024}, '/dev/sdd': {'bytes': 1024}}}
+
+        def subp(args, **kwargs):
+            if args == ['partprobe', '/dev/sdc']:
+                raise util.ProcessExecutionError(cmd=args, exit_code=1)
+            return ('', '')
+        self.mock_subp.side_effect = subp
+
+        block_meta.write_image_to_disk(source, 'sda',
+                                       mirrors=['sdb', 'sdc', 'sdd'])
+
+        self.assertEqual([call(['partprobe', '/dev/sda']),
+                          call(['partprobe', '/dev/sdc']),
+                          call(['partprobe', '/dev/sdd']),
+                          call(['udevadm', 'settle'])],
+                         self.mock_subp.call_args_list)
+        self.mock_block_get_root_device.assert_called_with(
+            ['sda'], paths=ANY)
+
+        # the target device is not isolated
+        self.mock_subp.side_effect = util.ProcessExecutionError(
+            cmd=['partprobe'], exit_code=1)
+        with self.assertRaises(util.ProcessExecutionError):
+            block_meta.write_image_to_disk(source, 'sda', mirrors=['sdc'])
+
+    def test_write_image_to_disk_fallback_refuses_unsupported_keys(self):
+        self.mock_block_get_dev_name_entry.return_value = ('sda', '/dev/sda')
+        self.m_supported.return_value = False
+        for key, value in (('bmap', 'http://myhost/disk.bmap'),
+                           ('checksum', 'sha256:' + '0' * 64)):
+            source = {'type': 'dd-xz', 'uri': 'http://myhost/disk.xz',
+                      key: value}
+            with self.assertRaisesRegexp(ValueError, 'not supported'):
+                block_meta.write_image_to_disk(source, 'sda')
+        self.assertEqual(0, self.mock_subp.call_count)
+
+        # zero_blocks only changes how the image is written
+        source = {'type': 'dd-xz', 'uri': 'http://myhost/disk.xz',
+                  'zero_blocks': 'punch'}
+        block_meta.write_image_to_disk(source, 'sda')
+        self.assertEqual(3, self.mock_subp.call_count)
+
+    def test_get_image_mirrors(self):
+        self.assertEqual([], block_meta.get_image_mirrors({}))
+        self.assertEqual(
+            ['/dev/sdb', '/dev/sdc'],
+            block_meta.get_image_mirrors({'block-meta': {
+                'image-mirrors': ['/dev/sdb', '/dev/sdc', '/dev/sdb']}}))
+        with self.assertRaisesRegexp(ValueError, 'list of devices'):
+            block_meta.get_image_mirrors(
+                {'block-meta': {'image-mirrors': '/dev/sdb'}})
 
     def test_write_image_to_disk(self):
         source = {
@@ -144,6 +315,7 @@ class TestBlockMetaSimple(CiTestCase):
         devname = "fakedisk1p1"
         devnode = "/dev/" + devname
         self.mock_block_get_dev_name_entry.return_value = (devname, devnode)
+        self.m_supported.return_value = False
 
         block_meta.write_image_to_disk(source, devname)
 
@@ -166,9 +338,11 @@ class TestBlockMetaSimple(CiTestCase):
         devname = "fakedisk1p1"
         devnode = "/dev/" + devname
         self.mock_block_get_dev_name_entry.return_value = (devname, devnode)
+        self.m_supported.return_value = False
 
         block_meta.write_image_to_disk(source, devname)
 
+        self.assertEqual(0, self.m_write_image.call_count)
         wget = ['sh', '-c',
                 'wget "$1" --progress=dot:mega -O - |'
                 'tar -xOzf -| dd bs=4M of="$2"',
@@ -205,10 +379,48 @@ class TestBlockMetaSimple(CiTestCase):
 
         block_meta.block_meta(args)
 
-        mock_write_image.assert_called_with(sources.get('unittest'), devname)
+        mock_write_image.assert_called_with(sources.get('unittest'), devname,
+                                            mirrors=[])
         self.mock_subp.assert_has_calls(
             [call(['mount', devname, self.target])])
 
+    @patch('curtin.commands.block_meta.meta_clear')
+    @patch('curtin.commands.block_meta.write_image_to_disk')
+    def test_meta_simple_writes_img_to_mirrors(self, mock_write_image,
+                                               mock_clear):
+        devname = "fakedisk1p1"
+        sources = {
+            'unittest': {'type': 'dd-xz',
+                         'uri': 'http://myhost/curtin-unittest-dd.xz'}
+        }
+        config = {
+            'block-meta': {'devices': [devname],
+                           'image-mirrors': ['/dev/sdb', '/dev/sdc']},
+            'sources': sources,
+        }
+        self.mock_config_load.return_value = config
+        self.mock_load_env.return_value = {'target': self.target}
+        self.mock_block_is_valid_device.return_value = True
+        self.mock_block_get_dev_name_entry.return_value = (
+            devname, "/dev/" + devname)
+        mock_write_image.return_value = devname
+
+        args = Namespace(target=self.target, devices=None, mode=None,
+                         boot_fstype=None, fstype=None, force_mode=False)
+
+        block_meta.block_meta(args)
+
+        mock_clear.assert_called_with([devname, '/dev/sdb', '/dev/sdc'],
+                                      ANY, max_workers=1)
+        mock_write_image.assert_called_with(
+            sources.get('unittest'), devname,
+            mirrors=['/dev/sdb', '/dev/sdc'])
+
+        self.mock_block_is_valid_device.side_effect = (
+            lambda dev: dev != '/dev/sdc')
+        with self.assertRaisesRegexp(Exception, "'/dev/sdc' is not a valid"):
+            block_meta.block_meta(args)
+
 
 class TestBlockMeta(CiTestCase):
 
@@ -249,6 +461,10 @@ class TestBlockMeta(CiTestCase):
                        'mock_block_zero_file')
         self.add_patch('curtin.block.rescan_block_devices',
                        'mock_block_rescan')
+        self.add_patch('curtin.block.register_partitions',
+                       'mock_block_register_partitions')
+        self.add_patch('curtin.commands.block_meta.wait_for_device',
+                       'mock_wait_for_device')
         self.add_patch('curtin.block.get_blockdev_sector_size',
                        'mock_block_sector_size')
 
@@ -1308,6 +1524,61 @@ class TestDiskHandler(CiTestCase):
         m_subp.assert_called_once_with(['fdasd', '-c', '/dev/null', path])
 
 
+class TestPrewipeDisks(CiTestCase):
+
+    def setUp(self):
+        super(TestPrewipeDisks, self).setUp()
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(basepath + 'block.wipe_volumes', 'm_wipe_volumes')
+        self.add_patch(basepath + 'get_path_to_storage_volume', 'm_getpath')
+        self.add_patch(basepath + '_PREWIPED_DISKS', 'm_prewiped',
+                       new=set(), autospec=None)
+        self.m_getpath.side_effect = lambda item_id, sconfig: '/dev/' + item_id
+        self.storage_config = OrderedDict()
+        for item in [
+                {'id': 'sda', 'type': 'disk', 'wipe': 'zero'},
+                {'id': 'sdb', 'type': 'disk', 'wipe': 'superblock',
+                 'preserve': True},
+                {'id': 'sdc', 'type': 'disk', 'wipe': 'random'},
+                {'id': 'sdd', 'type': 'disk'},
+                {'id': 'dasd0', 'type': 'dasd', 'device_id': '0.0.1544'},
+                {'id': 'dasda', 'type': 'disk', 'wipe': 'superblock',
+                 'device_id': '0.0.1544'},
+                {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+                 'wipe': 'zero'}]:
+            self.storage_config[item['id']] = item
+
+    def test_prewipe_disks(self):
+        block_meta.prewipe_disks(self.storage_config, 4, bandwidth=1000)
+        self.m_wipe_volumes.assert_called_with(
+            [('/dev/sda', 'zero'), ('/dev/sdc', 'random')],
+            max_workers=4, bandwidth=1000)
+        self.assertEqual({'sda', 'sdc'}, self.m_prewiped)
+
+    @patch('curtin.commands.block_meta.clear_holders')
+    @patch('curtin.commands.block_meta.block')
+    def test_disk_handler_skips_prewiped_disk(self, m_block, m_clear_holders):
+        m_clear_holders.get_holders.return_value = []
+        self.m_prewiped.add('sda')
+        block_meta.disk_handler(self.storage_config['sda'],
+                                self.storage_config)
+        self.assertEqual(0, m_block.wipe_volume.call_count)
+        block_meta.disk_handler(self.storage_config['sdc'],
+                                self.storage_config)
+        m_block.wipe_volume.assert_called_with('/dev/sdc', mode='random')
+
+    def test_get_wipe_settings(self):
+        self.assertEqual((1, None), block_meta.get_wipe_settings({}))
+        self.assertEqual(
+            (8, 500 * 1024 ** 2),
+            block_meta.get_wipe_settings(
+                {'block-meta': {'wipe-workers': '8',
+                                'wipe-bandwidth': '500M'}}))
+        with self.assertRaises(ValueError):
+            block_meta.get_wipe_settings(
+                {'block-meta': {'wipe-workers': 'many'}})
+
+
 class TestLvmVolgroupHandler(CiTestCase):
 
     def setUp(self):
@@ -1800,6 +2071,7 @@ class TestRaidHandler(CiTestCase):
         self.add_patch(basepath + 'mdadm', 'm_mdadm')
         self.add_patch(basepath + 'block', 'm_block')
         self.add_patch(basepath + 'udevadm_settle', 'm_uset')
+        self.add_patch(basepath + 'wait_for_device', 'm_wait')
 
         # The behavior of this function is being directly tested in
         # these tests, so we can't mock it
@@ -2077,6 +2349,7 @@ class TestPartitionHandler(CiTestCase):
         self.add_patch(basepath + 'block', 'm_block')
         self.add_patch(basepath + 'multipath', 'm_mp')
         self.add_patch(basepath + 'udevadm_settle', 'm_uset')
+        self.add_patch(basepath + 'wait_for_device', 'm_wait')
         self.add_patch(basepath + 'udevadm_info', 'm_uinfo')
 
         self.target = "my_target"
@@ -2232,6 +2505,170 @@ class TestPartitionHandler(CiTestCase):
         m_verify_fdasd.assert_has_calls([call(devpath, 1, sconfig[1])])
 
 
+class TestPartitionIndex(CiTestCase):
+
+    def setUp(self):
+        super(TestPartitionIndex, self).setUp()
+        self.storage_config = OrderedDict()
+        for item in [
+                {'id': 'sda', 'type': 'disk', 'ptable': 'msdos'},
+                {'id': 'sdb', 'type': 'disk', 'ptable': 'gpt'},
+                {'id': 'sda1', 'type': 'partition', 'device': 'sda'},
+                {'id': 'sdb1', 'type': 'partition', 'device': 'sdb'},
+                {'id': 'sda2', 'type': 'partition', 'device': 'sda',
+                 'flag': 'extended'},
+                {'id': 'sda5', 'type': 'partition', 'device': 'sda',
+                 'flag': 'logical'},
+                {'id': 'sdb2', 'type': 'partition', 'device': 'sdb',
+                 'number': 7},
+                {'id': 'sda6', 'type': 'partition', 'device': 'sda',
+                 'flag': 'logical'},
+                {'id': 'sdb3', 'type': 'partition', 'device': 'sdb'}]:
+            self.storage_config[item['id']] = item
+        self.part_ids = [item_id for item_id, item
+                         in self.storage_config.items()
+                         if item['type'] == 'partition']
+
+    def _lookups(self):
+        results = {}
+        for part_id in self.part_ids:
+            disk = self.storage_config[part_id]['device']
+            results[part_id] = (
+                block_meta.determine_partition_number(
+                    part_id, self.storage_config),
+                block_meta.find_previous_partition(
+                    disk, part_id, self.storage_config),
+                block_meta.find_extended_partition(
+                    disk, self.storage_config),
+                block_meta.getnumberoflogicaldisks(
+                    disk, self.storage_config))
+        return results
+
+    def test_index_matches_config_scan(self):
+        expected = self._lookups()
+        self.assertEqual((6, 5, 'sda2', 2), expected['sda6'])
+        self.assertEqual((3, 7, None, 0), expected['sdb3'])
+        self.add_patch('curtin.commands.block_meta._PARTITION_INDEX',
+                       'm_index', autospec=None,
+                       new=block_meta.PartitionIndex(self.storage_config))
+        self.assertEqual(expected, self._lookups())
+
+    def test_index_ignored_for_other_storage_config(self):
+        other = copy.deepcopy(self.storage_config)
+        self.add_patch('curtin.commands.block_meta._PARTITION_INDEX',
+                       'm_index', autospec=None,
+                       new=block_meta.PartitionIndex(other))
+        self.assertIsNone(block_meta.get_partition_index(self.storage_config))
+        self.assertIsNotNone(block_meta.get_partition_index(other))
+
+
+class TestPartitionBatchHandler(CiTestCase):
+
+    def setUp(self):
+        super(TestPartitionBatchHandler, self).setUp()
+
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(basepath + 'get_path_to_storage_volume', 'm_getpath')
+        self.add_patch(basepath + 'util.subp', 'm_subp')
+        self.add_patch(basepath + 'make_dname', 'm_dname')
+        self.add_patch(basepath + 'multipath', 'm_mp')
+        self.add_patch(basepath + 'udevadm_settle', 'm_uset')
+        self.add_patch(basepath + 'wait_for_device', 'm_wait')
+        self.add_patch(basepath + 'block.get_blockdev_sector_size',
+                       'm_sector_size')
+        self.add_patch(basepath + 'block.register_partitions',
+                       'm_register')
+        self.add_patch(basepath + 'block.zero_file_at_offsets', 'm_zero')
+        self.add_patch(basepath + 'block.wipe_volume', 'm_wipe')
+        self.add_patch(basepath + 'block.path_to_kname', 'm_kname')
+        self.add_patch(basepath + '_PARTITION_BATCHES', 'm_batches',
+                       new={}, autospec=None)
+        self.m_getpath.return_value = '/dev/sda'
+        self.m_kname.return_value = 'sda'
+        self.m_sector_size.return_value = (512, 512)
+        self.m_mp.is_mpath_device.return_value = False
+
+        self.config = {
+            'storage': {
+                'version': 1,
+                'config': [
+                    {'id': 'sda', 'type': 'disk', 'ptable': 'msdos',
+                     'serial': 'disk-a'},
+                    {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+                     'number': 1, 'size': '3GB', 'flag': 'boot'},
+                    {'id': 'sda2', 'type': 'partition', 'device': 'sda',
+                     'number': 2, 'size': '5GB', 'flag': 'extended'},
+                    {'id': 'sda5', 'type': 'partition', 'device': 'sda',
+                     'number': 5, 'size': '2GB', 'flag': 'logical',
+                     'wipe': 'superblock'},
+                    {'id': 'sda6', 'type': 'partition', 'device': 'sda',
+                     'number': 6, 'size': '2GB', 'flag': 'logical'},
+                ],
+            }
+        }
+        self.sconfig = block_meta.extract_storage_ordered_dict(self.config)
+
+    def test_calc_partition_layout_msdos(self):
+        layout = block_meta.calc_partition_layout('sda', self.sconfig, 512)
+        self.assertEqual([
+            block_meta.PartitionLayout(
+                'sda1', 1, 2048, 6291455, 'primary', 'boot'),
+            block_meta.PartitionLayout(
+                'sda2', 2, 6293504, 10489855, 'extended', 'extended'),
+            block_meta.PartitionLayout(
+                'sda5', 5, 6295552, 4194303, 'logical', 'logical'),
+            block_meta.PartitionLayout(
+                'sda6', 6, 10491904, 4194303, 'logical', 'logical'),
+            ], layout)
+
+    def test_partition_table_cmd_gpt(self):
+        layout = [
+            block_meta.PartitionLayout('p1', 1, 2048, 2047, None, 'bios_grub'),
+            block_meta.PartitionLayout('p2', 2, 4096, 8191, None, None),
+        ]
+        self.assertEqual(
+            ['sgdisk', '--new', '1:2048:4095', '--typecode=1:ef02',
+             '--new', '2:4096:12287', '--typecode=2:8300', '/dev/sda'],
+            block_meta.partition_table_cmd('/dev/sda', 'gpt', layout))
+
+    def test_batch_handler_writes_table_once(self):
+        for item_id in ('sda1', 'sda2', 'sda5', 'sda6'):
+            block_meta.partition_batch_handler(self.sconfig[item_id],
+                                               self.sconfig)
+
+        self.assertEqual([call([
+            'parted', '/dev/sda', '--script',
+            'mkpart', 'primary', '2048s', '6293503s',
+            'set', '1', 'boot', 'on',
+            'mkpart', 'extended', '6293504s', '16783359s',
+            'mkpart', 'logical', '6295552s', '10489855s',
+            'mkpart', 'logical', '10491904s', '14686207s'], capture=True)],
+            self.m_subp.call_args_list)
+        self.assertEqual([call('/dev/sda', [1, 2, 5, 6])],
+                         self.m_register.call_args_list)
+        self.assertEqual([call('/dev/sda', [6295552 * 512], exclusive=False)],
+                         self.m_zero.call_args_list)
+        self.assertEqual(
+            [call('/dev/sda%s' % num) for num in (1, 2, 5, 6)],
+            self.m_wait.call_args_list)
+        # superblock wipe of new partitions is done by the pre-wipe
+        self.assertEqual(0, self.m_wipe.call_count)
+
+    @patch('curtin.commands.block_meta.partition_handler')
+    def test_batch_handler_falls_back_with_preserved_partition(self, m_ph):
+        self.sconfig['sda6']['preserve'] = True
+        block_meta.partition_batch_handler(self.sconfig['sda1'], self.sconfig)
+        m_ph.assert_called_with(self.sconfig['sda1'], self.sconfig)
+        self.assertEqual(0, self.m_subp.call_count)
+
+    @patch('curtin.commands.block_meta.partition_handler')
+    def test_batch_handler_falls_back_for_multipath(self, m_ph):
+        self.m_mp.is_mpath_device.return_value = True
+        block_meta.partition_batch_handler(self.sconfig['sda1'], self.sconfig)
+        m_ph.assert_called_with(self.sconfig['sda1'], self.sconfig)
+        self.assertEqual(0, self.m_subp.call_count)
+
+
 class TestMultipathPartitionHandler(CiTestCase):
 
     def setUp(self):
@@ -2244,6 +2681,7 @@ class TestMultipathPartitionHandler(CiTestCase):
         self.add_patch(basepath + 'block', 'm_block')
         self.add_patch(basepath + 'multipath', 'm_mp')
         self.add_patch(basepath + 'udevadm_settle', 'm_uset')
+        self.add_patch(basepath + 'wait_for_device', 'm_wait')
         self.add_patch(basepath + 'udevadm_info', 'm_uinfo')
 
         self.target = self.tmp_dir()
@@ -2561,6 +2999,73 @@ class TestVerifyExists(CiTestCase):
             self.m_exists.call_args_list)
 
 
+class TestGetUdevInfo(CiTestCase):
+
+    def setUp(self):
+        super(TestGetUdevInfo, self).setUp()
+        self.add_patch('curtin.commands.block_meta.udevadm_info',
+                       'm_udevadm_info')
+
+    def test_get_udev_info_without_database(self):
+        with patch('curtin.commands.block_meta._UDEV_DB', None):
+            info = block_meta.get_udev_info('/dev/sda')
+        self.assertEqual(self.m_udevadm_info.return_value, info)
+        self.m_udevadm_info.assert_called_with(path='/dev/sda')
+
+    def test_get_udev_info_uses_database(self):
+        with patch('curtin.commands.block_meta._UDEV_DB') as m_db:
+            info = block_meta.get_udev_info('/dev/sda')
+        self.assertEqual(m_db.get.return_value, info)
+        m_db.get.assert_called_with('/dev/sda')
+        self.assertEqual(0, self.m_udevadm_info.call_count)
+
+
+class TestGetSfdiskInfo(CiTestCase):
+
+    def setUp(self):
+        super(TestGetSfdiskInfo, self).setUp()
+        base = 'curtin.commands.block_meta.'
+        self.add_patch(base + 'block.sfdisk_info', 'm_block_sfdisk_info')
+        self.add_patch(base + 'block.get_blockdev_for_partition',
+                       'm_block_get_blockdev_for_partition')
+        self.m_block_get_blockdev_for_partition.side_effect = (
+            lambda devpath: (devpath[:-1], devpath[-1]))
+        self.m_block_sfdisk_info.side_effect = (
+            lambda devpath: {'device': devpath[:-1], 'partitions': []})
+        self.add_patch(base + '_SFDISK_INFO', '_sfdisk_info', autospec=None,
+                       new={})
+
+    def test_get_sfdisk_info_reads_each_disk_once(self):
+        self.assertEqual({'device': '/dev/vda', 'partitions': []},
+                         block_meta.get_sfdisk_info('/dev/vda1'))
+        block_meta.get_sfdisk_info('/dev/vda2')
+        block_meta.get_sfdisk_info('/dev/vdb1')
+        self.assertEqual([call('/dev/vda1'), call('/dev/vdb1')],
+                         self.m_block_sfdisk_info.call_args_list)
+
+    def test_get_sfdisk_info_rereads_invalidated_disk(self):
+        block_meta.get_sfdisk_info('/dev/vda1')
+        block_meta.invalidate_sfdisk_info('/dev/vda')
+        block_meta.get_sfdisk_info('/dev/vda2')
+        self.assertEqual([call('/dev/vda1'), call('/dev/vda2')],
+                         self.m_block_sfdisk_info.call_args_list)
+
+    def test_get_sfdisk_info_does_not_keep_failed_reads(self):
+        self.m_block_sfdisk_info.side_effect = None
+        self.m_block_sfdisk_info.return_value = {}
+        block_meta.get_sfdisk_info('/dev/vda1')
+        block_meta.get_sfdisk_info('/dev/vda2')
+        self.assertEqual(2, self.m_block_sfdisk_info.call_count)
+
+    def test_get_sfdisk_info_without_cache(self):
+        with patch('curtin.commands.block_meta._SFDISK_INFO', None):
+            block_meta.get_sfdisk_info('/dev/vda1')
+            block_meta.get_sfdisk_info('/dev/vda1')
+        self.assertEqual(2, self.m_block_sfdisk_info.call_count)
+        self.assertEqual(
+            0, self.m_block_get_blockdev_for_partition.call_count)
+
+
 class TestVerifySize(CiTestCase):
 
     def setUp(self):
@@ -2794,4 +3299,154 @@ class TestGetDevicePathsFromStorageConfig(CiTestCase):
             self.m_exists.call_args_list)
 
 
+class TestHandlerDependencies(CiTestCase):
+
+    def setUp(self):
+        super(TestHandlerDependencies, self).setUp()
+        self.config = {
+            'storage': {
+                'version': 1,
+                'config': [
+                    {'id': 'sda', 'type': 'disk', 'ptable': 'gpt',
+                     'serial': 'disk-a'},
+                    {'id': 'sdb', 'type': 'disk', 'ptable': 'gpt',
+                     'serial': 'disk-b'},
+                    {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+                     'size': '1G'},
+                    {'id': 'sdb1', 'type': 'partition', 'device': 'sdb',
+                     'size': '1G'},
+                    {'id': 'sda2', 'type': 'partition', 'device': 'sda',
+                     'size': '1G'},
+                    {'id': 'sda1_fmt', 'type': 'format', 'fstype': 'ext4',
+                     'volume': 'sda1'},
+                    {'id': 'sdb1_fmt', 'type': 'format', 'fstype': 'ext4',
+                     'volume': 'sdb1'},
+                    {'id': 'vg0', 'type': 'lvm_volgroup', 'name': 'vg0',
+                     'devices': ['sda2']},
+                    {'id': 'lv1', 'type': 'lvm_partition', 'name': 'lv1',
+                     'volgroup': 'vg0', 'size': '1G'},
+                    {'id': 'lv2', 'type': 'lvm_partition', 'name': 'lv2',
+                     'volgroup': 'vg0'},
+                    {'id': 'root', 'type': 'mount', 'path': '/',
+                     'device': 'sda1_fmt'},
+                    {'id': 'srv', 'type': 'mount', 'path': '/srv',
+                     'device': 'sdb1_fmt'},
+                ],
+            }
+        }
+        self.sconfig = block_meta.extract_storage_ordered_dict(self.config)
+
+    def test_handler_dependencies(self):
+        depends = block_meta.get_handler_dependencies(self.sconfig)
+        self.assertEqual(list(self.sconfig.keys()), list(depends.keys()))
+        self.assertEqual(set(), depends['sda'])
+        self.assertEqual(set(), depends['sdb'])
+        self.assertEqual({'sda'}, depends['sda1'])
+        self.assertEqual({'sdb'}, depends['sdb1'])
+        # partitions on the same disk are created in order
+        self.assertEqual({'sda', 'sda1'}, depends['sda2'])
+        # partition users wait for the whole partition table
+        self.assertEqual({'sda1', 'sda2'}, depends['sda1_fmt'])
+        self.assertEqual({'sdb1'}, depends['sdb1_fmt'])
+        self.assertEqual({'sda1', 'sda2'}, depends['vg0'])
+        self.assertEqual({'vg0'}, depends['lv1'])
+        self.assertEqual({'vg0', 'lv1'}, depends['lv2'])
+        self.assertEqual({'sda1_fmt'}, depends['root'])
+        self.assertEqual({'sdb1_fmt', 'root'}, depends['srv'])
+
+    def test_handler_dependencies_disk_waits_for_dasd(self):
+        self.config['storage']['config'] = [
+            {'id': 'dasd0', 'type': 'dasd', 'device_id': '0.0.1544',
+             'blocksize': 4096, 'mode': 'quick', 'disk_layout': 'cdl'},
+            {'id': 'disk0', 'type': 'disk', 'device_id': '0.0.1544',
+             'ptable': 'vtoc'},
+        ]
+        sconfig = block_meta.extract_storage_ordered_dict(self.config)
+        depends = block_meta.get_handler_dependencies(sconfig)
+        self.assertEqual({'dasd0'}, depends['disk0'])
+
+    def test_get_parallel_workers(self):
+        self.assertEqual(1, block_meta.get_parallel_workers({}))
+        self.assertEqual(
+            1, block_meta.get_parallel_workers({'block-meta': {}}))
+        self.assertEqual(
+            1, block_meta.get_parallel_workers(
+                {'block-meta': {'parallel': 0}}))
+        self.assertEqual(
+            8, block_meta.get_parallel_workers(
+                {'block-meta': {'parallel': '8'}}))
+        with self.assertRaises(ValueError):
+            block_meta.get_parallel_workers(
+                {'block-meta': {'parallel': 'many'}})
+
+    def test_get_clear_holders_workers(self):
+        self.assertEqual(1, block_meta.get_clear_holders_workers({}))
+        self.assertEqual(
+            4, block_meta.get_clear_holders_workers(
+                {'block-meta': {'clear-holders-workers': '4'}}))
+        with self.assertRaises(ValueError):
+            block_meta.get_clear_holders_workers(
+                {'block-meta': {'clear-holders-workers': 'many'}})
+
+
+class TestMetaCustom(CiTestCase):
+
+    def setUp(self):
+        super(TestMetaCustom, self).setUp()
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(basepath + 'util.load_command_environment', 'm_env')
+        self.add_patch(basepath + 'config.load_command_config', 'm_cfg')
+        self.add_patch(basepath + 'disk_handler', 'm_disk')
+        self.add_patch(basepath + 'partition_handler', 'm_part')
+        self.m_env.return_value = {'target': '/target'}
+        self.config = {
+            'storage': {
+                'version': 1,
+                'config': [
+                    {'id': 'sda', 'type': 'disk', 'serial': 'disk-a'},
+                    {'id': 'sdb', 'type': 'disk', 'serial': 'disk-b'},
+                    {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+                     'size': '1G'},
+                    {'id': 'sdb1', 'type': 'partition', 'device': 'sdb',
+                     'size': '1G'},
+                ],
+            }
+        }
+        self.m_cfg.return_value = self.config
+        self.args = Namespace(umount=False)
+
+    def _handled(self):
+        return [mock_call[1][0]['id'] for mock_call in
+                self.m_disk.mock_calls + self.m_part.mock_calls]
+
+    def test_meta_custom_serial_in_config_order(self):
+        seen = []
+        self.m_disk.side_effect = lambda info, sconfig: seen.append(info['id'])
+        self.m_part.side_effect = lambda info, sconfig: seen.append(info['id'])
+        block_meta.meta_custom(self.args)
+        self.assertEqual(['sda', 'sdb', 'sda1', 'sdb1'], seen)
+
+    def test_meta_custom_parallel_handles_all_items(self):
+        self.config['block-meta'] = {'parallel': 4}
+        block_meta.meta_custom(self.args)
+        self.assertEqual(['sda', 'sda1', 'sdb', 'sdb1'],
+                         sorted(self._handled()))
+
+    def test_meta_custom_parallel_rejects_unknown_type(self):
+        self.config['block-meta'] = {'parallel': 4}
+        self.config['storage']['config'].append(
+            {'id': 'foo', 'type': 'unknown'})
+        with self.assertRaises(ValueError):
+            block_meta.meta_custom(self.args)
+        self.assertEqual([], self._handled())
+
+    def test_meta_custom_resets_caches_on_failure(self):
+        self.m_part.side_effect = OSError('partitioning failed')
+        with self.assertRaises(OSError):
+            block_meta.meta_custom(self.args)
+        self.assertIsNone(block_meta._PARTITION_INDEX)
+        self.assertIsNone(block_meta._VOLUME_PATH_CACHE)
+        self.assertIsNone(block_meta._SFDISK_INFO)
+        self.assertIsNone(block_meta._UDEV_DB)
+
 # vi: ts=4 expandtab syntax=python
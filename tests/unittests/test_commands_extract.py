@@ -1,11 +1,16 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
+import mock
 import os
+import threading
+import time
 
 from .helpers import CiTestCase
 
 from curtin import util
 from curtin.commands.extract import (extract_root_fsimage_url,
                                      extract_root_layered_fsimage_url,
+                                     get_download_workers,
+                                     _extract_root_layered_fsimage,
                                      _get_image_stack)
 from curtin.url_helper import UrlError
 
@@ -75,7 +80,7 @@ class TestExtractRootFsImageUrl(CiTestCase):
 
 class TestExtractRootLayeredFsImageUrl(CiTestCase):
     """Test extract_root_layared_fsimage_url."""
-    def _fake_download(self, url, path, retries=0):
+    def _fake_download(self, url, path, retries=0, reporthook=None):
         self.downloads.append(os.path.abspath(path))
         with open(path, "w") as fp:
             fp.write("fake content from " + url + "\n")
@@ -86,7 +91,14 @@ class TestExtractRootLayeredFsImageUrl(CiTestCase):
         self.add_patch("curtin.commands.extract.url_helper.download",
                        "m_download", side_effect=self._fake_download)
         self.add_patch("curtin.commands.extract._extract_root_layered_fsimage",
-                       "m__extract_root_layered_fsimage")
+                       "m__extract_root_layered_fsimage",
+                       side_effect=self._fake_extract)
+
+    def _fake_extract(self, image_stack, target, fetch=None):
+        # fetch every layer as mounting them would
+        for img in image_stack:
+            if fetch is not None:
+                fetch(img)
 
     def test_relative_local_file_single(self):
         """extract_root_layered_fsimage_url supports relative file:// uris."""
@@ -210,7 +222,8 @@ class TestExtractRootLayeredFsImageUrl(CiTestCase):
         """extract_root_layered_fsimage_url supports normal hierarchy from
            http:// urls with one layer missing."""
 
-        def fail_download_minimal_standard(url, path, retries=0):
+        def fail_download_minimal_standard(url, path, retries=0,
+                                           reporthook=None):
             if url == "http://example.io/minimal.standard.squashfs":
                 raise UrlError(url, 404, "Couldn't download",
                                None, None)
@@ -222,7 +235,8 @@ class TestExtractRootLayeredFsImageUrl(CiTestCase):
         myurl = "http://example.io/minimal.standard.debug.squashfs"
         self.assertRaises(UrlError, extract_root_layered_fsimage_url,
                           myurl, target)
-        self.assertEqual(0, self.m__extract_root_layered_fsimage.call_count)
+        # mounting starts before every layer has arrived
+        self.assertEqual(1, self.m__extract_root_layered_fsimage.call_count)
         self.assertEqual(2, self.m_download.call_count)
         for i, image_url in enumerate(["minimal.squashfs",
                                        "minimal.standard.squashfs"]):
@@ -235,7 +249,8 @@ class TestExtractRootLayeredFsImageUrl(CiTestCase):
         """extract_root_layered_fsimage_url supports normal hierarchy from
            http:// urls with one layer empty."""
 
-        def empty_download_minimal_standard(url, path, retries=0):
+        def empty_download_minimal_standard(url, path, retries=0,
+                                            reporthook=None):
             if url == "http://example.io/minimal.standard.squashfs":
                 self.downloads.append(os.path.abspath(path))
                 with open(path, "w") as fp:
@@ -249,16 +264,109 @@ class TestExtractRootLayeredFsImageUrl(CiTestCase):
         myurl = "http://example.io/minimal.standard.debug.squashfs"
         self.assertRaises(ValueError, extract_root_layered_fsimage_url,
                           myurl, target)
-        self.assertEqual(0, self.m__extract_root_layered_fsimage.call_count)
-        self.assertEqual(3, self.m_download.call_count)
+        self.assertEqual(1, self.m__extract_root_layered_fsimage.call_count)
+        # no layer is downloaded after the empty one
+        self.assertEqual(2, self.m_download.call_count)
         for i, image_url in enumerate(["minimal.squashfs",
-                                       "minimal.standard.squashfs",
-                                       "minimal.standard.debug.squashfs"]):
+                                       "minimal.standard.squashfs"]):
             self.assertEqual("http://example.io/" + image_url,
                              self.m_download.call_args_list[i][0][0])
         # ensure the file got cleaned up.
         self.assertEqual([], [f for f in self.downloads if os.path.exists(f)])
 
+    def test_remote_file_multiple_concurrent(self):
+        """extract_root_layered_fsimage_url downloads download_workers
+           layers at the same time."""
+        last_started = threading.Event()
+
+        def download(url, path, retries=0, reporthook=None):
+            if url.endswith("debug.squashfs"):
+                last_started.set()
+            else:
+                # only returns early if the top layer is fetched meanwhile
+                last_started.wait(5)
+            return self._fake_download(url, path, retries)
+        self.m_download.side_effect = download
+
+        tmpd = self.tmp_dir()
+        target = self.tmp_path("target_d", tmpd)
+        myurl = "http://example.io/minimal.standard.debug.squashfs"
+        extract_root_layered_fsimage_url(myurl, target, download_workers=3)
+        self.assertTrue(last_started.is_set())
+        self.assertEqual(3, self.m_download.call_count)
+        self.assertEqual([], [f for f in self.downloads if os.path.exists(f)])
+
+    def test_remote_layer_failure_cancels_other_downloads(self):
+        """a failed layer stops the downloads of the others in progress."""
+        started = []
+        cancelled = []
+
+        def download(url, path, retries=0, reporthook=None):
+            if url.endswith("minimal.squashfs"):
+                # fail once the other layers are downloading
+                deadline = time.time() + 5
+                while len(started) < 2 and time.time() < deadline:
+                    time.sleep(0.01)
+                raise UrlError(url, 404, "Couldn't download", None, None)
+            started.append(url)
+            # a large layer, stopped by the hook at one of its chunks
+            try:
+                while True:
+                    reporthook(1, 8192, None)
+                    time.sleep(0.01)
+            except Exception:
+                cancelled.append(url)
+                raise
+        self.m_download.side_effect = download
+
+        tmpd = self.tmp_dir()
+        target = self.tmp_path("target_d", tmpd)
+        myurl = "http://example.io/minimal.standard.debug.squashfs"
+        self.assertRaises(UrlError, extract_root_layered_fsimage_url,
+                          myurl, target, download_workers=3)
+        self.assertEqual(
+            ["http://example.io/minimal.standard.debug.squashfs",
+             "http://example.io/minimal.standard.squashfs"],
+            sorted(cancelled))
+
+    def test_remote_layers_are_mounted_as_they_arrive(self):
+        """_extract_root_layered_fsimage mounts the lowest layer while the
+           next is still being downloaded."""
+        mounted = threading.Event()
+
+        def download(url, path, retries=0, reporthook=None):
+            if url.endswith("standard.squashfs"):
+                mounted.wait(5)
+                self.assertTrue(mounted.is_set())
+            return self._fake_download(url, path, retries)
+        self.m_download.side_effect = download
+
+        def subp(args, **kwargs):
+            if args[0] == 'mount':
+                mounted.set()
+            return ('', '')
+        self.m__extract_root_layered_fsimage.side_effect = (
+            _extract_root_layered_fsimage)
+        tmpd = self.tmp_dir()
+        target = self.tmp_path("target_d", tmpd)
+        myurl = "http://example.io/minimal.standard.squashfs"
+        with mock.patch("curtin.commands.extract.util.subp",
+                        side_effect=subp) as m_subp:
+            with mock.patch("curtin.commands.extract.copy_to_target"):
+                extract_root_layered_fsimage_url(myurl, target)
+        mounts = [c[0][0] for c in m_subp.call_args_list
+                  if c[0][0][0] == 'mount']
+        self.assertEqual(3, len(mounts))
+        self.assertEqual(2, self.m_download.call_count)
+
+    def test_get_download_workers(self):
+        """get_download_workers reads download_workers of a source."""
+        self.assertEqual(1, get_download_workers({}))
+        self.assertEqual(4, get_download_workers({'download_workers': '4'}))
+        self.assertEqual(1, get_download_workers({'download_workers': 0}))
+        with self.assertRaisesRegexp(ValueError, 'must be an integer'):
+            get_download_workers({'download_workers': 'many'})
+
 
 class TestGetImageStack(CiTestCase):
     """Test _get_image_stack."""
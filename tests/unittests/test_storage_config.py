@@ -981,6 +981,72 @@ class TestZfsParser(CiTestCase):
         self.assertEqual(4, len(zfs))
 
 
+class TestSortConfigByDependency(CiTestCase):
+
+    def _make_config(self, ndisks=4, nparts=5):
+        config = []
+        for disk in range(ndisks):
+            disk_id = 'disk%d' % disk
+            config.append({'id': disk_id, 'type': 'disk', 'ptable': 'gpt',
+                           'path': '/dev/vd%d' % disk})
+            for part in range(1, nparts + 1):
+                config.append({'id': '%s-part%d' % (disk_id, part),
+                               'type': 'partition', 'device': disk_id,
+                               'number': part, 'size': '1G'})
+        config.append({'id': 'md0', 'type': 'raid', 'name': 'md0',
+                       'raidlevel': 1,
+                       'devices': ['disk0-part1', 'disk1-part1']})
+        config.append({'id': 'vg0', 'type': 'lvm_volgroup', 'name': 'vg0',
+                       'devices': ['disk2-part1', 'disk3-part1']})
+        for lv in range(3):
+            config.append({'id': 'lv%d' % lv, 'type': 'lvm_partition',
+                           'volgroup': 'vg0', 'name': 'lv%d' % lv})
+        config.append({'id': 'bcache0', 'type': 'bcache', 'name': 'bcache0',
+                       'backing_device': 'md0',
+                       'cache_device': 'disk0-part2'})
+        for vol in ['bcache0', 'lv0', 'lv1', 'disk1-part3']:
+            config.append({'id': 'fmt-%s' % vol, 'type': 'format',
+                           'fstype': 'ext4', 'volume': vol})
+            config.append({'id': 'mnt-%s' % vol, 'type': 'mount',
+                           'path': '/srv/%s' % vol,
+                           'device': 'fmt-%s' % vol})
+        # list the probed items in an order unrelated to their dependencies
+        return list(reversed(config))
+
+    def test_matches_merged_config_trees(self):
+        config = self._make_config()
+        full_config = {'storage': {'version': 1, 'config': config}}
+        ctrees = [storage_config.get_config_tree(cfg['id'], full_config)
+                  for cfg in config]
+        expected = storage_config.merge_config_trees_to_list(ctrees)
+        sconfig = storage_config.extract_storage_ordered_dict(full_config)
+        self.assertEqual(
+            [cfg['id'] for cfg in expected],
+            [cfg['id'] for cfg in
+             storage_config.sort_config_by_dependency(sconfig)])
+
+    def test_levels_count_config_tree_ids(self):
+        config = self._make_config()
+        full_config = {'storage': {'version': 1, 'config': config}}
+        sconfig = storage_config.extract_storage_ordered_dict(full_config)
+        levels = storage_config.get_dependency_levels(sconfig)
+        for cfg in config:
+            tree = storage_config.get_config_tree(cfg['id'], full_config)
+            self.assertEqual(len(tree), levels[cfg['id']])
+
+    def test_dependency_cycle_raises(self):
+        config = [
+            {'id': 'md0', 'type': 'raid', 'name': 'md0', 'raidlevel': 1,
+             'devices': ['md0-part1']},
+            {'id': 'md0-part1', 'type': 'partition', 'device': 'md0',
+             'number': 1},
+        ]
+        sconfig = storage_config.extract_storage_ordered_dict(
+            {'storage': {'version': 1, 'config': config}})
+        with self.assertRaises(ValueError):
+            storage_config.sort_config_by_dependency(sconfig)
+
+
 class TestExtractStorageConfig(CiTestCase):
 
     def setUp(self):
@@ -1,14 +1,19 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+import errno
 import mock
+import os
 import shlex
+import stat
+import struct
 
 from curtin.udev import (
         udevadm_info,
         shlex_quote,
         )
+from curtin import udev
 from curtin import util
-from .helpers import CiTestCase
+from .helpers import CiTestCase, populate_dir
 
 
 UDEVADM_INFO_QUERY = """\
@@ -116,3 +121,222 @@ class TestUdevInfo(CiTestCase):
             ['udevadm', 'info', '--query=property', '--export', mypath],
             capture=True)
         self.assertEqual({'SCSI_IDENT_TARGET_VENDOR': 'clusterid=92901'}, info)
+
+
+def udev_message(props):
+    """ Return a uevent as re-broadcast by udev with properties props. """
+    data = b''.join(('%s=%s' % item).encode() + b'\0'
+                    for item in sorted(props.items()))
+    header = (udev.UDEV_MONITOR_PREFIX +
+              struct.pack('>I', udev.UDEV_MONITOR_MAGIC) +
+              struct.pack('=III', 40, 40, len(data)) + b'\0' * 16)
+    return header + data
+
+
+class FakeUeventSource(object):
+
+    def __init__(self, events):
+        self.events = list(events)
+        self.timeouts = []
+        self.closed = False
+
+    def receive(self, timeout):
+        self.timeouts.append(timeout)
+        return self.events.pop(0) if self.events else None
+
+    def close(self):
+        self.closed = True
+
+
+class TestParseUevent(CiTestCase):
+
+    def test_parse_udev_event(self):
+        props = {'ACTION': 'add', 'DEVNAME': '/dev/sda1',
+                 'DEVLINKS': '/dev/disk/by-id/a-part1 /dev/disk/by-uuid/b'}
+        self.assertEqual(props, udev.parse_uevent(udev_message(props)))
+
+    def test_parse_kernel_event(self):
+        data = (b'add@/devices/virtual/block/loop0/loop0p1\0ACTION=add\0'
+                b'DEVNAME=loop0p1\0SUBSYSTEM=block\0')
+        self.assertEqual(
+            {'ACTION': 'add', 'DEVNAME': 'loop0p1', 'SUBSYSTEM': 'block'},
+            udev.parse_uevent(data))
+
+    def test_parse_bad_magic_raises(self):
+        data = bytearray(udev_message({'ACTION': 'add'}))
+        data[8] = 0
+        with self.assertRaises(ValueError):
+            udev.parse_uevent(bytes(data))
+
+
+class TestUdevadmSettle(CiTestCase):
+
+    @mock.patch('curtin.udev.os.path.exists', return_value=True)
+    @mock.patch('curtin.udev.util.subp')
+    def test_existing_path_counts_as_settled(self, m_subp, m_exists):
+        generation = udev.settle_generation()
+        udev.udevadm_settle(exists='/dev/sda2')
+        self.assertEqual(0, m_subp.call_count)
+        self.assertNotEqual(generation, udev.settle_generation())
+
+
+class TestUdevProcessed(CiTestCase):
+
+    def setUp(self):
+        super(TestUdevProcessed, self).setUp()
+        self.data_dir = self.tmp_dir()
+        self.add_patch('curtin.udev.UDEV_DATA_DIR', 'm_data_dir',
+                       autospec=None, new=self.data_dir)
+        self.add_patch('curtin.udev.os.path.islink', 'm_islink',
+                       return_value=False)
+        real_stat = os.stat
+        node = mock.Mock(st_mode=stat.S_IFBLK | 0o660,
+                         st_rdev=os.makedev(8, 2))
+        self.add_patch('curtin.udev.os.stat', 'm_stat')
+        self.m_stat.side_effect = lambda path: (
+            real_stat(path) if path.startswith(self.data_dir) else node)
+
+    def test_existing_node_is_not_processed_yet(self):
+        self.assertFalse(udev.udev_processed('/dev/sda2'))
+        with open(os.path.join(self.data_dir, 'b8:2'), 'w') as fp:
+            fp.write('E:ID_FS_TYPE=ext4\n')
+        self.assertTrue(udev.udev_processed('/dev/sda2'))
+
+    def test_missing_path_or_symlink(self):
+        self.m_islink.return_value = True
+        self.assertTrue(udev.udev_processed('/dev/disk/by-id/disk-part2'))
+        self.m_stat.side_effect = OSError(errno.ENOENT, 'missing')
+        self.assertFalse(udev.udev_processed('/dev/disk/by-id/disk-part2'))
+
+
+class TestWaitForDevice(CiTestCase):
+
+    def setUp(self):
+        super(TestWaitForDevice, self).setUp()
+        self.add_patch('curtin.udev.udevadm_settle', 'm_settle')
+        self.add_patch('curtin.udev.udev_processed', 'm_processed',
+                       return_value=False)
+
+    def test_returns_on_matching_event(self):
+        source = FakeUeventSource([
+            {'DEVNAME': '/dev/sdb1'},
+            {'DEVNAME': '/dev/sda2',
+             'DEVLINKS': '/dev/disk/by-id/disk-part2 /dev/disk/by-uuid/x'},
+            {'DEVNAME': '/dev/sda3'}])
+        udev.wait_for_device('/dev/disk/by-id/disk-part2', source=source)
+        self.assertEqual(1, len(source.events))
+        self.assertEqual(0, self.m_settle.call_count)
+        self.assertFalse(source.closed)
+
+    def test_matches_kernel_device_names(self):
+        source = FakeUeventSource([{'DEVNAME': 'sda2'}])
+        udev.wait_for_device('/dev/sda2', source=source)
+        self.assertEqual(0, self.m_settle.call_count)
+
+    def test_returns_if_udev_processed_path(self):
+        self.m_processed.return_value = True
+        source = FakeUeventSource([{'DEVNAME': '/dev/sdb1'}])
+        generation = udev.settle_generation()
+        udev.wait_for_device('/dev/sda2', source=source)
+        self.assertEqual([], source.timeouts)
+        # caches of device state are still refreshed
+        self.assertNotEqual(generation, udev.settle_generation())
+
+    def test_settles_without_event(self):
+        source = FakeUeventSource([{'DEVNAME': '/dev/sdb1'}])
+        udev.wait_for_device('/dev/sda2', timeout=5, source=source)
+        self.assertEqual(2, len(source.timeouts))
+        self.assertTrue(all(0 < timeout <= 5 for timeout in source.timeouts))
+        self.m_settle.assert_called_with()
+
+    @mock.patch('curtin.udev.NetlinkUeventSource')
+    def test_closes_netlink_source(self, m_source):
+        m_source.return_value.receive.return_value = {'DEVNAME': '/dev/sda2'}
+        udev.wait_for_device('/dev/sda2')
+        m_source.return_value.close.assert_called_with()
+        self.assertEqual(0, self.m_settle.call_count)
+
+    @mock.patch('curtin.udev.socket.socket')
+    def test_settles_without_netlink(self, m_socket):
+        m_socket.side_effect = OSError('Address family not supported')
+        udev.wait_for_device('/dev/sda2')
+        self.m_settle.assert_called_with()
+
+
+UDEV_DATA = """\
+S:disk/by-id/nvme-eui.0025388b710116a1
+S:disk/by-id/nvme-n1
+I:2026691
+E:ID_PART_TABLE_TYPE=gpt
+E:ID_PART_TABLE_UUID=ea0b9ddc-a114-4e01-b257-750d86e3a944
+E:ID_SERIAL=SAMSUNG MZVLB1T0HALR-000L7_S3TPNY0JB00151
+E:ID_SERIAL_SHORT=S3TPNY0JB00151
+G:systemd
+"""
+
+
+class TestUdevDatabase(CiTestCase):
+
+    def setUp(self):
+        super(TestUdevDatabase, self).setUp()
+        self.add_patch('curtin.util.subp', 'm_subp')
+        self.add_patch('curtin.udev.udevadm_info', 'm_udevadm_info')
+        tmp = self.tmp_dir()
+        self.sysfs = os.path.join(tmp, 'sys')
+        self.data_dir = os.path.join(tmp, 'data')
+        devpath = self.sysfs + INFO_DICT['DEVPATH']
+        populate_dir(devpath, {
+            'dev': '259:0\n',
+            'uevent': 'MAJOR=259\nMINOR=0\nDEVNAME=nvme0n1\nDEVTYPE=disk\n'})
+        os.makedirs(os.path.join(self.sysfs, 'dev', 'block'))
+        os.symlink(devpath, os.path.join(self.sysfs, 'dev', 'block', '259:0'))
+        populate_dir(self.data_dir, {'b259:0': UDEV_DATA})
+        self.db = udev.UdevDatabase(data_dir=self.data_dir, sysfs=self.sysfs)
+
+    def test_lookups_match_udevadm_info(self):
+        for path in ('259:0', self.sysfs + INFO_DICT['DEVPATH']):
+            self.assertEqual(INFO_DICT, self.db.get(path))
+        self.assertEqual(0, self.m_subp.call_count)
+        self.assertEqual(0, self.m_udevadm_info.call_count)
+
+    def test_lookup_of_device_node(self):
+        real_stat = os.stat
+        node = mock.Mock(st_mode=stat.S_IFBLK | 0o660,
+                         st_rdev=os.makedev(259, 0))
+        with mock.patch('curtin.udev.os.stat') as m_stat:
+            m_stat.side_effect = lambda path: (
+                node if path == '/dev/nvme0n1' else real_stat(path))
+            self.assertEqual(INFO_DICT, self.db.get('/dev/nvme0n1'))
+        self.assertEqual(0, self.m_udevadm_info.call_count)
+
+    def test_devices_without_database_entry_use_udevadm(self):
+        self.db.get('/dev/loop-control')
+        self.m_udevadm_info.assert_called_once_with('/dev/loop-control')
+        self.db.get('8:0')
+        self.m_udevadm_info.assert_called_with('8:0')
+
+    def test_returns_copies(self):
+        self.db.get('259:0')['DEVLINKS'].append('/dev/foo')
+        self.assertEqual(INFO_DICT, self.db.get('259:0'))
+
+    def test_reloads_only_rewritten_devices(self):
+        with mock.patch('curtin.udev.util.load_file',
+                        side_effect=util.load_file) as m_load:
+            self.db.get('259:0')
+            self.db.get('259:0')
+            self.assertEqual(2, m_load.call_count)
+            # udev replaces the database file of a device it processed
+            data_file = os.path.join(self.data_dir, 'b259:0')
+            new_file = data_file + '.new'
+            with open(new_file, 'w') as fp:
+                fp.write(UDEV_DATA + 'E:ID_FS_TYPE=ext4\n')
+            os.rename(new_file, data_file)
+            self.assertEqual('ext4', self.db.get('259:0')['ID_FS_TYPE'])
+            self.assertEqual(4, m_load.call_count)
+
+    def test_invalid_path(self):
+        with self.assertRaises(ValueError):
+            self.db.get(None)
+
+
+# vi: ts=4 expandtab syntax=python
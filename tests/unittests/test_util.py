@@ -25,6 +25,89 @@ class TestLogTimer(CiTestCase):
         self.assertIn("mymessage", data['msg'])
 
 
+class TestRunInDependencyOrder(CiTestCase):
+
+    def test_serial_runs_in_list_order(self):
+        seen = []
+        result = util.run_in_dependency_order(
+            ['a', 'b', 'c'], lambda item: seen.append(item) or item * 2)
+        self.assertEqual(['a', 'b', 'c'], seen)
+        self.assertEqual({'a': 'aa', 'b': 'bb', 'c': 'cc'}, result)
+
+    def test_serial_runs_dependencies_first(self):
+        seen = []
+        util.run_in_dependency_order(
+            ['a', 'b', 'c'], seen.append, depends={'a': ['c'], 'b': ['a']})
+        self.assertEqual(['c', 'a', 'b'], seen)
+
+    def test_unknown_and_self_dependencies_are_ignored(self):
+        seen = []
+        util.run_in_dependency_order(
+            ['a', 'b'], seen.append, depends={'a': ['a', 'x']},
+            max_workers=2)
+        self.assertEqual(['a', 'b'], sorted(seen))
+
+    def test_parallel_respects_dependencies(self):
+        seen = []
+        depends = {'b': ['a'], 'c': ['a'], 'd': ['b', 'c']}
+        util.run_in_dependency_order(
+            ['a', 'b', 'c', 'd'], seen.append, depends=depends,
+            max_workers=4)
+        self.assertEqual('a', seen[0])
+        self.assertEqual(['b', 'c'], sorted(seen[1:3]))
+        self.assertEqual('d', seen[3])
+
+    def test_parallel_runs_independent_items_concurrently(self):
+        barrier = util.threading.Event()
+        started = []
+
+        def func(item):
+            started.append(item)
+            if len(started) == 2:
+                barrier.set()
+            # both items must be running at once for this to return
+            self.assertTrue(barrier.wait(5))
+
+        util.run_in_dependency_order(['a', 'b'], func, max_workers=2)
+        self.assertEqual(['a', 'b'], sorted(started))
+
+    def test_parallel_limits_workers(self):
+        lock = util.threading.Lock()
+        state = {'running': 0, 'max': 0}
+
+        def func(item):
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            util.time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+
+        util.run_in_dependency_order(range(10), func, max_workers=3)
+        self.assertLessEqual(state['max'], 3)
+
+    def test_parallel_raises_first_error_and_stops_scheduling(self):
+        seen = []
+
+        def func(item):
+            seen.append(item)
+            if item == 'a':
+                raise RuntimeError('failed on a')
+
+        with self.assertRaises(RuntimeError):
+            util.run_in_dependency_order(
+                ['a', 'b', 'c'], func, depends={'b': ['a'], 'c': ['b']},
+                max_workers=2)
+        self.assertEqual(['a'], seen)
+
+    def test_cycle_raises_valueerror(self):
+        for workers in (1, 2):
+            with self.assertRaises(ValueError):
+                util.run_in_dependency_order(
+                    ['a', 'b'], lambda item: None,
+                    depends={'a': ['b'], 'b': ['a']}, max_workers=workers)
+
+
 class TestDisableDaemons(CiTestCase):
     prcpath = "usr/sbin/policy-rc.d"
 
@@ -1122,8 +1205,8 @@ class TestSanitizeSource(CiTestCase):
 
     # copied from curtin.util.sanitize_source
     supported = ['tgz', 'dd-tgz', 'tbz', 'dd-tbz', 'txz', 'dd-txz', 'dd-tar',
-                 'dd-bz2', 'dd-gz', 'dd-xz', 'dd-raw', 'fsimage',
-                 'fsimage-layered']
+                 'dd-bz2', 'dd-gz', 'dd-xz', 'dd-zst', 'dd-raw', 'dd-qcow2',
+                 'dd-sparse', 'fsimage', 'fsimage-layered']
     source_url = 'http://curtin.io/root-fs.foo'
     squashfs_source_path = "/media/filesystem.squashfs"
 